@@ -1,7 +1,12 @@
 """Custom callbacks
 """
 from lightning.pytorch import Trainer
-from lightning.pytorch.callbacks import BaseFinetuning, EarlyStopping, LearningRateFinder
+from lightning.pytorch.callbacks import (
+    BaseFinetuning,
+    Callback,
+    EarlyStopping,
+    LearningRateFinder,
+)
 from lightning.pytorch.trainer.states import TrainerFn
 
 
@@ -127,3 +132,116 @@ class PhasedLearningRateFinder(LearningRateFinder):
     def activate(self):
         """Activate callback"""
         self.active = True
+
+
+class SampleCacheMonitor(Callback):
+    """Log the hit rate of the shared-memory sample caches of the train and val dataloaders
+
+    The datamodule must have been created with `sample_cache_bytes` set. The hits and misses are
+    counted over each epoch.
+    """
+
+    def __init__(self):
+        """Log the hit rate of the shared-memory sample caches"""
+        super().__init__()
+        self._last_counts: dict[str, tuple[int, int]] = {}
+
+    def _log_cache_stats(self, split, dataloader, pl_module) -> None:
+        # Dataloaders may be wrapped in a `DevicePrefetcher`
+        dataloader = getattr(dataloader, "iterable", dataloader)
+        cache = getattr(getattr(dataloader, "dataset", None), "cache", None)
+        if cache is None:
+            return
+
+        last_hits, last_misses = self._last_counts.get(split, (0, 0))
+        hits, misses = cache.hits - last_hits, cache.misses - last_misses
+        self._last_counts[split] = (cache.hits, cache.misses)
+
+        pl_module.log_dict(
+            {
+                f"{split}_sample_cache/hits": float(hits),
+                f"{split}_sample_cache/misses": float(misses),
+                f"{split}_sample_cache/hit_rate": hits / max(hits + misses, 1),
+                f"{split}_sample_cache/gigabytes": cache.nbytes / 1e9,
+            },
+            on_step=False,
+            on_epoch=True,
+        )
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        """Log the train cache stats"""
+        self._log_cache_stats("train", trainer.train_dataloader, pl_module)
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        """Log the val cache stats"""
+        if not trainer.sanity_checking:
+            self._log_cache_stats("val", trainer.val_dataloaders, pl_module)
+
+
+class DataStageMonitor(Callback):
+    """Log the time the dataloader workers spend in each stage of loading the batches
+
+    The datamodule must have been created with `time_data_stages` set, and the timers are read from
+    the datamodule of the trainer. For each stage, such as reading or collating the samples, this
+    logs the milliseconds spent per batch used by the model, summed over the workers. The train
+    times are logged as `data/<stage>_ms` every `log_every_n_steps` steps and the val times as
+    `val_data/<stage>_ms` each epoch.
+    """
+
+    def __init__(self):
+        """Log the time the dataloader workers spend in each stage of loading the batches"""
+        super().__init__()
+        self._last_seconds: dict[str, tuple] = {}
+        self._num_batches: dict[str, int] = {"train": 0, "val": 0}
+
+    def _get_stage_times(self, split, datamodule) -> tuple[dict[str, float], int] | None:
+        """Get the seconds spent in each stage and the number of batches since the last call"""
+        stage_timer = getattr(datamodule, f"{split}_stage_timer", None)
+        if stage_timer is None:
+            return None
+
+        seconds = stage_timer.get_seconds()
+        last_timer, last_seconds = self._last_seconds.get(split, (None, {}))
+        # A new dataloader has a new timer which starts from zero
+        if last_timer is not stage_timer:
+            last_seconds = {}
+        self._last_seconds[split] = (stage_timer, seconds)
+
+        num_batches = self._num_batches[split]
+        self._num_batches[split] = 0
+        return {k: v - last_seconds.get(k, 0) for k, v in seconds.items()}, num_batches
+
+    def _log_stage_times(self, split, datamodule, pl_module, on_step) -> None:
+        stage_times = self._get_stage_times(split, datamodule)
+        if stage_times is None or stage_times[1] == 0:
+            return
+        seconds, num_batches = stage_times
+
+        prefix = "data" if split == "train" else f"{split}_data"
+        pl_module.log_dict(
+            {
+                f"{prefix}/{stage}_ms": 1e3 * total / num_batches
+                for stage, total in seconds.items()
+                if total > 0
+            },
+            on_step=on_step,
+            on_epoch=not on_step,
+        )
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        """Log the train stage times"""
+        self._num_batches["train"] += 1
+        if (batch_idx + 1) % trainer.log_every_n_steps == 0:
+            self._log_stage_times("train", trainer.datamodule, pl_module, on_step=True)
+
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        """Count the val batches"""
+        self._num_batches["val"] += 1
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        """Log the val stage times"""
+        if trainer.sanity_checking:
+            # Do not count the sanity check batches in the first epoch
+            self._get_stage_times("val", trainer.datamodule)
+        else:
+            self._log_stage_times("val", trainer.datamodule, pl_module, on_step=False)
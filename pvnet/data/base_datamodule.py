@@ -1,42 +1,195 @@
 """ Data module for pytorch lightning """
 
-from glob import glob
+import contextlib
+import math
+from functools import partial
 
 from lightning.pytorch import LightningDataModule
 from ocf_data_sampler.numpy_sample.collate import stack_np_samples_into_batch
 from ocf_data_sampler.sample.base import (
     NumpyBatch,
+    NumpySample,
     SampleBase,
     TensorBatch,
     batch_to_tensor,
 )
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 
+from pvnet.data.collate import BufferedCollator
+from pvnet.data.encoding import decode_sample, get_image_encoding
+from pvnet.data.manifest import get_sample_paths, load_filtered_manifest
+from pvnet.data.memmap_samples import MemmapSamplesDataset
+from pvnet.data.packed_samples import PackedSamplesDataset, PackedSamplesIterableDataset
+from pvnet.data.prefetch import DevicePrefetcher
+from pvnet.data.projection import ProjectedDataset, SampleProjection
+from pvnet.data.remote import RemoteSampleReader, is_remote_path
+from pvnet.data.sample_cache import CachedDataset
+from pvnet.data.sampler import ResumableSampler
+from pvnet.data.shared_batches import SharedBatchCollator, SharedBatchDataLoader, SharedBatchSlots
+from pvnet.data.stream_cache import StreamedSampleCache
+from pvnet.data.timing import StageTimer, TimedDataset, time_stage
+from pvnet.data.utils import read_sample_format
 
-def collate_fn(samples: list[NumpyBatch]) -> TensorBatch:
-    """Convert a list of NumpySample samples to a tensor batch"""
-    return batch_to_tensor(stack_np_samples_into_batch(samples))
+
+def collate_fn(
+    samples: list[NumpySample] | NumpyBatch, stage_timer: StageTimer | None = None
+) -> TensorBatch:
+    """Convert a list of NumpySample samples, or an already stacked batch, to a tensor batch
+
+    The samples are stacked straight into the batch arrays, so samples which are views into
+    memory-mapped files are only copied once. Datasets with a `__getitems__()` method return
+    batches which are already stacked.
+
+    Args:
+        samples: The samples to collate
+        stage_timer: If set, the stacking and conversion to tensors are timed
+    """
+    if not isinstance(samples, dict):
+        with time_stage(stage_timer, "collate"):
+            samples = stack_np_samples_into_batch(samples)
+    with time_stage(stage_timer, "to_tensor"):
+        return batch_to_tensor(samples)
 
 
 class PremadeSamplesDataset(Dataset):
     """Dataset to load samples from
 
+    The sample paths are read from the manifest of the sample directory if it has one. Otherwise
+    the directory is listed. The samples can only be filtered if there is a manifest.
+
     Args:
         sample_dir: Path to the directory of pre-saved samples.
         sample_class: sample class type to use for save/load/to_numpy
+        start_time: If set, only use samples with init-times at or after this time
+        end_time: If set, only use samples with init-times at or before this time
+        target_ids: If set, only use samples for these GSP or site IDs
+        projection: If set, the samples are reduced to the inputs used by a model as they are
+            loaded
+        reader: The reader used if the sample directory is on a remote filesystem. A reader
+            without a disk cache is used by default
+        stage_timer: If set, the reading, projection and decoding of the samples are timed
     """
 
-    def __init__(self, sample_dir: str, sample_class: SampleBase):
+    def __init__(
+        self,
+        sample_dir: str,
+        sample_class: SampleBase,
+        start_time: str | None = None,
+        end_time: str | None = None,
+        target_ids: list[int] | None = None,
+        projection: SampleProjection | None = None,
+        reader: RemoteSampleReader | None = None,
+        stage_timer: StageTimer | None = None,
+    ):
         """Initialise PremadeSamplesDataset"""
-        self.sample_paths = glob(f"{sample_dir}/*")
+        manifest = load_filtered_manifest(sample_dir, start_time, end_time, target_ids)
+        if manifest is None:
+            self.sample_paths = get_sample_paths(sample_dir)
+        else:
+            self.sample_paths = [f"{sample_dir}/{path}" for path in manifest["path"]]
         self.sample_class = sample_class
+        self.image_encoding = get_image_encoding(read_sample_format(sample_dir))
+        self.projection = projection
+        if reader is None and is_remote_path(sample_dir):
+            reader = RemoteSampleReader()
+        self.reader = reader
+        self.stage_timer = stage_timer
 
     def __len__(self):
         return len(self.sample_paths)
 
+    def _load(self, idx):
+        path = self.sample_paths[idx]
+        with contextlib.ExitStack() as stack:
+            with time_stage(self.stage_timer, "read"):
+                if self.reader is not None:
+                    # The samples may be loaded lazily, so the local copy is kept until they
+                    # are converted to numpy
+                    path = stack.enter_context(self.reader.local_file(path))
+                sample = self.sample_class.load(path)
+            with time_stage(self.stage_timer, "to_numpy"):
+                sample = sample.to_numpy()
+        if self.projection is not None:
+            with time_stage(self.stage_timer, "project"):
+                sample = self.projection.project(sample)
+        return sample
+
     def __getitem__(self, idx):
-        sample = self.sample_class.load(self.sample_paths[idx])
-        return sample.to_numpy()
+        sample = self._load(idx)
+        with time_stage(self.stage_timer, "decode"):
+            return decode_sample(sample, self.image_encoding)
+
+    def __getitems__(self, indices: list[int]) -> NumpyBatch:
+        """Load a batch of samples and stack them
+
+        Returns:
+            The samples stacked into a batch
+        """
+        samples = [self._load(idx) for idx in indices]
+        with time_stage(self.stage_timer, "collate"):
+            batch = stack_np_samples_into_batch(samples)
+        with time_stage(self.stage_timer, "decode"):
+            return decode_sample(batch, self.image_encoding, batched=True)
+
+
+def get_premade_samples_dataset(
+    sample_dir: str,
+    sample_class: SampleBase,
+    start_time: str | None = None,
+    end_time: str | None = None,
+    target_ids: list[int] | None = None,
+    projection: SampleProjection | None = None,
+    stream_shards: bool = False,
+    shuffle: bool = True,
+    shuffle_buffer_size: int = 1000,
+    reader: RemoteSampleReader | None = None,
+    stage_timer: StageTimer | None = None,
+) -> Dataset:
+    """Construct the dataset matching the storage format of a directory of premade samples
+
+    Args:
+        sample_dir: Path to the directory of pre-saved samples.
+        sample_class: sample class type to use for load/to_numpy if the samples are stored one
+            per file
+        start_time: If set, only use samples with init-times at or after this time
+        end_time: If set, only use samples with init-times at or before this time
+        target_ids: If set, only use samples for these GSP or site IDs
+        projection: If set, the samples are reduced to the inputs used by a model as they are
+            loaded
+        stream_shards: Whether to return an iterable dataset which reads packed shards in order
+        shuffle: Whether the iterable dataset shuffles the samples. Only used if `stream_shards`
+        shuffle_buffer_size: The shuffle buffer size of the iterable dataset. Only used if
+            `stream_shards`
+        reader: The reader used if the sample directory is on a remote filesystem
+        stage_timer: If set, the stages of loading the samples are timed. Not used for samples
+            in the memmap format
+    """
+    sample_format = read_sample_format(sample_dir)
+    filters = dict(
+        start_time=start_time, end_time=end_time, target_ids=target_ids, projection=projection
+    )
+
+    if sample_format is not None and sample_format["format"] == "memmap":
+        # Memory-mapping needs the arrays on the local filesystem
+        if is_remote_path(sample_dir):
+            raise ValueError("Samples in the memmap format cannot be read from a remote filesystem")
+        return MemmapSamplesDataset(sample_dir, **filters)
+
+    filters.update(reader=reader, stage_timer=stage_timer)
+
+    if stream_shards:
+        if sample_format is None or sample_format["format"] != "packed":
+            raise ValueError("Streaming shards requires samples in the packed format")
+        return PackedSamplesIterableDataset(
+            sample_dir, shuffle=shuffle, shuffle_buffer_size=shuffle_buffer_size, **filters
+        )
+
+    if sample_format is None or sample_format["format"] == "files":
+        return PremadeSamplesDataset(sample_dir, sample_class, **filters)
+    elif sample_format["format"] == "packed":
+        return PackedSamplesDataset(sample_dir, **filters)
+    else:
+        raise ValueError(f"Unknown sample format: {sample_format['format']}")
 
 
 class BaseDataModule(LightningDataModule):
@@ -51,6 +204,22 @@ class BaseDataModule(LightningDataModule):
         prefetch_factor: int | None = None,
         train_period: list[str | None] = [None, None],
         val_period: list[str | None] = [None, None],
+        target_ids: list[int] | None = None,
+        sample_cache_bytes: int | None = None,
+        stream_shards: bool = False,
+        shuffle_buffer_size: int = 1000,
+        projection: SampleProjection | None = None,
+        use_model_input_spec: bool = False,
+        reuse_collate_buffers: bool = False,
+        pin_collate_buffers: bool = False,
+        shared_batch_slot_bytes: int | None = None,
+        prefetch_to_device: int | None = None,
+        stream_cache_dir: str | None = None,
+        resumable_sampler: bool = False,
+        sampler_seed: int = 0,
+        remote_cache_dir: str | None = None,
+        remote_cache_bytes: int | None = None,
+        time_data_stages: bool = False,
     ):
         """Base Datamodule for training pvnet architecture.
 
@@ -59,12 +228,57 @@ class BaseDataModule(LightningDataModule):
         Args:
             configuration: Path to ocf-data-sampler configuration file.
             sample_dir: Path to the directory of pre-saved samples. Cannot be used together with
-                `configuration` or '[train/val]_period'.
+                `configuration`.
             batch_size: Batch size.
             num_workers: Number of workers to use in multiprocess batch loading.
             prefetch_factor: Number of data will be prefetched at the end of each worker process.
-            train_period: Date range filter for train dataloader.
-            val_period: Date range filter for val dataloader.
+            train_period: Date range filter for train dataloader. With pre-saved samples this
+                requires the sample directories to have manifests.
+            val_period: Date range filter for val dataloader. With pre-saved samples this requires
+                the sample directories to have manifests.
+            target_ids: If set, only use samples for these GSP or site IDs. With pre-saved samples
+                this requires the sample directories to have manifests.
+            sample_cache_bytes: If set, pre-saved samples are cached in shared memory so they are
+                only read from disk once. This is the byte budget of the cache for each of the
+                train and val sets. The cache is shared by all dataloader workers.
+            stream_shards: If True, pre-saved samples in the packed format are streamed from each
+                shard in order rather than read in a random order. This gives close to sequential
+                disk reads. The train samples are shuffled using a shuffle buffer.
+            shuffle_buffer_size: The number of samples in the shuffle buffer if `stream_shards`.
+            projection: If set, the samples are reduced to the inputs used by the model inside the
+                dataloader workers, so the workers only load and send what the model uses.
+            use_model_input_spec: If True, the samples are reduced using the input spec declared
+                by the model being trained with `get_input_spec()`. Cannot be used together with
+                `projection`.
+            reuse_collate_buffers: If True, batches are stacked into a ring of preallocated tensor
+                buffers which are reused rather than allocated for each batch. In the dataloader
+                workers these buffers are in shared memory, so the batches are not copied again to
+                be sent to the main process. Batches must not be kept after the next few batches
+                have been loaded, since their buffers are then overwritten.
+            pin_collate_buffers: If True, the reused collate buffers are pinned. Only used if
+                `reuse_collate_buffers` and `num_workers` is 0.
+            shared_batch_slot_bytes: If set, the dataloader workers write batches into a fixed set
+                of preallocated shared-memory slots of this size, and the main process reads them
+                without copying. This avoids a shared-memory file for every tensor of every batch.
+                Only used if `num_workers` is greater than 0.
+            prefetch_to_device: If set, this many batches are copied to the device of the trainer
+                ahead of time on a background thread, so that loading and copying the next batches
+                overlaps with the compute. Only supported when training on a single device.
+            stream_cache_dir: If set, each sample streamed using `configuration` is saved to this
+                directory the first time it is generated. The same samples are then loaded from the
+                cache in later epochs and later runs with the same data configuration.
+            resumable_sampler: If True, the train samples are shuffled deterministically from
+                `sampler_seed` and the epoch number. The position in the epoch is stored in
+                checkpoints, so a run resumed from a checkpoint continues with the next sample
+                rather than starting the epoch again. Cannot be used with `stream_shards`.
+            sampler_seed: The seed of the resumable sampler.
+            remote_cache_dir: If set and `sample_dir` is on a remote filesystem such as `s3://` or
+                `gs://`, what is read from the remote samples is cached in this local directory.
+            remote_cache_bytes: The byte budget of the remote sample cache. The least recently
+                used data is deleted when the cache is full. Required if `remote_cache_dir` is set.
+            time_data_stages: If True, the time the dataloader workers spend reading, decoding
+                and collating the samples is recorded. Use `pvnet.callbacks.DataStageMonitor` to
+                log these times.
 
         """
         super().__init__()
@@ -72,21 +286,55 @@ class BaseDataModule(LightningDataModule):
         if not ((sample_dir is not None) ^ (configuration is not None)):
             raise ValueError("Exactly one of `sample_dir` or `configuration` must be set.")
 
-        if sample_dir is not None:
-            if any([period != [None, None] for period in [train_period, val_period]]):
-                raise ValueError("Cannot set `(train/val)_period` with presaved samples")
+        if stream_cache_dir is not None and sample_dir is not None:
+            raise ValueError("Cannot use `stream_cache_dir` with `sample_dir`")
+
+        if stream_shards and resumable_sampler:
+            raise ValueError("Cannot use `resumable_sampler` with `stream_shards`")
+
+        if stream_shards and sample_cache_bytes is not None:
+            raise ValueError("Cannot use `sample_cache_bytes` with `stream_shards`")
+
+        if projection is not None and use_model_input_spec:
+            raise ValueError("Cannot use `projection` with `use_model_input_spec`")
+
+        if reuse_collate_buffers and shared_batch_slot_bytes is not None:
+            raise ValueError("Cannot use `reuse_collate_buffers` with `shared_batch_slot_bytes`")
+
+        if remote_cache_dir is not None and remote_cache_bytes is None:
+            raise ValueError("`remote_cache_bytes` must be set to use `remote_cache_dir`")
 
         self.configuration = configuration
         self.sample_dir = sample_dir
         self.train_period = train_period
         self.val_period = val_period
+        self.target_ids = target_ids
+        self.sample_cache_bytes = sample_cache_bytes
+        self.stream_shards = stream_shards
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.projection = projection
+        self.use_model_input_spec = use_model_input_spec
+        self.reuse_collate_buffers = reuse_collate_buffers
+        self.pin_collate_buffers = pin_collate_buffers
+        self.shared_batch_slot_bytes = shared_batch_slot_bytes
+        self.prefetch_to_device = prefetch_to_device
+        self.stream_cache_dir = stream_cache_dir
+        self.resumable_sampler = resumable_sampler
+        self.sampler_seed = sampler_seed
+        self.remote_cache_dir = remote_cache_dir
+        self.remote_cache_bytes = remote_cache_bytes
+        self.time_data_stages = time_data_stages
+        # The position of the train sampler loaded from a checkpoint
+        self._sampler_state: dict | None = None
+        # The timers of the current dataloaders, read by `pvnet.callbacks.DataStageMonitor`
+        self.train_stage_timer: StageTimer | None = None
+        self.val_stage_timer: StageTimer | None = None
 
         self._common_dataloader_kwargs = dict(
             batch_size=batch_size,
             sampler=None,
             batch_sampler=None,
             num_workers=num_workers,
-            collate_fn=collate_fn,
             pin_memory=False,
             drop_last=False,
             timeout=0,
@@ -98,21 +346,199 @@ class BaseDataModule(LightningDataModule):
     def _get_streamed_samples_dataset(self, start_time, end_time) -> Dataset:
         raise NotImplementedError
 
-    def _get_premade_samples_dataset(self, subdir) -> Dataset:
+    def _get_premade_samples_dataset(self, subdir, **kwargs) -> Dataset:
         raise NotImplementedError
 
-    def train_dataloader(self) -> DataLoader:
-        """Construct train dataloader"""
-        if self.sample_dir is not None:
-            dataset = self._get_premade_samples_dataset("train")
+    def _get_projection(self) -> SampleProjection | None:
+        """Get the projection to apply to the samples"""
+        if not self.use_model_input_spec:
+            return self.projection
+        if self.trainer is None:
+            raise ValueError(
+                "`use_model_input_spec` requires the datamodule to be used by a trainer"
+            )
+        return self.trainer.lightning_module.get_input_spec()
+
+    def _get_worker_batches_in_flight(self) -> int:
+        """Get the number of batches which the dataloader workers can have in flight at once"""
+        kwargs = self._common_dataloader_kwargs
+        if kwargs["num_workers"] == 0:
+            return 0
+        # Each worker can have `prefetch_factor` batches in flight
+        prefetch_factor = 2 if kwargs["prefetch_factor"] is None else kwargs["prefetch_factor"]
+        return kwargs["num_workers"] * prefetch_factor
+
+    def _get_device_prefetched_batches(self) -> int:
+        """Get the number of batches which the device prefetcher can hold at once
+
+        On CPU the device batches are the host batches, so their buffers must not be reused.
+        """
+        if self.prefetch_to_device is None:
+            return 0
+        # The batches in its queue and one being staged on its thread
+        return self.prefetch_to_device + 1
+
+    def _get_batches_in_flight(self) -> int:
+        """Get the number of batches which can be in use at once, not counting the trainer's"""
+        return self._get_worker_batches_in_flight() + self._get_device_prefetched_batches()
+
+    def _get_stage_timer(self) -> StageTimer | None:
+        """Construct a timer for the stages of the data pipeline if required"""
+        if not self.time_data_stages:
+            return None
+        return StageTimer(num_workers=self._common_dataloader_kwargs["num_workers"])
+
+    def _get_dataloader(
+        self,
+        dataset: Dataset,
+        shuffle: bool,
+        sampler: ResumableSampler | None = None,
+        stage_timer: StageTimer | None = None,
+    ) -> DataLoader:
+        """Construct a dataloader with its own collate function
+
+        Each dataloader gets its own collator, so the train and val batches use separate buffers
+        or slots.
+        """
+        kwargs = self._common_dataloader_kwargs
+        default_collate_fn = (
+            collate_fn if stage_timer is None else partial(collate_fn, stage_timer=stage_timer)
+        )
+        if sampler is not None:
+            # The sampler does the shuffling
+            kwargs = dict(kwargs, sampler=sampler)
+            shuffle = False
+
+        if self.shared_batch_slot_bytes is not None and kwargs["num_workers"] > 0:
+            # The trainer also holds the batch it is using and prefetches one more. The slots are
+            # freed once their batches are garbage collected, so these counts only avoid stalls
+            slots = SharedBatchSlots(
+                num_slots=self._get_batches_in_flight() + 4,
+                slot_bytes=self.shared_batch_slot_bytes,
+            )
+            dataloader = SharedBatchDataLoader(
+                dataset,
+                shuffle=shuffle,
+                collate_fn=SharedBatchCollator(slots, default_collate_fn),
+                **kwargs,
+            )
         else:
-            dataset = self._get_streamed_samples_dataset(*self.train_period)
-        return DataLoader(dataset, shuffle=True, **self._common_dataloader_kwargs)
+            if self.reuse_collate_buffers:
+                # Each worker has its own ring, so only needs room for its own prefetched batches
+                # and its share of the batches held by the device prefetcher, which takes the
+                # batches from the workers in turn
+                num_workers = max(kwargs["num_workers"], 1)
+                in_flight = self._get_worker_batches_in_flight() // num_workers + math.ceil(
+                    self._get_device_prefetched_batches() / num_workers
+                )
+                batch_collate_fn = BufferedCollator(
+                    ring_size=in_flight + 2, pin_memory=self.pin_collate_buffers
+                )
+            else:
+                batch_collate_fn = default_collate_fn
+            dataloader = DataLoader(dataset, shuffle=shuffle, collate_fn=batch_collate_fn, **kwargs)
+
+        return dataloader
+
+    def _prefetch(self, dataloader: DataLoader) -> DataLoader | DevicePrefetcher:
+        """Wrap a dataloader to prefetch its batches onto the device of the trainer if required"""
+        if self.prefetch_to_device is None:
+            return dataloader
+        if self.trainer is None:
+            raise ValueError("`prefetch_to_device` requires the datamodule to be used by a trainer")
+        # The trainer only adds distributed samplers to dataloaders it can see
+        if self.trainer.world_size > 1:
+            raise ValueError("`prefetch_to_device` is only supported on a single device")
+        return DevicePrefetcher(
+            dataloader, self.trainer.strategy.root_device, num_batches=self.prefetch_to_device
+        )
+
+    def _get_split_dataset(
+        self, subdir, period, shuffle, stage_timer: StageTimer | None = None
+    ) -> Dataset:
+        projection = self._get_projection()
+
+        if self.sample_dir is None:
+            dataset = self._get_streamed_samples_dataset(*period)
+            # The full samples are cached so the cache can be used with any projection
+            if self.stream_cache_dir is not None:
+                dataset = StreamedSampleCache(dataset, self.stream_cache_dir)
+            if stage_timer is not None:
+                dataset = TimedDataset(dataset, stage_timer, stage="generate")
+            if projection is not None:
+                dataset = ProjectedDataset(dataset, projection, stage_timer=stage_timer)
+            return dataset
 
-    def val_dataloader(self) -> DataLoader:
+        dataset = self._get_premade_samples_dataset(
+            subdir,
+            start_time=period[0],
+            end_time=period[1],
+            target_ids=self.target_ids,
+            projection=projection,
+            stream_shards=self.stream_shards,
+            shuffle=shuffle,
+            shuffle_buffer_size=self.shuffle_buffer_size,
+            reader=self._get_remote_reader(),
+            stage_timer=stage_timer,
+        )
+        if self.sample_cache_bytes is not None:
+            dataset = CachedDataset(dataset, max_bytes=self.sample_cache_bytes)
+        return dataset
+
+    def _get_remote_reader(self) -> RemoteSampleReader | None:
+        """Construct the reader for pre-saved samples on a remote filesystem"""
+        if not is_remote_path(self.sample_dir):
+            return None
+        return RemoteSampleReader(
+            cache_dir=self.remote_cache_dir, cache_bytes=self.remote_cache_bytes
+        )
+
+    def _get_train_sampler(self, dataset: Dataset) -> ResumableSampler:
+        """Construct the resumable train sampler, continuing from the checkpoint if there is one"""
+        state = self._sampler_state or {}
+        sampler = ResumableSampler(dataset, shuffle=True, seed=state.get("seed", self.sampler_seed))
+        if state:
+            sampler.resume(state["epoch"], state["num_samples_seen"])
+        return sampler
+
+    def state_dict(self) -> dict:
+        """Get the position of the resumable train sampler to store in checkpoints"""
+        if not self.resumable_sampler or self.trainer is None:
+            return {}
+        # The batches which have been used to update the model being checkpointed
+        num_batches = self.trainer.fit_loop.epoch_loop.batch_progress.current.processed
+        return dict(
+            seed=self._sampler_state["seed"] if self._sampler_state else self.sampler_seed,
+            epoch=self.trainer.current_epoch,
+            num_samples_seen=num_batches * self._common_dataloader_kwargs["batch_size"],
+        )
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        """Load the position of the resumable train sampler from a checkpoint"""
+        if self.resumable_sampler and state_dict:
+            self._sampler_state = state_dict
+
+    def train_dataloader(self) -> DataLoader | DevicePrefetcher:
+        """Construct train dataloader"""
+        stage_timer = self.train_stage_timer = self._get_stage_timer()
+        dataset = self._get_split_dataset(
+            "train", self.train_period, shuffle=True, stage_timer=stage_timer
+        )
+        # Iterable datasets shuffle themselves
+        shuffle = not isinstance(dataset, IterableDataset)
+        sampler = self._get_train_sampler(dataset) if self.resumable_sampler else None
+        return self._prefetch(
+            self._get_dataloader(
+                dataset, shuffle=shuffle, sampler=sampler, stage_timer=stage_timer
+            )
+        )
+
+    def val_dataloader(self) -> DataLoader | DevicePrefetcher:
         """Construct val dataloader"""
-        if self.sample_dir is not None:
-            dataset = self._get_premade_samples_dataset("val")
-        else:
-            dataset = self._get_streamed_samples_dataset(*self.val_period)
-        return DataLoader(dataset, shuffle=False, **self._common_dataloader_kwargs)
+        stage_timer = self.val_stage_timer = self._get_stage_timer()
+        dataset = self._get_split_dataset(
+            "val", self.val_period, shuffle=False, stage_timer=stage_timer
+        )
+        return self._prefetch(
+            self._get_dataloader(dataset, shuffle=False, stage_timer=stage_timer)
+        )
@@ -0,0 +1,138 @@
+"""Collation of samples into reusable, preallocated tensor buffers
+
+The default `collate_fn()` stacks each batch into new numpy arrays and then wraps these as tensors.
+When it runs in a DataLoader worker, the tensors are then copied again into shared memory to be sent
+to the main process. A `BufferedCollator` instead infers the batch shapes from the first batch and
+allocates a small ring of tensor buffers. Each batch is stacked straight into the next set of
+buffers in the ring. In workers the buffers are allocated in shared memory, so sending a batch to
+the main process only sends a handle to the buffers. In the main process the buffers can be pinned
+so the batches can be copied to the GPU asynchronously.
+
+A set of buffers is overwritten when the ring comes back round to it. The ring must therefore be
+larger than the number of batches from one process which can be in use at once. For a DataLoader
+this is the `prefetch_factor` of each worker, plus the batch being used and one batch prefetched by
+the trainer.
+
+Keys whose values are not numeric arrays, or which have a different shape or dtype to the first
+batch, are stacked as by the default `collate_fn()`.
+"""
+
+import numpy as np
+import torch
+from ocf_data_sampler.sample.base import NumpyBatch, NumpySample, TensorBatch, batch_to_tensor
+from torch.utils.data import get_worker_info
+
+from pvnet.data.utils import flatten_sample, is_constant_key, unflatten_sample
+
+
+class BufferedCollator:
+    """Collate samples into a ring of preallocated tensor buffers which are reused across batches
+
+    Each process which uses the collator allocates its own ring of buffers the first time it is
+    called, so a collator can be passed to the DataLoader and copied to each worker.
+
+    Args:
+        ring_size: The number of sets of buffers in the ring of each process
+        pin_memory: Whether to pin the buffers. Only used outside of DataLoader workers, since
+            pinned memory cannot be shared with the main process. Ignored if CUDA is not available
+    """
+
+    def __init__(self, ring_size: int = 4, pin_memory: bool = False):
+        """Collate samples into a ring of preallocated tensor buffers"""
+        if ring_size < 1:
+            raise ValueError(f"`ring_size` must be positive - got {ring_size}")
+        self.ring_size = ring_size
+        self.pin_memory = pin_memory
+
+        # The per-sample shape and dtype of each buffered key, and the ring of buffers
+        self._layout: dict[str, tuple[tuple[int, ...], np.dtype]] | None = None
+        self._ring: list[dict[str, torch.Tensor]] = []
+        self._capacity = 0
+        self._next = 0
+
+    def __getstate__(self):
+        # Each worker allocates its own buffers
+        state = self.__dict__.copy()
+        state.update(_layout=None, _ring=[], _capacity=0, _next=0)
+        return state
+
+    @property
+    def in_worker(self) -> bool:
+        """Whether the collator is being used in a DataLoader worker"""
+        return get_worker_info() is not None
+
+    def _allocate(self, flat_batch: dict, batch_size: int) -> None:
+        """Infer the layout of the batches and allocate the ring of buffers"""
+        self._layout = {
+            key: (value.shape[1:], value.dtype)
+            for key, value in flat_batch.items()
+            if not is_constant_key(key)
+            and isinstance(value, np.ndarray)
+            and value.ndim > 0
+            and np.issubdtype(value.dtype, np.number)
+        }
+        pin_memory = self.pin_memory and not self.in_worker and torch.cuda.is_available()
+
+        self._ring = []
+        for _ in range(self.ring_size):
+            buffers = {}
+            for key, (shape, dtype) in self._layout.items():
+                buffer = torch.from_numpy(np.empty((batch_size, *shape), dtype=dtype))
+                if pin_memory:
+                    buffer = buffer.pin_memory()
+                elif self.in_worker:
+                    buffer.share_memory_()
+                buffers[key] = buffer
+            self._ring.append(buffers)
+        self._capacity = batch_size
+        self._next = 0
+
+    def _fits(self, key: str, shape: tuple[int, ...], dtype: np.dtype) -> bool:
+        return key in self._layout and self._layout[key] == (shape, dtype)
+
+    def __call__(self, samples: list[NumpySample] | NumpyBatch) -> TensorBatch:
+        """Collate a list of samples, or an already stacked batch, into a tensor batch"""
+        if isinstance(samples, dict):
+            flat_batch = flatten_sample(samples)
+            flat_samples = None
+            batch_size = len(next(v for k, v in flat_batch.items() if not is_constant_key(k)))
+        else:
+            flat_samples = [flatten_sample(sample) for sample in samples]
+            flat_batch = flat_samples[0]
+            batch_size = len(flat_samples)
+
+        if self._layout is None or batch_size > self._capacity:
+            if flat_samples is None:
+                self._allocate(flat_batch, batch_size)
+            else:
+                self._allocate(
+                    {k: np.expand_dims(np.asarray(v), 0) for k, v in flat_batch.items()},
+                    batch_size,
+                )
+
+        buffers = self._ring[self._next]
+        self._next = (self._next + 1) % self.ring_size
+
+        out_batch = {}
+        for key, value in flat_batch.items():
+            if flat_samples is None:
+                if isinstance(value, np.ndarray) and self._fits(key, value.shape[1:], value.dtype):
+                    out = buffers[key][:batch_size]
+                    np.copyto(out.numpy(), value)
+                    value = out
+                out_batch[key] = value
+                continue
+
+            if is_constant_key(key):
+                out_batch[key] = value
+                continue
+
+            values = [np.asarray(sample[key]) for sample in flat_samples]
+            if all(self._fits(key, v.shape, v.dtype) for v in values):
+                out = buffers[key][:batch_size]
+                np.stack(values, out=out.numpy())
+                out_batch[key] = out
+            else:
+                out_batch[key] = np.stack(values)
+
+        return batch_to_tensor(unflatten_sample(out_batch))
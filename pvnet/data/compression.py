@@ -0,0 +1,117 @@
+"""Compression of the records in packed sample shards
+
+Samples are pickled with protocol 5 so the data of each numpy array is kept in a separate buffer.
+Each buffer is then compressed on its own with a numcodecs codec. This lets the blosc codec
+byte-shuffle each array using the size of its elements. The available codecs are:
+
+- none: Samples are stored as plain pickles
+- lz4: Fast compression and decompression with a modest compression ratio
+- zstd: Better compression ratios with slower compression. The level can be set from 1 to 22
+- blosc: lz4 compression inside blosc with byte-shuffling, which often compresses float arrays
+    much better than lz4 alone
+
+A compressed record is laid out as:
+
+    uint32 number of buffers
+    uint64 length of the pickle
+    for each buffer: uint64 compressed length, uint64 decompressed length
+    the pickle
+    the compressed buffers
+"""
+
+import pickle
+import struct
+
+import numcodecs
+import numpy as np
+from numcodecs.abc import Codec
+from ocf_data_sampler.sample.base import NumpySample
+
+CODECS = ["none", "lz4", "zstd", "blosc"]
+
+
+def get_codec(codec: str, compression_level: int | None = None) -> Codec | None:
+    """Construct a numcodecs codec from its name
+
+    Args:
+        codec: One of "none", "lz4", "zstd" or "blosc"
+        compression_level: The compression level. Uses the default of the codec if not set. Not
+            used for "lz4"
+
+    Returns:
+        The codec, or None if `codec` is "none"
+    """
+    if codec == "none":
+        return None
+    elif codec == "lz4":
+        return numcodecs.LZ4()
+    elif codec == "zstd":
+        return numcodecs.Zstd(level=3 if compression_level is None else compression_level)
+    elif codec == "blosc":
+        return numcodecs.Blosc(
+            cname="lz4",
+            clevel=5 if compression_level is None else compression_level,
+            shuffle=numcodecs.Blosc.SHUFFLE,
+        )
+    else:
+        raise ValueError(f"Unknown codec: {codec}. Must be one of {CODECS}")
+
+
+def get_codec_from_config(config: dict | None) -> Codec | None:
+    """Reconstruct a codec from the config stored in a sample format description"""
+    return None if config is None else numcodecs.get_codec(config)
+
+
+def compress_sample(sample: NumpySample, codec: Codec | None) -> bytes:
+    """Serialise and compress a numpy sample
+
+    Args:
+        sample: The sample to compress
+        codec: The codec to compress with. If None the sample is only pickled
+    """
+    if codec is None:
+        return pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)
+
+    buffers = []
+    data = pickle.dumps(sample, protocol=5, buffer_callback=buffers.append)
+
+    compressed = []
+    for buffer in buffers:
+        # Give the codec the element size of the array so blosc can shuffle the bytes
+        itemsize = memoryview(buffer).itemsize
+        array = np.frombuffer(buffer.raw(), dtype=np.dtype((np.void, itemsize)))
+        compressed.append((codec.encode(array), array.nbytes))
+
+    header = struct.pack("<IQ", len(buffers), len(data)) + b"".join(
+        struct.pack("<QQ", len(c), n) for c, n in compressed
+    )
+    return b"".join([header, data] + [c for c, _ in compressed])
+
+
+def decompress_sample(record: bytes | memoryview, codec: Codec | None) -> NumpySample:
+    """Decompress and deserialise a sample compressed with `compress_sample()`
+
+    Args:
+        record: The compressed record
+        codec: The codec the record was compressed with
+    """
+    if codec is None:
+        return pickle.loads(record)
+
+    record = memoryview(record)
+    num_buffers, data_length = struct.unpack_from("<IQ", record)
+    sizes = struct.iter_unpack("<QQ", record[12 : 12 + 16 * num_buffers])
+
+    position = 12 + 16 * num_buffers
+    data = record[position : position + data_length]
+    position += data_length
+
+    buffers = []
+    for compressed_length, length in sizes:
+        # Decode into writable memory so torch can use the arrays without copying
+        out = np.empty(length, dtype=np.uint8)
+        codec.decode(record[position : position + compressed_length], out=out)
+        buffers.append(out)
+        position += compressed_length
+
+    return pickle.loads(data, buffers=buffers)
@@ -0,0 +1,245 @@
+"""Deduplicated storage of concurrent samples
+
+A concurrent sample holds the samples of all GSPs for one init-time, as made by
+`PVNetUKConcurrentDataset` and saved by `scripts/save_concurrent_samples.py`. Its NWP and satellite
+arrays stack one crop per GSP, and these crops overlap heavily since they are all cut from the same
+field. The deduplicated storage instead keeps the part of the field which covers all the crops
+once, and the position of each crop in it. Each stacked image array `<key>` is replaced by:
+
+- `<key>_field`: The part of the field covering all of the crops
+- `<key>_crop_offsets`: Integer array of shape [num_gsps, ndim] with the start of each crop along
+    each axis of the field
+- `<key>_crop_shape`: The shape of one crop
+
+For example `sample["nwp"]["ukv"]["nwp"]` is stored as `sample["nwp"]["ukv"]["nwp_field"]` and so
+on, and `sample["satellite_actual"]` as `sample["satellite_actual_field"]`. All other values are
+stored as before. `load_concurrent_sample()` reads both storages and can rebuild the crops lazily,
+so only the crops which are used are copied out of the field.
+"""
+
+import numpy as np
+import torch
+import xarray as xr
+from ocf_data_sampler.numpy_sample.collate import stack_np_samples_into_batch
+from ocf_data_sampler.sample.base import NumpySample
+from ocf_data_sampler.torch_datasets.datasets.pvnet_uk import (
+    PVNetUKConcurrentDataset,
+    compute,
+    process_and_combine_datasets,
+    slice_datasets_by_space,
+    slice_datasets_by_time,
+)
+from torch.utils.data import Dataset
+
+from pvnet.data.manifest import get_sample_paths
+from pvnet.data.utils import flatten_sample, unflatten_sample
+
+_FIELD_SUFFIX = "_field"
+_OFFSETS_SUFFIX = "_crop_offsets"
+_SHAPE_SUFFIX = "_crop_shape"
+
+
+def _crop_slices(offset: np.ndarray, crop_shape: np.ndarray) -> tuple[slice, ...]:
+    return tuple(slice(int(start), int(start + size)) for start, size in zip(offset, crop_shape))
+
+
+def get_crop_offsets(field: xr.DataArray, crop: xr.DataArray) -> np.ndarray:
+    """Find the position of a crop in the field it was cut from
+
+    Args:
+        field: The data array the crop was cut from
+        crop: The crop, which must be a contiguous window of the field with the same dimensions
+
+    Returns:
+        The index of the start of the crop along each dimension of the field
+    """
+    offsets = []
+    for dim in crop.dims:
+        if crop.sizes[dim] == field.sizes[dim]:
+            offsets.append(0)
+        else:
+            offsets.append(field.get_index(dim).get_loc(crop[dim].values[0]))
+    return np.array(offsets, dtype=np.int64)
+
+
+def deduplicate_crops(crops: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Store a stack of crops as the part of their field which covers them all
+
+    Args:
+        crops: The stacked crops, with shape [num_crops, *crop_shape]
+        offsets: The start of each crop in the field it was cut from, with shape
+            [num_crops, len(crop_shape)]
+
+    Returns:
+        The part of the field covering the crops, and the start of each crop in it. The parts of
+        the field which are not in any crop are filled with zeros
+    """
+    crop_shape = np.array(crops.shape[1:])
+    start = offsets.min(axis=0)
+    end = (offsets + crop_shape).max(axis=0)
+    offsets = offsets - start
+
+    field = np.zeros(end - start, dtype=crops.dtype)
+    for crop, offset in zip(crops, offsets):
+        field[_crop_slices(offset, crop_shape)] = crop
+    return field, offsets
+
+
+class CropStack:
+    """Stack of crops of a field which are only copied out of the field when they are indexed
+
+    Args:
+        field: The field the crops are cut from. A numpy array or torch tensor
+        offsets: The start of each crop in the field, with shape [num_crops, field.ndim]
+        crop_shape: The shape of one crop
+    """
+
+    def __init__(self, field, offsets: np.ndarray, crop_shape: np.ndarray):
+        """Stack of crops of a field which are only copied out of the field when indexed"""
+        self.field = field
+        self.offsets = np.asarray(offsets)
+        self.crop_shape = np.asarray(crop_shape)
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        """The shape of the stacked crops"""
+        return (len(self.offsets), *(int(size) for size in self.crop_shape))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.field[_crop_slices(self.offsets[idx], self.crop_shape)]
+        return self._stack(self.offsets[idx])
+
+    def _stack(self, offsets: np.ndarray):
+        crops = [self.field[_crop_slices(offset, self.crop_shape)] for offset in offsets]
+        return torch.stack(crops) if isinstance(self.field, torch.Tensor) else np.stack(crops)
+
+    def stack(self):
+        """Copy all of the crops out of the field and stack them"""
+        return self._stack(self.offsets)
+
+
+def deduplicate_concurrent_sample(sample: NumpySample, crop_offsets: dict) -> NumpySample:
+    """Replace the stacked image crops of a concurrent sample with their deduplicated storage
+
+    Args:
+        sample: The concurrent sample
+        crop_offsets: The start of each crop in the field it was cut from, keyed by the flattened
+            key of the stacked crops. e.g. "nwp/ukv/nwp" or "satellite_actual"
+    """
+    flat_sample = flatten_sample(sample)
+    for key, offsets in crop_offsets.items():
+        crops = flat_sample.pop(key)
+        field, offsets = deduplicate_crops(crops, offsets)
+        flat_sample[f"{key}{_FIELD_SUFFIX}"] = field
+        flat_sample[f"{key}{_OFFSETS_SUFFIX}"] = offsets
+        flat_sample[f"{key}{_SHAPE_SUFFIX}"] = np.array(crops.shape[1:])
+    return unflatten_sample(flat_sample)
+
+
+def rebuild_concurrent_sample(sample: NumpySample, lazy: bool = False) -> NumpySample:
+    """Rebuild the stacked image crops of a concurrent sample in the deduplicated storage
+
+    Samples which are not deduplicated are returned unchanged.
+
+    Args:
+        sample: The concurrent sample
+        lazy: Whether to return each stack of crops as a `CropStack`, which only copies the crops
+            out of the field when they are indexed. Otherwise they are stacked into arrays
+    """
+    flat_sample = flatten_sample(sample)
+    field_keys = [k for k in flat_sample if k.endswith(_FIELD_SUFFIX)]
+    if len(field_keys) == 0:
+        return sample
+
+    for field_key in field_keys:
+        key = field_key.removesuffix(_FIELD_SUFFIX)
+        crops = CropStack(
+            flat_sample.pop(field_key),
+            flat_sample.pop(f"{key}{_OFFSETS_SUFFIX}"),
+            flat_sample.pop(f"{key}{_SHAPE_SUFFIX}"),
+        )
+        flat_sample[key] = crops if lazy else crops.stack()
+    return unflatten_sample(flat_sample)
+
+
+def load_concurrent_sample(path: str, lazy: bool = False) -> NumpySample:
+    """Load a concurrent sample saved by `scripts/save_concurrent_samples.py` in either storage
+
+    Args:
+        path: Path to the saved sample
+        lazy: Whether to rebuild the crops of deduplicated samples lazily. See
+            `rebuild_concurrent_sample()`
+    """
+    # The samples hold numpy arrays of channel names, which are not loaded with `weights_only`
+    return rebuild_concurrent_sample(torch.load(path, weights_only=False), lazy=lazy)
+
+
+class ConcurrentSamplesDataset(Dataset):
+    """Dataset of concurrent samples saved by `scripts/save_concurrent_samples.py`
+
+    Args:
+        sample_dir: Path to the directory of concurrent samples
+        lazy: Whether to rebuild the crops of deduplicated samples lazily. See
+            `rebuild_concurrent_sample()`
+    """
+
+    def __init__(self, sample_dir: str, lazy: bool = False):
+        """Dataset of concurrent samples saved by `scripts/save_concurrent_samples.py`"""
+        self.sample_paths = get_sample_paths(sample_dir)
+        self.lazy = lazy
+
+    def __len__(self):
+        return len(self.sample_paths)
+
+    def __getitem__(self, idx):
+        return load_concurrent_sample(self.sample_paths[idx], lazy=self.lazy)
+
+
+class DeduplicatedConcurrentDataset(Dataset):
+    """Wrapper around a `PVNetUKConcurrentDataset` which returns deduplicated samples
+
+    The samples are made in the same way as by the wrapped dataset, and the position of each GSP's
+    NWP and satellite crops in the time-sliced data is recorded as they are cut.
+
+    Args:
+        dataset: The concurrent dataset to wrap
+    """
+
+    def __init__(self, dataset: PVNetUKConcurrentDataset):
+        """Wrapper around a `PVNetUKConcurrentDataset` which returns deduplicated samples"""
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        t0 = self.dataset.valid_t0_times[idx]
+        config = self.dataset.config
+
+        time_sliced = compute(slice_datasets_by_time(self.dataset.datasets_dict, t0, config))
+
+        # The keys of the stacked crops in the sample and of the time-sliced data they are cut from
+        image_keys = {
+            f"nwp/{nwp_key}/nwp": ("nwp", nwp_key) for nwp_key in time_sliced.get("nwp", {})
+        }
+        if "sat" in time_sliced:
+            image_keys["satellite_actual"] = ("sat",)
+
+        gsp_samples = []
+        crop_offsets = {key: [] for key in image_keys}
+        for location in self.dataset.locations:
+            gsp_sample_dict = slice_datasets_by_space(time_sliced, location, config)
+            for key, data_key in image_keys.items():
+                field, crop = time_sliced, gsp_sample_dict
+                for k in data_key:
+                    field, crop = field[k], crop[k]
+                crop_offsets[key].append(get_crop_offsets(field, crop))
+            gsp_samples.append(process_and_combine_datasets(gsp_sample_dict, config, t0, location))
+
+        sample = stack_np_samples_into_batch(gsp_samples)
+        crop_offsets = {key: np.stack(offsets) for key, offsets in crop_offsets.items()}
+        return deduplicate_concurrent_sample(sample, crop_offsets)
@@ -0,0 +1,162 @@
+"""Reduced precision storage of the image-like arrays in premade samples
+
+The NWP and satellite arrays make up almost all of the size of a sample, but the models cast them
+to float32 anyway. These arrays can be stored with one of the following image encodings:
+
+- float32: Stored at full precision
+- float16: Stored as half precision floats
+- bfloat16: Stored as the top 16 bits of each float32 value. numpy has no bfloat16 type, so these
+    are held in uint16 arrays
+- uint8 / uint16: Quantised using a scale and offset for each channel of each sample. The scale
+    and offset are stored in the sample under the keys `<key>_scale` and `<key>_offset`. The
+    largest integer is reserved for NaN values, so missing data is still NaN when decoded
+
+The image encoding of a sample directory is recorded in its format description, and the premade
+datasets decode the arrays back to float32 as they are loaded.
+"""
+
+import numpy as np
+from ocf_data_sampler.sample.base import NumpyBatch, NumpySample
+
+from pvnet.data.utils import flatten_sample, unflatten_sample
+
+IMAGE_ENCODINGS = ["float32", "float16", "bfloat16", "uint8", "uint16"]
+
+_QUANTISED_DTYPES = {"uint8": np.uint8, "uint16": np.uint16}
+
+
+def is_image_key(key: str) -> bool:
+    """Check if a flattened sample key is for image-like data with shape (time, channel, y, x)"""
+    return key == "satellite_actual" or (key.startswith("nwp/") and key.endswith("/nwp"))
+
+
+def get_image_encoding(sample_format: dict | None) -> str:
+    """Get the image encoding from the format description of a sample directory
+
+    Args:
+        sample_format: The format description, or None for directories without one
+    """
+    if sample_format is None:
+        return "float32"
+    return sample_format.get("image_encoding", "float32")
+
+
+def check_image_encoding(image_encoding: str) -> None:
+    """Raise an error if the image encoding is not known"""
+    if image_encoding not in IMAGE_ENCODINGS:
+        raise ValueError(
+            f"Unknown image encoding: {image_encoding}. Must be one of {IMAGE_ENCODINGS}"
+        )
+
+
+def _channel_shape(params: np.ndarray, ndim: int, channel_axis: int) -> tuple:
+    """The shape to reshape per-channel parameters to so they broadcast against the image"""
+    num_channels = params.shape[-1]
+    leading = params.shape[:-1]
+    return (
+        leading
+        + (1,) * (channel_axis - len(leading))
+        + (num_channels,)
+        + (1,) * (ndim - channel_axis - 1)
+    )
+
+
+def _encode_array(x: np.ndarray, image_encoding: str) -> dict[str, np.ndarray]:
+    """Encode an image array with shape (time, channel, y, x)"""
+    x = np.asarray(x, dtype=np.float32)
+
+    if image_encoding == "float16":
+        return {"": x.astype(np.float16)}
+
+    elif image_encoding == "bfloat16":
+        # Round to the nearest bfloat16, with ties to even
+        bits = x.view(np.uint32)
+        rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+        encoded = ((bits + rounding) >> 16).astype(np.uint16)
+        # Rounding can carry the payload of a NaN into the exponent and make it inf, so NaNs are
+        # truncated and kept quiet instead
+        nan_mask = np.isnan(x)
+        encoded[nan_mask] = ((bits[nan_mask] >> 16) | np.uint32(0x0040)).astype(np.uint16)
+        return {"": encoded}
+
+    else:
+        dtype = _QUANTISED_DTYPES[image_encoding]
+        # The largest integer is reserved for NaNs
+        nan_code = np.iinfo(dtype).max
+        qmax = nan_code - 1
+
+        reduce_axes = tuple(i for i in range(x.ndim) if i != 1)
+        # fmin and fmax ignore NaNs. Channels which are all NaN get a NaN offset, which is set to
+        # zero since all of their values are stored as the NaN code anyway
+        offset = np.fmin.reduce(x, axis=reduce_axes)
+        scale = (np.fmax.reduce(x, axis=reduce_axes) - offset) / qmax
+        offset = np.nan_to_num(offset, nan=0)
+        # Constant and all NaN channels would otherwise divide by zero
+        scale[~(scale > 0)] = 1
+
+        shape = _channel_shape(scale, x.ndim, channel_axis=1)
+        q = np.round((x - offset.reshape(shape)) / scale.reshape(shape))
+        return {
+            "": np.nan_to_num(q, nan=nan_code).astype(dtype),
+            "_scale": scale.astype(np.float32),
+            "_offset": offset.astype(np.float32),
+        }
+
+
+def encode_sample(sample: NumpySample, image_encoding: str) -> NumpySample:
+    """Encode the image-like arrays of a numpy sample
+
+    Args:
+        sample: The numpy sample
+        image_encoding: The encoding to use
+    """
+    check_image_encoding(image_encoding)
+    if image_encoding == "float32":
+        return sample
+
+    flat_sample = {}
+    for key, value in flatten_sample(sample).items():
+        if is_image_key(key):
+            for suffix, array in _encode_array(value, image_encoding).items():
+                flat_sample[f"{key}{suffix}"] = array
+        else:
+            flat_sample[key] = value
+    return unflatten_sample(flat_sample)
+
+
+def decode_sample(
+    sample: NumpySample | NumpyBatch,
+    image_encoding: str,
+    batched: bool = False,
+) -> NumpySample | NumpyBatch:
+    """Decode the image-like arrays of a numpy sample or batch back to float32
+
+    Args:
+        sample: The encoded numpy sample or batch
+        image_encoding: The encoding the sample was stored with
+        batched: Whether the input is a batch of samples stacked along a new first axis
+    """
+    if image_encoding == "float32":
+        return sample
+
+    flat_sample = flatten_sample(sample)
+    channel_axis = 2 if batched else 1
+
+    for key in [k for k in flat_sample if is_image_key(k)]:
+        x = flat_sample[key]
+
+        if image_encoding == "float16":
+            flat_sample[key] = x.astype(np.float32)
+
+        elif image_encoding == "bfloat16":
+            flat_sample[key] = (x.astype(np.uint32) << 16).view(np.float32)
+
+        else:
+            scale = flat_sample.pop(f"{key}_scale")
+            offset = flat_sample.pop(f"{key}_offset")
+            shape = _channel_shape(scale, x.ndim, channel_axis)
+            decoded = x.astype(np.float32) * scale.reshape(shape) + offset.reshape(shape)
+            decoded[x == np.iinfo(x.dtype).max] = np.nan
+            flat_sample[key] = decoded
+
+    return unflatten_sample(flat_sample)
@@ -0,0 +1,326 @@
+"""Sample generation shared between many processes or machines
+
+Generating a large sample directory can be split between independent processes, on one machine or
+on many machines which share a filesystem. Each process runs the same command. The samples to save
+are split into fixed blocks, and a `WorkLedger` in the sample directory records which blocks have
+been claimed and which are finished, so each block is generated by exactly one process. No
+coordinator is needed. A claim is made by creating a file which must not already exist, which is
+atomic on local filesystems and on NFS.
+
+The block order is drawn from a fixed seed, so every process agrees on which samples make up each
+block and what they are numbered. Each block writes its rows of the manifest to its own file. The
+process which finishes the last block joins these into the manifest of the sample directory:
+
+    sample_dir/
+        .ledger/
+            claims/
+                block_000000
+                ...
+            done/
+                block_000000
+                ...
+            manifests/
+                block_000000.csv
+                ...
+            tmp_<process token>/
+        format.json
+        manifest.csv
+        00000000.pt
+        ...
+
+A process which is stopped leaves its block claimed but not finished. A claim which has not been
+touched for `stale_seconds` is taken over by the next process to look for work, so running the
+command again finishes the directory. A process which is only slow can also lose its claim this
+way. Each process writes its samples to its own temporary directory and moves each one into place
+once it is complete, so two processes saving the same sample never leave a partly written file.
+Each process also writes the manifest rows of a block to its own temporary file, and only commits
+them if it still holds the claim once the block is finished, so a block taken over from a live
+process is still only in the manifest once.
+"""
+
+import csv
+import os
+import shutil
+import socket
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+from torch.utils.data import DataLoader, Dataset, Sampler
+from tqdm import tqdm
+
+from pvnet.data.manifest import MANIFEST_FILENAME, SampleManifestWriter
+from pvnet.data.utils import IndexedDataset
+
+LEDGER_DIRNAME = ".ledger"
+
+
+class WorkLedger:
+    """Record of which blocks of work have been claimed and finished, shared through files
+
+    Args:
+        ledger_dir: The directory to keep the ledger in
+        num_blocks: The number of blocks of work
+        stale_seconds: A claim which has not been touched for this long can be taken over
+    """
+
+    def __init__(self, ledger_dir: str, num_blocks: int, stale_seconds: float = 3600):
+        """Record of which blocks of work have been claimed and finished, shared through files"""
+        self.ledger_dir = ledger_dir
+        self.num_blocks = num_blocks
+        self.stale_seconds = stale_seconds
+        # Identifies the claims made by this ledger
+        self.token = uuid.uuid4().hex
+        for subdir in ["claims", "done"]:
+            os.makedirs(f"{ledger_dir}/{subdir}", exist_ok=True)
+
+    def _get_path(self, subdir: str, block: int) -> str:
+        return f"{self.ledger_dir}/{subdir}/block_{block:06}"
+
+    def is_done(self, block: int) -> bool:
+        """Check if a block has been finished"""
+        return os.path.exists(self._get_path("done", block))
+
+    def num_done(self) -> int:
+        """Count the finished blocks"""
+        return len(os.listdir(f"{self.ledger_dir}/done"))
+
+    def _try_claim(self, block: int) -> bool:
+        try:
+            fd = os.open(self._get_path("claims", block), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{socket.gethostname()}:{os.getpid()}:{self.token}\n")
+        return True
+
+    def _take_over_stale_claim(self, block: int) -> bool:
+        """Remove the claim on a block if it is stale, and claim the block"""
+        path = self._get_path("claims", block)
+        try:
+            if time.time() - os.path.getmtime(path) < self.stale_seconds:
+                return False
+            # Only one process can rename the stale claim away
+            os.rename(path, f"{path}.stale.{uuid.uuid4().hex}")
+        except FileNotFoundError:
+            pass
+        return self._try_claim(block)
+
+    def claim(self) -> int | None:
+        """Claim the first block which has not been claimed or finished
+
+        Returns:
+            The claimed block, or None if there are no blocks left to claim
+        """
+        for block in range(self.num_blocks):
+            if self.is_done(block):
+                continue
+            if self._try_claim(block) or self._take_over_stale_claim(block):
+                # The block may have been finished since it was checked
+                if not self.is_done(block):
+                    return block
+        return None
+
+    def owns(self, block: int) -> bool:
+        """Check if this ledger still holds the claim on a block"""
+        try:
+            with open(self._get_path("claims", block)) as f:
+                return f.read().strip().endswith(f":{self.token}")
+        except FileNotFoundError:
+            return False
+
+    def touch(self, block: int) -> None:
+        """Mark that the process which claimed a block is still working on it"""
+        try:
+            os.utime(self._get_path("claims", block))
+        except FileNotFoundError:
+            # The claim is being taken over
+            pass
+
+    def finish(self, block: int) -> None:
+        """Mark a block as finished"""
+        with open(self._get_path("done", block), "w"):
+            pass
+
+
+class LedgerSampler(Sampler):
+    """Sampler which claims blocks from a ledger as it needs them and yields their indices
+
+    Args:
+        ledger: The ledger to claim the blocks from
+        blocks: The dataset indices of each block
+    """
+
+    def __init__(self, ledger: WorkLedger, blocks: list[np.ndarray]):
+        """Sampler which claims blocks from a ledger as it needs them"""
+        self.ledger = ledger
+        self.blocks = blocks
+        # The block and position of each index yielded, until its sample is saved
+        self.positions: dict[int, tuple[int, int]] = {}
+
+    def __iter__(self):
+        block_size = len(self.blocks[0]) if self.blocks else 0
+        while (block := self.ledger.claim()) is not None:
+            for i, idx in enumerate(self.blocks[block]):
+                self.positions[int(idx)] = (block, block * block_size + i)
+                yield int(idx)
+
+
+def get_blocks(num_indices: int, num_samples: int, block_size: int, seed: int) -> list[np.ndarray]:
+    """Choose the dataset indices to save and split them into blocks
+
+    Every process must call this with the same arguments, so they agree on the blocks.
+
+    Args:
+        num_indices: The number of samples in the dataset
+        num_samples: The number of samples to save
+        block_size: The number of samples in each block
+        seed: The seed used to choose and order the samples
+    """
+    order = np.random.default_rng(seed).permutation(num_indices)[:num_samples]
+    return [order[i : i + block_size] for i in range(0, len(order), block_size)]
+
+
+def _join_manifests(save_dir: str, num_blocks: int, shuffle_seed: int | None = None) -> None:
+    """Join the manifests of all blocks into the manifest of the sample directory
+
+    If `shuffle_seed` is set, the rows are shuffled with it, so every process writes the same file.
+    Only the first row for each sample path is kept.
+    """
+    manifests_dir = f"{save_dir}/{LEDGER_DIRNAME}/manifests"
+    rows = []
+    paths = set()
+    for block in range(num_blocks):
+        with open(f"{manifests_dir}/block_{block:06}.csv", newline="") as f:
+            header = f.readline()
+            for row in f.readlines():
+                path = next(csv.reader([row]))[0]
+                if path not in paths:
+                    paths.add(path)
+                    rows.append(row)
+    if shuffle_seed is not None:
+        rows = [rows[i] for i in np.random.default_rng(shuffle_seed).permutation(len(rows))]
+
+    tmp_path = f"{save_dir}/{MANIFEST_FILENAME}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", newline="") as out:
+        out.write(header)
+        out.writelines(rows)
+    # All processes which join the manifests write the same file
+    os.replace(tmp_path, f"{save_dir}/{MANIFEST_FILENAME}")
+
+
+def save_samples_with_ledger(
+    dataset: Dataset,
+    save_dir: str,
+    num_samples: int,
+    dataloader_kwargs: dict,
+    save_func: Callable,
+    get_manifest_row: Callable,
+    block_size: int = 256,
+    seed: int = 0,
+    num_writers: int = 4,
+    stale_seconds: float = 3600,
+    order: np.ndarray | None = None,
+) -> None:
+    """Save samples from a dataset, sharing the work with other processes through a ledger
+
+    Args:
+        dataset: The dataset to save samples from. Must be the same in every process
+        save_dir: The directory to save the samples to. Shared by every process
+        num_samples: The total number of samples to save, across all processes
+        dataloader_kwargs: Keyword arguments for the dataloader. The sampler is replaced
+        save_func: Function which saves a sample given the sample, its number and the directory
+            to save it in, and returns the path of the saved file
+        get_manifest_row: Function which returns the manifest columns other than the path and
+            size of a sample, given its index in the dataset
+        block_size: The number of samples in each block of work
+        seed: The seed used to choose and order the samples. Must be the same in every process
+        num_writers: The number of threads writing samples to disk
+        stale_seconds: A block claimed by a process which has not saved a sample for this long is
+            taken over by another process
+        order: The dataset indices to save, in the order to generate them. Must be the same in
+            every process. If set, the samples are not chosen from the seed, and the manifest is
+            shuffled with the seed once all blocks are finished. If None, the samples are chosen
+            and ordered at random
+    """
+    if order is None:
+        blocks = get_blocks(len(dataset), num_samples, block_size, seed)
+    else:
+        order = np.asarray(order)[:num_samples]
+        blocks = [order[i : i + block_size] for i in range(0, len(order), block_size)]
+    ledger_dir = f"{save_dir}/{LEDGER_DIRNAME}"
+    ledger = WorkLedger(ledger_dir, len(blocks), stale_seconds=stale_seconds)
+    manifests_dir = f"{ledger_dir}/manifests"
+    os.makedirs(manifests_dir, exist_ok=True)
+    # On the same filesystem as the sample directory, so the samples can be moved atomically
+    tmp_dir = f"{ledger_dir}/tmp_{ledger.token}"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    def save_sample(sample, sample_num):
+        tmp_filename = save_func(sample, sample_num, save_dir=tmp_dir)
+        filename = f"{save_dir}/{os.path.basename(tmp_filename)}"
+        os.replace(tmp_filename, filename)
+        return filename
+
+    sampler = LedgerSampler(ledger, blocks)
+    dataloader_kwargs = dict(dataloader_kwargs, shuffle=False, sampler=sampler)
+    dataloader = DataLoader(IndexedDataset(dataset), **dataloader_kwargs)
+
+    num_done = sum(len(blocks[b]) for b in range(len(blocks)) if ledger.is_done(b))
+    pbar = tqdm(total=sum(len(b) for b in blocks), initial=num_done, desc="Written")
+
+    # The manifest writer and number of samples left to save of each block in progress
+    manifests: dict[int, SampleManifestWriter] = {}
+    num_left: dict[int, int] = {}
+    pending_writes = deque()
+
+    def get_tmp_manifest_path(block):
+        return f"{manifests_dir}/tmp_{block:06}_{ledger.token}"
+
+    def finish_oldest_write():
+        idx, block, future = pending_writes.popleft()
+        filename = future.result()
+        if block not in manifests:
+            manifests[block] = SampleManifestWriter(
+                manifests_dir, filename=os.path.basename(get_tmp_manifest_path(block))
+            )
+            num_left[block] = len(blocks[block])
+
+        manifests[block].write(
+            path=os.path.basename(filename),
+            nbytes=os.path.getsize(filename),
+            **get_manifest_row(idx),
+        )
+        ledger.touch(block)
+        pbar.update()
+
+        num_left[block] -= 1
+        if num_left[block] == 0:
+            manifests.pop(block).close()
+            if ledger.owns(block):
+                os.replace(get_tmp_manifest_path(block), f"{manifests_dir}/block_{block:06}.csv")
+                ledger.finish(block)
+            else:
+                # The block was taken over by another process, which commits its own rows
+                os.remove(get_tmp_manifest_path(block))
+
+    with ThreadPoolExecutor(num_writers) as writers:
+        for idx, sample in dataloader:
+            block, sample_num = sampler.positions.pop(int(idx))
+            pending_writes.append((idx, block, writers.submit(save_sample, sample, sample_num)))
+            while pending_writes and (
+                pending_writes[0][2].done() or len(pending_writes) > 2 * num_writers
+            ):
+                finish_oldest_write()
+
+        while pending_writes:
+            finish_oldest_write()
+    pbar.close()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # The process which finishes the last block joins the manifests
+    if len(blocks) > 0 and ledger.num_done() == len(blocks):
+        _join_manifests(save_dir, len(blocks), shuffle_seed=None if order is None else seed)
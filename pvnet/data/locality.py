@@ -0,0 +1,130 @@
+"""Generating streamed samples in an order which reuses the data read from the zarr stores
+
+A streamed sample is cut from the NWP and satellite stores around its init-time and location. When
+samples are generated in a random order, each one reads and decompresses its own zarr chunks, even
+though the samples for every location at one init-time are cut from the same chunks. Grouping the
+samples by init-time lets those chunks be read once and shared:
+
+- `get_time_blocks()` sorts the samples to generate by init-time and splits them into blocks of
+    samples with the same init-time
+- `TimeCachedDataset` loads the data for one init-time over the whole domain once, like
+    `PVNetUKConcurrentDataset`, and cuts the samples for each location from it in memory
+
+Each block is generated by a single dataloader worker, so the data for an init-time is loaded at
+most once per block rather than once per sample. The samples are then saved in time order, and the
+manifest can be shuffled afterwards so the training loader does not see them in that order.
+"""
+
+import numpy as np
+import pandas as pd
+from ocf_data_sampler.torch_datasets.datasets.pvnet_uk import (
+    PVNetUKRegionalDataset,
+    compute,
+    process_and_combine_datasets,
+    slice_datasets_by_space,
+    slice_datasets_by_time,
+)
+from ocf_data_sampler.torch_datasets.datasets.site import SitesDataset
+from torch.utils.data import Dataset, default_convert
+
+from pvnet.data.utils import get_all_sample_coords
+
+
+def sort_indices_by_time(dataset: Dataset, indices: np.ndarray) -> np.ndarray:
+    """Sort the indices of a streamed dataset by init-time, and then by location ID
+
+    Args:
+        dataset: A `PVNetUKRegionalDataset` or `SitesDataset`
+        indices: The dataset indices to sort
+    """
+    indices = np.asarray(indices)
+    coords = get_all_sample_coords(dataset).iloc[indices]
+    order = np.lexsort((coords["target_id"].values, coords["t0"].values))
+    return indices[order]
+
+
+def get_time_blocks(dataset: Dataset, indices: np.ndarray, block_size: int) -> list[list[int]]:
+    """Sort the indices of a streamed dataset by init-time and split them into blocks
+
+    Each block only holds samples with the same init-time. The samples for one init-time are split
+    into several blocks if there are more than `block_size` of them, so they can be shared between
+    dataloader workers.
+
+    Args:
+        dataset: A `PVNetUKRegionalDataset` or `SitesDataset`
+        indices: The dataset indices to generate
+        block_size: The maximum number of samples in a block
+    """
+    if block_size < 1:
+        raise ValueError(f"`block_size` must be positive - got {block_size}")
+
+    indices = sort_indices_by_time(dataset, indices)
+    t0 = pd.DatetimeIndex(get_all_sample_coords(dataset)["t0"].values[indices])
+
+    # Start a new block at each new init-time, and after every `block_size` samples within it
+    run_starts = np.flatnonzero(np.r_[True, t0[1:] != t0[:-1]])
+    run_ends = np.r_[run_starts[1:], len(indices)]
+    return [
+        indices[start : min(start + block_size, end)].tolist()
+        for run_start, end in zip(run_starts, run_ends)
+        for start in range(run_start, end, block_size)
+    ]
+
+
+def collate_sample_list(samples: list) -> list:
+    """Collate function which keeps a block of samples as a list
+
+    Each sample is converted to tensors in the same way as when the dataloader is not batching.
+    """
+    return [default_convert(sample) for sample in samples]
+
+
+class TimeCachedDataset(Dataset):
+    """Wrapper around a streamed dataset which loads the data for each init-time once
+
+    The data for the init-time of the last sample is kept in memory, and the next sample is cut
+    from it if it has the same init-time. The samples are the same as those of the wrapped dataset.
+
+    Args:
+        dataset: A `PVNetUKRegionalDataset` or `SitesDataset`
+    """
+
+    def __init__(self, dataset: Dataset):
+        """Wrapper around a streamed dataset which loads the data for each init-time once"""
+        if not isinstance(dataset, (PVNetUKRegionalDataset, SitesDataset)):
+            raise ValueError(f"Cannot cache the data by init-time for dataset {type(dataset)}")
+        self.dataset = dataset
+        self._t0 = None
+        self._time_sliced = None
+
+    def __getstate__(self):
+        # Do not copy the loaded data to the dataloader workers
+        return dict(self.__dict__, _t0=None, _time_sliced=None)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _get_coords(self, idx):
+        if isinstance(self.dataset, PVNetUKRegionalDataset):
+            t_index, loc_index = self.dataset.index_pairs[idx]
+            return self.dataset.valid_t0_times[t_index], self.dataset.locations[loc_index]
+        else:
+            t0, site_id = self.dataset.valid_t0_and_site_ids.iloc[idx]
+            return t0, self.dataset.get_location_from_site_id(site_id)
+
+    def __getitem__(self, idx):
+        t0, location = self._get_coords(idx)
+        config = self.dataset.config
+
+        if t0 != self._t0:
+            # Free the data for the last init-time before loading the next
+            self._t0, self._time_sliced = None, None
+            time_sliced = slice_datasets_by_time(self.dataset.datasets_dict, t0, config)
+            self._time_sliced = compute(time_sliced)
+            self._t0 = t0
+
+        sample_dict = slice_datasets_by_space(self._time_sliced, location, config)
+        if isinstance(self.dataset, PVNetUKRegionalDataset):
+            return process_and_combine_datasets(sample_dict, config, t0, location)
+        else:
+            return self.dataset.process_and_combine_site_sample_dict(sample_dict).compute()
@@ -0,0 +1,295 @@
+"""Manifests of premade samples
+
+A manifest is a CSV file stored alongside premade samples with one row per sample. It lets the
+datasets find all samples with a single file read rather than listing the sample directory, which
+can be very slow on network and object-store backed disks. It also allows the samples to be
+filtered by init-time and target ID without opening them. The columns are:
+
+- path: The path of the file holding the sample, relative to the sample directory
+- nbytes: The size of the sample in bytes
+- t0: The init-time of the sample
+- target_id: The ID of the GSP or site the sample is for
+- sources: The data sources present in the sample, separated by ";". e.g. "gsp;nwp/ukv;satellite"
+
+Packed sample directories use the manifest as their index and have an extra `offset` column with
+the position of each sample inside its shard file.
+"""
+
+import csv
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+from ocf_data_sampler.config import Configuration
+from ocf_data_sampler.sample.base import NumpySample, SampleBase
+from tqdm import tqdm
+
+from pvnet.data.remote import get_filesystem, is_remote_path
+from pvnet.data.utils import FORMAT_FILENAME
+
+MANIFEST_FILENAME = "manifest.csv"
+
+MANIFEST_COLUMNS = ["path", "nbytes", "t0", "target_id", "sources"]
+
+# Keys of the numpy samples which hold each data source
+_SOURCE_KEYS = {"gsp": "gsp", "satellite_actual": "satellite", "site": "site"}
+
+
+def get_config_sources(config: Configuration) -> list[str]:
+    """Get the data sources which samples created with a configuration will hold
+
+    Args:
+        config: The ocf-data-sampler configuration
+    """
+    input_data = config.input_data
+    sources = [name for name in ["gsp", "satellite", "site"] if getattr(input_data, name)]
+    if input_data.nwp is not None:
+        sources += [f"nwp/{nwp_key}" for nwp_key in input_data.nwp]
+    return sorted(sources)
+
+
+def get_sample_sources(sample: NumpySample) -> list[str]:
+    """Get the data sources present in a numpy sample
+
+    Args:
+        sample: A numpy sample for a GSP or site
+    """
+    sources = [source for key, source in _SOURCE_KEYS.items() if key in sample]
+    if "nwp" in sample:
+        sources += [f"nwp/{nwp_key}" for nwp_key in sample["nwp"]]
+    return sorted(sources)
+
+
+def get_sample_metadata(sample: NumpySample) -> dict:
+    """Get the init-time, target ID and data sources of a numpy sample
+
+    Args:
+        sample: A numpy sample for a GSP or site
+
+    Returns:
+        Dictionary with keys "t0", "target_id" and "sources". The values of "t0" and "target_id"
+        are None if they cannot be found
+    """
+    metadata = dict(t0=None, target_id=None, sources=get_sample_sources(sample))
+
+    for target_key in ["gsp", "site"]:
+        if f"{target_key}_id" in sample:
+            target_id = np.asarray(sample[f"{target_key}_id"])
+            # Concurrent samples hold many targets
+            if target_id.size == 1:
+                metadata["target_id"] = int(target_id.item())
+
+        if f"{target_key}_t0_idx" in sample and f"{target_key}_time_utc" in sample:
+            t0_idx = int(sample[f"{target_key}_t0_idx"])
+            times = np.asarray(sample[f"{target_key}_time_utc"])
+            metadata["t0"] = pd.Timestamp(times[..., t0_idx].flat[0])
+
+    return metadata
+
+
+class SampleManifestWriter:
+    """Append rows to the manifest of a sample directory
+
+    Each row is flushed as soon as it is written, so the manifest stays consistent with the samples
+    on disk if writing is interrupted.
+
+    Args:
+        sample_dir: Path to the directory of premade samples
+        columns: The columns of the manifest
+        filename: The name of the manifest file
+    """
+
+    def __init__(
+        self,
+        sample_dir: str,
+        columns: list[str] = MANIFEST_COLUMNS,
+        filename: str = MANIFEST_FILENAME,
+    ):
+        """Append rows to the manifest of a sample directory"""
+        path = f"{sample_dir}/{filename}"
+        is_new = not os.path.isfile(path)
+
+        self.columns = columns
+        self._file = open(path, "a", newline="")
+        self._writer = csv.writer(self._file)
+
+        if is_new:
+            self._writer.writerow(columns)
+            self._file.flush()
+
+    def write(self, **row) -> None:
+        """Write a row to the manifest
+
+        Args:
+            **row: The value of each column. Missing columns are left empty
+        """
+        self._writer.writerow([_format_value(row.get(c)) for c in self.columns])
+        self._file.flush()
+
+    def close(self) -> None:
+        """Close the manifest file"""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _format_value(value):
+    if value is None:
+        return ""
+    elif isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    elif isinstance(value, list):
+        return ";".join(value)
+    return value
+
+
+def load_manifest(sample_dir: str) -> pd.DataFrame | None:
+    """Load the manifest of a sample directory
+
+    Args:
+        sample_dir: Path to the directory of premade samples
+
+    Returns:
+        The manifest, or None if the sample directory has no manifest
+    """
+    path = f"{sample_dir}/{MANIFEST_FILENAME}"
+    if is_remote_path(path):
+        if not get_filesystem(path).isfile(path):
+            return None
+    elif not os.path.isfile(path):
+        return None
+
+    manifest = pd.read_csv(path, keep_default_na=False, na_values={"t0": "", "target_id": ""})
+    manifest["t0"] = pd.to_datetime(manifest["t0"])
+    return manifest
+
+
+def shuffle_manifest(sample_dir: str, seed: int | None = None) -> None:
+    """Shuffle the rows of the manifest of a sample directory
+
+    The datasets and `pack_samples()` read the samples in the order of the manifest, so this
+    shuffles a sample directory without moving any samples. The manifest is replaced atomically.
+
+    Args:
+        sample_dir: Path to the directory of premade samples
+        seed: The seed used to shuffle the rows
+    """
+    path = f"{sample_dir}/{MANIFEST_FILENAME}"
+    with open(path, newline="") as f:
+        header = f.readline()
+        rows = f.readlines()
+
+    order = np.random.default_rng(seed).permutation(len(rows))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        f.write(header)
+        f.writelines(rows[i] for i in order)
+    os.replace(tmp_path, path)
+
+
+def filter_manifest(
+    manifest: pd.DataFrame,
+    start_time: str | None = None,
+    end_time: str | None = None,
+    target_ids: list[int] | None = None,
+) -> pd.DataFrame:
+    """Select the manifest rows of the samples inside a time period and for a set of targets
+
+    The index of the manifest is kept, so it still gives the position of each selected sample.
+
+    Args:
+        manifest: The manifest of a sample directory
+        start_time: If set, only keep samples with init-times at or after this time
+        end_time: If set, only keep samples with init-times at or before this time
+        target_ids: If set, only keep samples for these GSP or site IDs
+    """
+    mask = np.ones(len(manifest), dtype=bool)
+    if start_time is not None:
+        mask &= (manifest["t0"] >= pd.Timestamp(start_time)).values
+    if end_time is not None:
+        mask &= (manifest["t0"] <= pd.Timestamp(end_time)).values
+    if target_ids is not None:
+        mask &= manifest["target_id"].isin(target_ids).values
+    return manifest[mask]
+
+
+def load_filtered_manifest(
+    sample_dir: str,
+    start_time: str | None = None,
+    end_time: str | None = None,
+    target_ids: list[int] | None = None,
+) -> pd.DataFrame | None:
+    """Load the manifest of a sample directory and filter it
+
+    Args:
+        sample_dir: Path to the directory of premade samples
+        start_time: If set, only keep samples with init-times at or after this time
+        end_time: If set, only keep samples with init-times at or before this time
+        target_ids: If set, only keep samples for these GSP or site IDs
+
+    Returns:
+        The filtered manifest, or None if the sample directory has no manifest and no filters are
+        set
+    """
+    manifest = load_manifest(sample_dir)
+    filters_set = any(v is not None for v in [start_time, end_time, target_ids])
+
+    if manifest is None:
+        if filters_set:
+            raise ValueError(
+                f"Cannot filter samples in {sample_dir} since it has no manifest. One can be "
+                "created using `pvnet.data.manifest.create_manifest()`"
+            )
+        return None
+
+    return filter_manifest(manifest, start_time, end_time, target_ids)
+
+
+def get_sample_paths(sample_dir: str) -> list[str]:
+    """Get the paths of all samples in a directory of one-sample-per-file samples
+
+    The paths are read from the manifest if the directory has one. Otherwise the directory is
+    listed and the paths are sorted.
+
+    Args:
+        sample_dir: Path to the directory of pre-saved samples
+    """
+    manifest = load_manifest(sample_dir)
+    if manifest is None:
+        if is_remote_path(sample_dir):
+            fs = get_filesystem(sample_dir)
+            paths = [fs.unstrip_protocol(p) for p in fs.glob(f"{sample_dir}/*")]
+        else:
+            paths = glob(f"{sample_dir}/*")
+        metadata_files = {MANIFEST_FILENAME, FORMAT_FILENAME}
+        return sorted(p for p in paths if os.path.basename(p) not in metadata_files)
+    return [f"{sample_dir}/{path}" for path in manifest["path"]]
+
+
+def create_manifest(sample_dir: str, sample_class: SampleBase) -> None:
+    """Create the manifest for an existing directory of one-sample-per-file samples
+
+    Every sample is loaded once to find its metadata. The rows are sorted by path.
+
+    Args:
+        sample_dir: Path to the directory of pre-saved samples
+        sample_class: sample class type to use for load/to_numpy
+    """
+    if os.path.isfile(f"{sample_dir}/{MANIFEST_FILENAME}"):
+        raise FileExistsError(f"{sample_dir} already has a manifest")
+
+    sample_paths = get_sample_paths(sample_dir)
+
+    with SampleManifestWriter(sample_dir) as manifest:
+        for sample_path in tqdm(sample_paths):
+            sample = sample_class.load(sample_path).to_numpy()
+            manifest.write(
+                path=os.path.basename(sample_path),
+                nbytes=os.path.getsize(sample_path),
+                **get_sample_metadata(sample),
+            )
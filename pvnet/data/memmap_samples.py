@@ -0,0 +1,288 @@
+"""Memory-mapped premade samples
+
+Each fixed-shape key of the samples is stored in its own contiguous `.npy` array with a leading
+sample dimension. The arrays are memory-mapped when read, so loading a sample returns views into
+the page cache rather than deserialising and copying every array. The only copy made is when
+`collate_fn` stacks the views into the batch. A memmap sample directory looks like:
+
+    sample_dir/
+        format.json
+        manifest.csv
+        constants.pkl
+        gsp.npy
+        nwp.ukv.nwp.npy
+        satellite_actual.npy
+        ...
+
+Keys which are constant across samples, like the NWP channel names, are stored once in
+`constants.pkl`. The rows of the manifest are in the same order as the samples in the arrays.
+"""
+
+import os
+import pickle
+
+import numpy as np
+from ocf_data_sampler.sample.base import NumpyBatch, NumpySample, SampleBase
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from pvnet.data.encoding import (
+    check_image_encoding,
+    decode_sample,
+    encode_sample,
+    get_image_encoding,
+)
+from pvnet.data.manifest import (
+    SampleManifestWriter,
+    get_sample_metadata,
+    get_sample_paths,
+    load_filtered_manifest,
+)
+from pvnet.data.projection import SampleProjection
+from pvnet.data.utils import (
+    flatten_sample,
+    is_constant_key,
+    read_sample_format,
+    sample_to_numpy,
+    unflatten_sample,
+    write_sample_format,
+)
+
+CONSTANTS_FILENAME = "constants.pkl"
+
+
+def _array_filename(key: str) -> str:
+    return f"{key.replace('/', '.')}.npy"
+
+
+class MemmapSampleWriter:
+    """Write samples into contiguous memory-mapped arrays
+
+    All samples must have the same keys and array shapes. The arrays are allocated for
+    `num_samples` samples when the first sample is written.
+
+    Args:
+        output_dir: Directory to write the arrays into. Will be created if it does not exist
+        num_samples: The maximum number of samples which will be written
+        image_encoding: The encoding used to store the NWP and satellite arrays. See
+            `pvnet.data.encoding`
+    """
+
+    def __init__(self, output_dir: str, num_samples: int, image_encoding: str = "float32"):
+        """Write samples into contiguous memory-mapped arrays"""
+        check_image_encoding(image_encoding)
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.output_dir = output_dir
+        self.num_samples = num_samples
+        self.image_encoding = image_encoding
+
+        self._arrays: dict[str, np.memmap] = {}
+        self._num_written = 0
+        self._manifest = SampleManifestWriter(output_dir)
+
+    def _allocate(self, flat_sample: dict) -> None:
+        """Create the arrays and save the constants using the first sample"""
+        constants = {}
+        for key, value in flat_sample.items():
+            if is_constant_key(key):
+                constants[key] = value
+            else:
+                value = np.asarray(value)
+                self._arrays[key] = np.lib.format.open_memmap(
+                    f"{self.output_dir}/{_array_filename(key)}",
+                    mode="w+",
+                    dtype=value.dtype,
+                    shape=(self.num_samples, *value.shape),
+                )
+
+        with open(f"{self.output_dir}/{CONSTANTS_FILENAME}", "wb") as f:
+            pickle.dump(constants, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def write(self, sample: NumpySample, **metadata) -> None:
+        """Write a sample into the next row of the arrays
+
+        Args:
+            sample: The sample to write
+            **metadata: Values for the "t0" and "target_id" manifest columns. By default these are
+                found from the sample
+        """
+        if self._num_written == self.num_samples:
+            raise ValueError(f"Cannot write more than {self.num_samples} samples")
+
+        sample = sample_to_numpy(sample)
+        flat_sample = flatten_sample(encode_sample(sample, self.image_encoding))
+
+        if not self._arrays:
+            self._allocate(flat_sample)
+
+        for key, array in self._arrays.items():
+            value = np.asarray(flat_sample[key])
+            if value.shape != array.shape[1:]:
+                raise ValueError(
+                    f"The memmap format requires fixed shapes. Key {key} has shape {value.shape} "
+                    f"but expected {array.shape[1:]}"
+                )
+            array[self._num_written] = value
+
+        self._num_written += 1
+
+        self._manifest.write(
+            **dict(get_sample_metadata(sample), **metadata),
+            nbytes=sum(np.asarray(flat_sample[key]).nbytes for key in self._arrays),
+        )
+
+    def close(self) -> None:
+        """Flush the arrays to disk and write the format description"""
+        for array in self._arrays.values():
+            array.flush()
+        self._manifest.close()
+
+        write_sample_format(
+            self.output_dir,
+            dict(
+                format="memmap",
+                num_samples=self._num_written,
+                image_encoding=self.image_encoding,
+                arrays={key: _array_filename(key) for key in self._arrays},
+            ),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MemmapSamplesDataset(Dataset):
+    """Dataset to load samples from memory-mapped arrays
+
+    The arrays in the returned samples are read-only views into the memory-mapped files. With a
+    projection, the unused arrays are never read and only the cropped part of each image is read.
+
+    Args:
+        sample_dir: Path to the directory of memmap samples.
+        start_time: If set, only use samples with init-times at or after this time
+        end_time: If set, only use samples with init-times at or before this time
+        target_ids: If set, only use samples for these GSP or site IDs
+        projection: If set, the samples are reduced to the inputs used by a model as they are
+            loaded
+    """
+
+    def __init__(
+        self,
+        sample_dir: str,
+        start_time: str | None = None,
+        end_time: str | None = None,
+        target_ids: list[int] | None = None,
+        projection: SampleProjection | None = None,
+    ):
+        """Initialise MemmapSamplesDataset"""
+        sample_format = read_sample_format(sample_dir)
+        manifest = load_filtered_manifest(sample_dir, start_time, end_time, target_ids)
+
+        with open(f"{sample_dir}/{CONSTANTS_FILENAME}", "rb") as f:
+            self.constants = pickle.load(f)
+
+        self.sample_dir = sample_dir
+        self.array_filenames = sample_format["arrays"]
+        self.image_encoding = get_image_encoding(sample_format)
+        self.projection = projection
+
+        # The rows of the arrays holding the selected samples
+        if manifest is None:
+            self._rows = np.arange(sample_format["num_samples"])
+        else:
+            self._rows = manifest.index.values
+        self.num_samples = len(self._rows)
+
+        # The arrays are memory-mapped lazily in each process
+        self._arrays: dict[str, np.memmap] = {}
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        # Memory maps are reopened in spawned worker processes
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    @property
+    def arrays(self) -> dict[str, np.memmap]:
+        """The memory-mapped arrays for each non-constant key
+
+        If there is a projection, the arrays dropped by it are left out and the image arrays are
+        views of only their time steps and centre crops.
+        """
+        if not self._arrays:
+            for key, filename in self.array_filenames.items():
+                if self.projection is not None and not self.projection.keeps(key):
+                    continue
+                array = np.load(f"{self.sample_dir}/{filename}", mmap_mode="r")
+                if self.projection is not None:
+                    array = self.projection.slice_array(key, array, batched=True)
+                self._arrays[key] = array
+        return self._arrays
+
+    def _finalise(self, flat_sample: dict, batched: bool) -> NumpySample | NumpyBatch:
+        """Add the constants, then project and decode a sample or batch"""
+        flat_sample.update(self.constants)
+        sample = unflatten_sample(flat_sample)
+        if self.projection is not None:
+            # The arrays are already sliced, so this only selects the keys and channels
+            sample = self.projection.project(sample, batched=batched)
+        return decode_sample(sample, self.image_encoding, batched=batched)
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.num_samples:
+            raise IndexError(f"Index {idx} out of range for {self.num_samples} samples")
+        row = self._rows[idx]
+        flat_sample = {key: array[row] for key, array in self.arrays.items()}
+        return self._finalise(flat_sample, batched=False)
+
+    def __getitems__(self, indices: list[int]) -> NumpyBatch:
+        """Load a batch of samples with one read of each array
+
+        Returns:
+            The samples stacked into a batch
+        """
+        indices = np.asarray(indices)
+        if ((indices < 0) | (indices >= self.num_samples)).any():
+            raise IndexError(f"Indices out of range for {self.num_samples} samples")
+
+        # Read the rows in ascending order so each array is read front to back
+        rows = self._rows[indices]
+        order = np.argsort(rows)
+        flat_batch = {}
+        for key, array in self.arrays.items():
+            flat_batch[key] = np.empty((len(rows), *array.shape[1:]), dtype=array.dtype)
+            flat_batch[key][order] = array[rows[order]]
+        return self._finalise(flat_batch, batched=True)
+
+
+def convert_to_memmap(
+    sample_dir: str,
+    output_dir: str,
+    sample_class: SampleBase,
+    image_encoding: str = "float32",
+) -> None:
+    """Convert a directory of one-sample-per-file samples into memory-mapped arrays
+
+    Args:
+        sample_dir: Path to the directory of pre-saved samples
+        output_dir: Directory to write the arrays into
+        sample_class: sample class type to use for load/to_numpy
+        image_encoding: The encoding used to store the NWP and satellite arrays
+    """
+    sample_paths = get_sample_paths(sample_dir)
+    input_encoding = get_image_encoding(read_sample_format(sample_dir))
+
+    writer = MemmapSampleWriter(
+        output_dir, num_samples=len(sample_paths), image_encoding=image_encoding
+    )
+    with writer:
+        for sample_path in tqdm(sample_paths):
+            sample = sample_to_numpy(sample_class.load(sample_path).to_numpy())
+            writer.write(decode_sample(sample, input_encoding))
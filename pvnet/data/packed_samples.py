@@ -0,0 +1,498 @@
+"""Packed sample shards
+
+Storing one sample per file means millions of files, and one file open per sample, for large
+training sets. The packed format instead appends many pickled samples into each shard file and
+records the byte range of every sample in the manifest. The samples can optionally be compressed,
+see `pvnet.data.compression`. A packed sample directory looks like:
+
+    sample_dir/
+        format.json
+        manifest.csv
+        shard_000000.bin
+        shard_000001.bin
+        ...
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from ocf_data_sampler.numpy_sample.collate import stack_np_samples_into_batch
+from ocf_data_sampler.sample.base import NumpyBatch, NumpySample, SampleBase
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from tqdm import tqdm
+
+from pvnet.data.compression import (
+    compress_sample,
+    decompress_sample,
+    get_codec,
+    get_codec_from_config,
+)
+from pvnet.data.encoding import (
+    check_image_encoding,
+    decode_sample,
+    encode_sample,
+    get_image_encoding,
+)
+from pvnet.data.manifest import (
+    MANIFEST_COLUMNS,
+    SampleManifestWriter,
+    get_sample_metadata,
+    get_sample_paths,
+    load_filtered_manifest,
+)
+from pvnet.data.projection import SampleProjection
+from pvnet.data.remote import RemoteSampleReader, is_remote_path
+from pvnet.data.timing import StageTimer, time_stage
+from pvnet.data.utils import read_sample_format, sample_to_numpy, write_sample_format
+
+PACKED_MANIFEST_COLUMNS = MANIFEST_COLUMNS[:1] + ["offset"] + MANIFEST_COLUMNS[1:]
+
+
+def _shard_filename(shard_num: int) -> str:
+    return f"shard_{shard_num:06}.bin"
+
+
+class PackedSampleWriter:
+    """Write samples into packed shard files
+
+    Samples are converted to numpy, pickled and optionally compressed. The manifest rows for a
+    shard are only written once the shard has been flushed to disk, so an interrupted write loses
+    at most the current shard.
+
+    Args:
+        output_dir: Directory to write the shards into. Will be created if it does not exist
+        samples_per_shard: Number of samples to store in each shard file
+        image_encoding: The encoding used to store the NWP and satellite arrays. See
+            `pvnet.data.encoding`
+        codec: The codec used to compress each sample. See `pvnet.data.compression`
+        compression_level: The compression level of the codec. Uses the codec default if not set
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        samples_per_shard: int = 1024,
+        image_encoding: str = "float32",
+        codec: str = "none",
+        compression_level: int | None = None,
+    ):
+        """Write samples into packed shard files"""
+        if samples_per_shard < 1:
+            raise ValueError(f"`samples_per_shard` must be positive - got {samples_per_shard}")
+        check_image_encoding(image_encoding)
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.output_dir = output_dir
+        self.samples_per_shard = samples_per_shard
+        self.image_encoding = image_encoding
+        self.codec = get_codec(codec, compression_level)
+
+        self._shard_num = 0
+        self._shard_file = None
+        self._shard_rows: list[dict] = []
+        self._manifest = SampleManifestWriter(output_dir, columns=PACKED_MANIFEST_COLUMNS)
+
+    def _open_shard(self) -> None:
+        shard_path = f"{self.output_dir}/{_shard_filename(self._shard_num)}"
+        self._shard_file = open(shard_path, "wb")
+
+    def _close_shard(self) -> None:
+        """Flush the current shard to disk and append its rows to the manifest"""
+        self._shard_file.close()
+        self._shard_file = None
+        self._shard_num += 1
+
+        for row in self._shard_rows:
+            self._manifest.write(**row)
+        self._shard_rows = []
+
+    def write(self, sample: NumpySample, **metadata) -> None:
+        """Append a sample to the current shard
+
+        Args:
+            sample: The sample to write
+            **metadata: Values for the "t0" and "target_id" manifest columns. By default these are
+                found from the sample
+        """
+        if self._shard_file is None:
+            self._open_shard()
+
+        sample = sample_to_numpy(sample)
+        record = compress_sample(encode_sample(sample, self.image_encoding), self.codec)
+
+        offset = self._shard_file.tell()
+        self._shard_file.write(record)
+        self._shard_rows.append(
+            dict(
+                get_sample_metadata(sample),
+                **metadata,
+                path=_shard_filename(self._shard_num),
+                offset=offset,
+                nbytes=len(record),
+            )
+        )
+
+        if len(self._shard_rows) == self.samples_per_shard:
+            self._close_shard()
+
+    def close(self) -> None:
+        """Flush any partially filled shard and write the format description"""
+        if self._shard_file is not None:
+            self._close_shard()
+        self._manifest.close()
+
+        write_sample_format(
+            self.output_dir,
+            dict(
+                format="packed",
+                samples_per_shard=self.samples_per_shard,
+                image_encoding=self.image_encoding,
+                codec=None if self.codec is None else self.codec.get_config(),
+            ),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedSamplesDataset(Dataset):
+    """Dataset to load samples from packed shards
+
+    Args:
+        sample_dir: Path to the directory of packed samples.
+        start_time: If set, only use samples with init-times at or after this time
+        end_time: If set, only use samples with init-times at or before this time
+        target_ids: If set, only use samples for these GSP or site IDs
+        projection: If set, the samples are reduced to the inputs used by a model as they are
+            loaded
+        reader: The reader used if the sample directory is on a remote filesystem. A reader
+            without a disk cache is used by default
+        stage_timer: If set, the reading, projection and decoding of the samples are timed
+    """
+
+    def __init__(
+        self,
+        sample_dir: str,
+        start_time: str | None = None,
+        end_time: str | None = None,
+        target_ids: list[int] | None = None,
+        projection: SampleProjection | None = None,
+        reader: RemoteSampleReader | None = None,
+        stage_timer: StageTimer | None = None,
+    ):
+        """Initialise PackedSamplesDataset"""
+        manifest = load_filtered_manifest(sample_dir, start_time, end_time, target_ids)
+
+        self.sample_dir = sample_dir
+        sample_format = read_sample_format(sample_dir)
+        self.image_encoding = get_image_encoding(sample_format)
+        self.codec = get_codec_from_config(sample_format.get("codec"))
+        self.projection = projection
+        if reader is None and is_remote_path(sample_dir):
+            reader = RemoteSampleReader()
+        self.reader = reader
+        self.stage_timer = stage_timer
+
+        # Store the shard of each sample as an integer code to keep the index compact
+        self._shard_codes, self.shard_names = pd.factorize(manifest["path"])
+        self._offsets = manifest["offset"].values
+        self._nbytes = manifest["nbytes"].values
+
+        # Shard file descriptors are opened lazily in each process
+        self._fds: dict[int, int] = {}
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getstate__(self):
+        # File descriptors cannot be shared with spawned worker processes
+        state = self.__dict__.copy()
+        state["_fds"] = {}
+        return state
+
+    def __del__(self):
+        for fd in getattr(self, "_fds", {}).values():
+            os.close(fd)
+
+    def _get_fd(self, shard_code: int) -> int:
+        if shard_code not in self._fds:
+            shard_path = f"{self.sample_dir}/{self.shard_names[shard_code]}"
+            self._fds[shard_code] = os.open(shard_path, os.O_RDONLY)
+        return self._fds[shard_code]
+
+    def _read_blocks(self, blocks: list[tuple[int, int, int]]) -> list[bytes]:
+        """Read byte ranges of the shards
+
+        Args:
+            blocks: The shard code, start and number of bytes of each range
+        """
+        with time_stage(self.stage_timer, "read"):
+            if self.reader is not None:
+                # Remote ranges are all requested at once to hide the latency of each request
+                return self.reader.read_ranges(
+                    [
+                        (f"{self.sample_dir}/{self.shard_names[code]}", start, nbytes)
+                        for code, start, nbytes in blocks
+                    ]
+                )
+            return [os.pread(self._get_fd(code), nbytes, start) for code, start, nbytes in blocks]
+
+    def _read_record(self, idx: int) -> bytes:
+        block = (self._shard_codes[idx], self._offsets[idx], self._nbytes[idx])
+        return self._read_blocks([block])[0]
+
+    def _read_records(self, indices: np.ndarray) -> list[bytes | memoryview]:
+        """Read the records of many samples, coalescing adjacent records into single reads"""
+        if self.reader is not None:
+            # The reader caches each record and only coalesces the records it has to read
+            with time_stage(self.stage_timer, "read"):
+                return self.reader.read_records(
+                    [
+                        (
+                            f"{self.sample_dir}/{self.shard_names[self._shard_codes[idx]]}",
+                            self._offsets[idx],
+                            self._nbytes[idx],
+                        )
+                        for idx in indices
+                    ]
+                )
+
+        # Read in shard and offset order so neighbouring records can be joined
+        order = np.lexsort((self._offsets[indices], self._shard_codes[indices]))
+
+        runs: list[list[int]] = []
+        for i in order:
+            if runs:
+                prev = indices[runs[-1][-1]]
+                contiguous = (
+                    self._shard_codes[indices[i]] == self._shard_codes[prev]
+                    and self._offsets[indices[i]] <= self._offsets[prev] + self._nbytes[prev]
+                )
+                if contiguous:
+                    runs[-1].append(i)
+                    continue
+            runs.append([i])
+
+        blocks = []
+        for run in runs:
+            first, last = indices[run[0]], indices[run[-1]]
+            start = self._offsets[first]
+            nbytes = self._offsets[last] + self._nbytes[last] - start
+            blocks.append((self._shard_codes[first], start, nbytes))
+
+        records = [None] * len(indices)
+        for run, (_, start, _), block in zip(runs, blocks, self._read_blocks(blocks)):
+            block = memoryview(block)
+            for i in run:
+                offset = self._offsets[indices[i]] - start
+                records[i] = block[offset : offset + self._nbytes[indices[i]]]
+
+        return records
+
+    def _decompress_record(self, record: bytes | memoryview) -> NumpySample:
+        """Decompress and project a single sample, leaving its images encoded"""
+        with time_stage(self.stage_timer, "decode"):
+            sample = decompress_sample(record, self.codec)
+        if self.projection is not None:
+            with time_stage(self.stage_timer, "project"):
+                sample = self.projection.project(sample)
+        return sample
+
+    def _load_record(self, record: bytes | memoryview) -> NumpySample:
+        """Decompress, project and decode a single sample"""
+        sample = self._decompress_record(record)
+        with time_stage(self.stage_timer, "decode"):
+            return decode_sample(sample, self.image_encoding)
+
+    def __getitem__(self, idx):
+        return self._load_record(self._read_record(idx))
+
+    def __getitems__(self, indices: list[int]) -> NumpyBatch:
+        """Load a batch of samples, reading neighbouring samples in each shard as one block
+
+        Returns:
+            The samples stacked into a batch
+        """
+        records = self._read_records(np.asarray(indices))
+        samples = [self._decompress_record(record) for record in records]
+        with time_stage(self.stage_timer, "collate"):
+            batch = stack_np_samples_into_batch(samples)
+        with time_stage(self.stage_timer, "decode"):
+            return decode_sample(batch, self.image_encoding, batched=True)
+
+
+def _get_rank_and_world_size() -> tuple[int, int]:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class PackedSamplesIterableDataset(IterableDataset):
+    """Dataset to stream samples from packed shards in file order
+
+    Each shard is read front to back, so the disk access is close to sequential. When shuffling,
+    the shards are visited in a random order and the samples pass through a shuffle buffer. This
+    gives a different sample order each epoch without random reads.
+
+    The shards are split between the dataloader workers of all distributed ranks so that each
+    shard is read by exactly one worker. Under distributed training every rank yields the same
+    number of samples, so a few samples may be dropped each epoch.
+
+    Args:
+        sample_dir: Path to the directory of packed samples.
+        start_time: If set, only use samples with init-times at or after this time
+        end_time: If set, only use samples with init-times at or before this time
+        target_ids: If set, only use samples for these GSP or site IDs
+        projection: If set, the samples are reduced to the inputs used by a model as they are
+            loaded
+        reader: The reader used if the sample directory is on a remote filesystem
+        stage_timer: If set, the reading, projection and decoding of the samples are timed
+        shuffle: Whether to randomise the order of the shards and samples each epoch
+        shuffle_buffer_size: The number of samples held in the shuffle buffer
+        rank: The distributed rank of this process. Found from `torch.distributed` by default
+        world_size: The number of distributed ranks. Found from `torch.distributed` by default
+    """
+
+    # Number of samples read from a shard at a time
+    read_block_size = 32
+
+    def __init__(
+        self,
+        sample_dir: str,
+        start_time: str | None = None,
+        end_time: str | None = None,
+        target_ids: list[int] | None = None,
+        projection: SampleProjection | None = None,
+        reader: RemoteSampleReader | None = None,
+        stage_timer: StageTimer | None = None,
+        shuffle: bool = True,
+        shuffle_buffer_size: int = 1000,
+        rank: int | None = None,
+        world_size: int | None = None,
+    ):
+        """Initialise PackedSamplesIterableDataset"""
+        if shuffle_buffer_size < 1:
+            raise ValueError(f"`shuffle_buffer_size` must be positive - got {shuffle_buffer_size}")
+
+        if rank is None or world_size is None:
+            rank, world_size = _get_rank_and_world_size()
+
+        self.dataset = PackedSamplesDataset(
+            sample_dir, start_time, end_time, target_ids, projection, reader, stage_timer
+        )
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+        # The indices of the samples in each shard in file order
+        ds = self.dataset
+        order = np.lexsort((ds._offsets, ds._shard_codes))
+        split_points = np.flatnonzero(np.diff(ds._shard_codes[order])) + 1
+        shard_indices = np.split(order, split_points) if len(order) > 0 else []
+
+        # Assign the shards round-robin to the ranks. Each rank yields the same number of samples
+        self._shard_indices = shard_indices[rank::world_size]
+        self.num_samples = min(
+            sum(len(indices) for indices in shard_indices[r::world_size]) for r in range(world_size)
+        )
+
+    def __len__(self):
+        return self.num_samples
+
+    def _get_worker_quotas(self, num_workers: int) -> list[int]:
+        """Split the samples of this rank between the workers, dropping any excess samples"""
+        quotas = [
+            sum(len(indices) for indices in self._shard_indices[w::num_workers])
+            for w in range(num_workers)
+        ]
+        excess = sum(quotas) - self.num_samples
+        while excess > 0:
+            # Take from the worker with the most samples so the workers finish close together
+            quotas[int(np.argmax(quotas))] -= 1
+            excess -= 1
+        return quotas
+
+    def _iter_shards(self, shard_indices: list[np.ndarray]):
+        for indices in shard_indices:
+            for start in range(0, len(indices), self.read_block_size):
+                block = indices[start : start + self.read_block_size]
+                for record in self.dataset._read_records(block):
+                    yield self.dataset._load_record(record)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+
+        shard_indices = self._shard_indices[worker_id::num_workers]
+        quota = self._get_worker_quotas(num_workers)[worker_id]
+
+        if not self.shuffle:
+            samples = self._iter_shards(shard_indices)
+            for _, sample in zip(range(quota), samples):
+                yield sample
+            return
+
+        # The torch RNG is reseeded for each worker every epoch, and advances between epochs in
+        # the main process, so this seed changes each epoch
+        rng = np.random.default_rng(int(torch.randint(2**62, ())))
+        shard_indices = [shard_indices[i] for i in rng.permutation(len(shard_indices))]
+
+        buffer = []
+        num_yielded = 0
+        for sample in self._iter_shards(shard_indices):
+            if num_yielded == quota:
+                return
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield sample
+            num_yielded += 1
+
+        rng.shuffle(buffer)
+        for sample in buffer[: quota - num_yielded]:
+            yield sample
+
+
+def pack_samples(
+    sample_dir: str,
+    output_dir: str,
+    sample_class: SampleBase,
+    samples_per_shard: int = 1024,
+    image_encoding: str = "float32",
+    codec: str = "none",
+    compression_level: int | None = None,
+) -> None:
+    """Convert a directory of one-sample-per-file samples into packed shards
+
+    Args:
+        sample_dir: Path to the directory of pre-saved samples
+        output_dir: Directory to write the packed shards into
+        sample_class: sample class type to use for load/to_numpy
+        samples_per_shard: Number of samples to store in each shard file
+        image_encoding: The encoding used to store the NWP and satellite arrays
+        codec: The codec used to compress each sample
+        compression_level: The compression level of the codec
+    """
+    sample_paths = get_sample_paths(sample_dir)
+    input_encoding = get_image_encoding(read_sample_format(sample_dir))
+
+    writer = PackedSampleWriter(
+        output_dir,
+        samples_per_shard=samples_per_shard,
+        image_encoding=image_encoding,
+        codec=codec,
+        compression_level=compression_level,
+    )
+    with writer:
+        for sample_path in tqdm(sample_paths):
+            sample = sample_to_numpy(sample_class.load(sample_path).to_numpy())
+            writer.write(decode_sample(sample, input_encoding))
@@ -0,0 +1,185 @@
+"""Background prefetching of batches onto a device
+
+Batches are normally copied to the device just before the forward pass, so the copy and the wait
+for the next batch from the dataloader both block the model. A `DevicePrefetcher` wraps any
+iterable of batches and, on a background thread, takes the next batches from it and copies them
+to the device. Up to `num_batches` batches are staged ahead of the one in use. The original host
+batches can be returned along with the device batches, for code like the backtests which also read
+some of the inputs on the host.
+
+On CPU the copy is a no-op, but taking batches from the dataloader still overlaps with the compute.
+On CUDA devices the copies are made on a separate stream, and the compute stream waits for the copy
+of each batch only when that batch is taken from the prefetcher.
+"""
+
+import queue
+import threading
+from collections.abc import Iterable, Iterator
+
+import torch
+from lightning.fabric.utilities.apply_func import move_data_to_device
+
+# Put on the queue once the wrapped iterable is exhausted
+_DONE = object()
+
+# How often the background thread checks whether it has been stopped while the queue is full
+_POLL_SECONDS = 0.1
+
+
+class _ExceptionWrapper:
+    """An exception raised on the background thread, to be re-raised on the main thread"""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def _record_stream(batch, stream: torch.cuda.Stream) -> None:
+    """Mark the tensors of a batch as used by a stream so their memory is not reused too early"""
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            _record_stream(value, stream)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            _record_stream(value, stream)
+
+
+class DevicePrefetcher:
+    """Iterable which stages the next batches of another iterable onto a device in the background
+
+    Args:
+        iterable: The iterable of batches, such as a DataLoader
+        device: The device to copy the batches to
+        num_batches: The number of batches to stage ahead of the one in use
+        keep_host_batch: If True, each item is a tuple of the original batch and the device batch
+    """
+
+    def __init__(
+        self,
+        iterable: Iterable,
+        device: torch.device | str,
+        num_batches: int = 2,
+        keep_host_batch: bool = False,
+    ):
+        """Iterable which stages the next batches of another iterable onto a device"""
+        if num_batches < 1:
+            raise ValueError(f"`num_batches` must be positive - got {num_batches}")
+        self.iterable = iterable
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+        self.keep_host_batch = keep_host_batch
+
+    def __len__(self):
+        return len(self.iterable)
+
+    @property
+    def sampler(self):
+        """The sampler of the wrapped dataloader, so the trainer can set its epoch"""
+        return getattr(self.iterable, "sampler", None)
+
+    @property
+    def batch_sampler(self):
+        """The batch sampler of the wrapped dataloader, so the trainer can set its epoch"""
+        return getattr(self.iterable, "batch_sampler", None)
+
+    def __iter__(self) -> Iterator:
+        return _DevicePrefetchIterator(
+            self.iterable, self.device, self.num_batches, self.keep_host_batch
+        )
+
+
+def _copy_to_device(batch, device: torch.device, stream: torch.cuda.Stream | None):
+    """Copy a batch to the device, also returning an event to wait for on CUDA devices"""
+    if stream is None:
+        return batch, move_data_to_device(batch, device), None
+    with torch.cuda.stream(stream):
+        device_batch = move_data_to_device(batch, device)
+        event = torch.cuda.Event()
+        event.record(stream)
+    return batch, device_batch, event
+
+
+def _put(batch_queue: queue.Queue, stop: threading.Event, item) -> bool:
+    """Put an item on the queue, unless stopped first"""
+    while not stop.is_set():
+        try:
+            batch_queue.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _stage_batches(
+    iterator: Iterator,
+    batch_queue: queue.Queue,
+    stop: threading.Event,
+    device: torch.device,
+    stream: torch.cuda.Stream | None,
+) -> None:
+    """Copy the batches to the device and put them on the queue until stopped
+
+    This does not hold a reference to the prefetch iterator, so the iterator can be garbage
+    collected and stop the thread if it is abandoned.
+    """
+    try:
+        for batch in iterator:
+            if not _put(batch_queue, stop, _copy_to_device(batch, device, stream)):
+                return
+    except BaseException as e:
+        _put(batch_queue, stop, _ExceptionWrapper(e))
+        return
+    _put(batch_queue, stop, _DONE)
+
+
+class _DevicePrefetchIterator:
+    """Iterator over the batches of a `DevicePrefetcher`, which runs the background thread"""
+
+    def __init__(
+        self, iterable: Iterable, device: torch.device, num_batches: int, keep_host_batch: bool
+    ):
+        self.device = device
+        self.keep_host_batch = keep_host_batch
+        self._queue = queue.Queue(maxsize=num_batches)
+        self._stop = threading.Event()
+        stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self._thread = threading.Thread(
+            target=_stage_batches,
+            args=(iter(iterable), self._queue, self._stop, device, stream),
+            daemon=True,
+            name="DevicePrefetcher",
+        )
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stop.is_set():
+            raise StopIteration
+
+        item = self._queue.get()
+        if item is _DONE:
+            self.close()
+            raise StopIteration
+        if isinstance(item, _ExceptionWrapper):
+            self.close()
+            raise item.exception
+
+        batch, device_batch, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            _record_stream(device_batch, stream)
+        return (batch, device_batch) if self.keep_host_batch else device_batch
+
+    def close(self) -> None:
+        """Stop the background thread and wait for it to finish"""
+        self._stop.set()
+        self._thread.join()
+
+    def __del__(self):
+        # The thread stops itself once it next tries to stage a batch
+        self._stop.set()
@@ -0,0 +1,238 @@
+"""Projection of samples onto the inputs a model uses
+
+Samples are often prepared with more NWP sources, larger images and longer time windows than a
+model uses. The model crops these down in `_adapt_batch()`, but by then the full samples have been
+loaded, collated and sent from the dataloader workers. A `SampleProjection` applied by the datasets
+reduces each sample in the dataloader workers instead. It can:
+
+- Drop the NWP sources and satellite data which are not used
+- Keep only the first time steps of each image-like array and of selected time series
+- Centre crop each image-like array
+- Keep a subset of the NWP channels, selected by name
+- Drop all keys which the model does not read, before the samples are stacked into a batch
+
+Only the image-like arrays and the selected time series are cropped and sliced, as in
+`_adapt_batch()`. The coordinate arrays of the images are left as they are.
+"""
+
+import numpy as np
+from ocf_data_sampler.sample.base import NumpyBatch, NumpySample
+from torch.utils.data import Dataset
+
+from pvnet.data.encoding import is_image_key
+from pvnet.data.timing import StageTimer, time_stage
+from pvnet.data.utils import flatten_sample, sample_to_numpy, unflatten_sample
+
+
+class ImageProjection:
+    """How to reduce one image-like array of a sample with shape (time, channel, y, x)
+
+    Args:
+        image_size_pixels: The height and width of the centre crop. Not cropped if None
+        sequence_length: The number of time steps to keep from the start. All kept if None
+        channels: The names of the channels to keep, in the order to keep them. All kept if None.
+            Only NWP data stores channel names
+    """
+
+    def __init__(
+        self,
+        image_size_pixels: int | None = None,
+        sequence_length: int | None = None,
+        channels: list[str] | None = None,
+    ):
+        """How to reduce one image-like array of a sample"""
+        self.image_size_pixels = image_size_pixels
+        self.sequence_length = sequence_length
+        self.channels = None if channels is None else list(channels)
+
+    def get_slices(self, shape: tuple[int, ...]) -> tuple[slice, ...]:
+        """Get the slices which take the time steps and centre crop from an array
+
+        Args:
+            shape: The shape of the unbatched array, (time, channel, y, x)
+        """
+        slices = [slice(None, self.sequence_length), slice(None)]
+        for size in shape[2:]:
+            if self.image_size_pixels is None or self.image_size_pixels >= size:
+                slices.append(slice(None))
+            else:
+                # Same rounding as `torchvision.transforms.functional.center_crop()`
+                start = int(round((size - self.image_size_pixels) / 2.0))
+                slices.append(slice(start, start + self.image_size_pixels))
+        return tuple(slices)
+
+    def get_channel_indices(self, channel_names: np.ndarray | None) -> np.ndarray | None:
+        """Get the indices of the channels to keep
+
+        Args:
+            channel_names: The channel names stored in the sample, or None if there are none
+        """
+        if self.channels is None:
+            return None
+        if channel_names is None:
+            raise ValueError("Channels can only be selected for data with stored channel names")
+
+        channel_names = list(np.asarray(channel_names))
+        missing = [c for c in self.channels if c not in channel_names]
+        if missing:
+            raise ValueError(f"Channels {missing} not found in the sample channels {channel_names}")
+        return np.array([channel_names.index(c) for c in self.channels])
+
+
+class SampleProjection:
+    """Reduce samples to the parts which are used by a model
+
+    Args:
+        nwp: The NWP sources to keep and how to reduce each of them. Sources mapped to None are
+            kept unchanged. If None, all NWP sources are kept unchanged
+        satellite: How to reduce the satellite data. Kept unchanged if None
+        include_satellite: Whether to keep the satellite data
+        series: The number of time steps to keep from the start of time series like the GSP
+            yield and solar coordinates, keyed by the flattened sample key
+        keys: If set, only these flattened sample keys are kept
+    """
+
+    def __init__(
+        self,
+        nwp: dict[str, ImageProjection | None] | None = None,
+        satellite: ImageProjection | None = None,
+        include_satellite: bool = True,
+        series: dict[str, int] | None = None,
+        keys: list[str] | None = None,
+    ):
+        """Reduce samples to the parts which are used by a model"""
+        self.nwp = None if nwp is None else dict(nwp)
+        self.satellite = satellite
+        self.include_satellite = include_satellite
+        self.series = {} if series is None else dict(series)
+        self.keys = None if keys is None else set(keys)
+
+    @classmethod
+    def from_model(cls, model) -> "SampleProjection":
+        """Get the projection onto the inputs used by a model
+
+        Args:
+            model: A PVNet model which declares its inputs with `get_input_spec()`
+        """
+        return model.get_input_spec()
+
+    def _keeps_source(self, key: str) -> bool:
+        if key.startswith("nwp/"):
+            return self.nwp is None or key.split("/")[1] in self.nwp
+        if key.startswith("satellite_"):
+            return self.include_satellite
+        return True
+
+    def keeps(self, key: str) -> bool:
+        """Check if a flattened sample key is kept by the projection"""
+        if not self._keeps_source(key):
+            return False
+        if self.keys is None or key in self.keys:
+            return True
+        # Quantised images need their scale and offset to be decoded
+        for suffix in ["_scale", "_offset"]:
+            if key.endswith(suffix) and key.removesuffix(suffix) in self.keys:
+                return True
+        return False
+
+    def _get_image_projection(self, key: str) -> ImageProjection | None:
+        if key == "satellite_actual":
+            return self.satellite
+        elif self.nwp is not None:
+            return self.nwp[key.split("/")[1]]
+        return None
+
+    def slice_array(self, key: str, x: np.ndarray, batched: bool = False) -> np.ndarray:
+        """Take the time steps and centre crop of an image-like array
+
+        This only uses basic slicing, so slicing a memory-mapped array does not read it. Slicing
+        an array which has already been sliced has no effect.
+
+        Args:
+            key: The flattened sample key of the array
+            x: The array
+            batched: Whether the array has a leading batch dimension
+        """
+        projection = self._get_image_projection(key) if is_image_key(key) else None
+        if projection is None:
+            return x
+        lead = (slice(None),) if batched else ()
+        return x[lead + projection.get_slices(x.shape[len(lead) :])]
+
+    def project(
+        self,
+        sample: NumpySample | NumpyBatch,
+        batched: bool = False,
+    ) -> NumpySample | NumpyBatch:
+        """Project a sample or batch onto the kept sources, time steps, crops and channels
+
+        Samples with encoded images can be projected before they are decoded.
+
+        Args:
+            sample: The numpy sample or batch
+            batched: Whether the input is a batch of samples stacked along a new first axis
+        """
+        flat_sample = {
+            key: value
+            for key, value in flatten_sample(sample_to_numpy(sample)).items()
+            if self._keeps_source(key)
+        }
+
+        lead = (slice(None),) if batched else ()
+        for key, sequence_length in self.series.items():
+            if key in flat_sample:
+                flat_sample[key] = flat_sample[key][lead + (slice(None, sequence_length),)]
+
+        channel_axis = 2 if batched else 1
+        for key in [k for k in flat_sample if is_image_key(k)]:
+            flat_sample[key] = self.slice_array(key, flat_sample[key], batched)
+
+            projection = self._get_image_projection(key)
+            if projection is None:
+                continue
+            names_key = f"{key}_channel_names"
+            channels = projection.get_channel_indices(flat_sample.get(names_key))
+            if channels is None:
+                continue
+
+            flat_sample[key] = np.take(flat_sample[key], channels, axis=channel_axis)
+            flat_sample[names_key] = np.asarray(flat_sample[names_key])[channels]
+            # The per-channel parameters of quantised images
+            for params_key in [f"{key}_scale", f"{key}_offset"]:
+                if params_key in flat_sample:
+                    flat_sample[params_key] = np.take(flat_sample[params_key], channels, axis=-1)
+
+        # The channel names are only dropped now they have been used to select channels
+        return unflatten_sample({k: v for k, v in flat_sample.items() if self.keeps(k)})
+
+
+class ProjectedDataset(Dataset):
+    """Wrapper around a dataset which projects each sample it returns
+
+    This is used for the streamed datasets, so the samples are reduced inside the dataloader
+    workers before they are collated.
+
+    Args:
+        dataset: The dataset to wrap
+        projection: The projection to apply
+        stage_timer: If set, the projection of the samples is timed
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        projection: SampleProjection,
+        stage_timer: StageTimer | None = None,
+    ):
+        """Wrapper around a dataset which projects each sample it returns"""
+        self.dataset = dataset
+        self.projection = projection
+        self.stage_timer = stage_timer
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        with time_stage(self.stage_timer, "project"):
+            return self.projection.project(sample)
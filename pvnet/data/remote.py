@@ -0,0 +1,319 @@
+"""Reading premade samples from object stores
+
+Premade sample directories can be on any filesystem supported by fsspec, such as `s3://` or
+`gs://` buckets. A `RemoteSampleReader` reads byte ranges of the remote files, such as the records
+of packed shards, and whole files, such as one-sample-per-file samples. Many ranges can be read at
+once on a thread pool, which hides most of the latency of each request.
+
+The reader can keep a bounded cache of what it has read on a local disk. Each record or file is
+stored as its own file, written to a temporary file and renamed, so the cache can be shared by the
+dataloader workers. When the cache grows over its byte budget, the least recently used files are
+deleted. Records are cached one by one even when neighbouring records are read together, so a
+record is found in the cache whichever records it was first read with.
+"""
+
+import contextlib
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import fsspec
+from fsspec.core import split_protocol
+
+# Fraction of the byte budget the cache is reduced to when it is full, so it is not trimmed on
+# every write
+_EVICT_TO = 0.9
+
+
+def is_remote_path(path: str) -> bool:
+    """Check if a path is on a filesystem other than the local disk"""
+    protocol, _ = split_protocol(path)
+    return protocol not in (None, "file", "local")
+
+
+def get_filesystem(path: str) -> fsspec.AbstractFileSystem:
+    """Get the fsspec filesystem of a path"""
+    fs, _ = fsspec.core.url_to_fs(path)
+    return fs
+
+
+def _get_range_key(path: str, start: int, nbytes: int) -> str:
+    return f"{path}:{start}:{nbytes}"
+
+
+def _coalesce_records(records: list[tuple[str, int, int]], indices: list[int]) -> list[list[int]]:
+    """Group records which are adjacent or overlapping in the same file, so each group is one read
+
+    Args:
+        records: The path, start and number of bytes of each record
+        indices: The indices of the records to group
+
+    Returns:
+        The indices of the records in each group, sorted by their position in the file
+    """
+    runs: list[list[int]] = []
+    run_end = 0
+    for i in sorted(indices, key=lambda i: records[i][:2]):
+        path, start, nbytes = records[i]
+        if runs and records[runs[-1][0]][0] == path and start <= run_end:
+            runs[-1].append(i)
+            run_end = max(run_end, start + nbytes)
+        else:
+            runs.append([i])
+            run_end = start + nbytes
+    return runs
+
+
+class DiskCache:
+    """Bounded cache of byte strings stored as files on a local disk
+
+    The cache can be shared by several processes. Each process keeps an estimate of the cache size
+    and trims it when the estimate exceeds the byte budget.
+
+    Args:
+        cache_dir: The local directory to store the cache in
+        max_bytes: The byte budget of the cache
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """Bounded cache of byte strings stored as files on a local disk"""
+        if max_bytes < 1:
+            raise ValueError(f"`max_bytes` must be positive - got {max_bytes}")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._nbytes: int | None = None
+
+    def _get_path(self, key: str) -> str:
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return f"{self.cache_dir}/{name[:2]}/{name}"
+
+    def _list_files(self) -> list[os.DirEntry]:
+        return [
+            entry
+            for subdir in os.scandir(self.cache_dir)
+            if subdir.is_dir()
+            for entry in os.scandir(subdir.path)
+            if not entry.name.endswith(".tmp")
+        ]
+
+    @property
+    def nbytes(self) -> int:
+        """The total size of the files in the cache"""
+        return sum(entry.stat().st_size for entry in self._list_files())
+
+    def get(self, key: str) -> bytes | None:
+        """Get a cached value, or None if it is not in the cache"""
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Mark the file as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Store a value in the cache, evicting the least recently used values if required"""
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Rename a complete temporary file so no process can read a partly written value
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if self._nbytes is None:
+            self._nbytes = self.nbytes
+        else:
+            self._nbytes += len(data)
+        if self._nbytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Delete the least recently used files until the cache is under its budget"""
+        entries = []
+        for entry in self._list_files():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if nbytes <= self.max_bytes * _EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            nbytes -= size
+        self._nbytes = nbytes
+
+
+class RemoteSampleReader:
+    """Read byte ranges and whole files of remote premade samples, with an optional disk cache
+
+    Args:
+        cache_dir: If set, what is read is cached in this local directory
+        cache_bytes: The byte budget of the disk cache. Required if `cache_dir` is set
+        max_concurrency: The maximum number of reads made at once
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | None = None,
+        cache_bytes: int | None = None,
+        max_concurrency: int = 16,
+    ):
+        """Read byte ranges and whole files of remote premade samples"""
+        if cache_dir is not None and cache_bytes is None:
+            raise ValueError("`cache_bytes` must be set to use a disk cache")
+        if max_concurrency < 1:
+            raise ValueError(f"`max_concurrency` must be positive - got {max_concurrency}")
+        self.cache = None if cache_dir is None else DiskCache(cache_dir, cache_bytes)
+        self.max_concurrency = max_concurrency
+        self._pool: ThreadPoolExecutor | None = None
+        self._pool_pid: int | None = None
+
+    def __getstate__(self):
+        # Each worker process starts its own thread pool
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        """The thread pool used to make concurrent reads"""
+        # The threads of a pool are not copied into forked worker processes
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.max_concurrency)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def _fetch_range(self, path: str, start: int, nbytes: int) -> bytes:
+        return get_filesystem(path).cat_file(path, start=start, end=start + nbytes)
+
+    def _read_range(self, path: str, start: int, nbytes: int) -> bytes:
+        key = _get_range_key(path, start, nbytes)
+        if self.cache is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+
+        data = self._fetch_range(path, start, nbytes)
+        if self.cache is not None:
+            self.cache.put(key, data)
+        return data
+
+    def read_range(self, path: str, start: int, nbytes: int) -> bytes:
+        """Read a byte range of a file
+
+        Args:
+            path: The path of the file, including its protocol
+            start: The position of the first byte to read
+            nbytes: The number of bytes to read
+        """
+        return self._read_range(path, int(start), int(nbytes))
+
+    def read_ranges(self, ranges: list[tuple[str, int, int]]) -> list[bytes]:
+        """Read many byte ranges at once
+
+        Args:
+            ranges: The path, start and number of bytes of each range
+
+        Returns:
+            The bytes of each range, in the same order
+        """
+        if len(ranges) == 1:
+            return [self.read_range(*ranges[0])]
+        futures = [
+            self.pool.submit(self._read_range, path, int(start), int(nbytes))
+            for path, start, nbytes in ranges
+        ]
+        return [future.result() for future in futures]
+
+    def read_records(self, records: list[tuple[str, int, int]]) -> list[bytes | memoryview]:
+        """Read many records, joining the neighbouring records which are not cached into one read
+
+        Each record is cached on its own, so later reads of the record hit the cache whichever
+        records it is read with.
+
+        Args:
+            records: The path, start and number of bytes of each record
+
+        Returns:
+            The bytes of each record, in the same order
+        """
+        records = [(path, int(start), int(nbytes)) for path, start, nbytes in records]
+        data: list[bytes | memoryview | None] = [None] * len(records)
+        if self.cache is not None:
+            data = [self.cache.get(_get_range_key(*record)) for record in records]
+
+        missing = [i for i, d in enumerate(data) if d is None]
+        if len(missing) == 0:
+            return data
+
+        runs = _coalesce_records(records, missing)
+        blocks = []
+        for run in runs:
+            path, start, _ = records[run[0]]
+            end = max(records[i][1] + records[i][2] for i in run)
+            blocks.append((path, start, end - start))
+
+        if len(blocks) == 1:
+            blocks_data = [self._fetch_range(*blocks[0])]
+        else:
+            futures = [self.pool.submit(self._fetch_range, *block) for block in blocks]
+            blocks_data = [future.result() for future in futures]
+
+        for run, (_, block_start, _), block in zip(runs, blocks, blocks_data):
+            block = memoryview(block)
+            for i in run:
+                _, start, nbytes = records[i]
+                data[i] = block[start - block_start : start - block_start + nbytes]
+                if self.cache is not None:
+                    self.cache.put(_get_range_key(*records[i]), bytes(data[i]))
+        return data
+
+    def read_file(self, path: str) -> bytes:
+        """Read a whole file
+
+        Args:
+            path: The path of the file, including its protocol
+        """
+        if self.cache is not None:
+            data = self.cache.get(path)
+            if data is not None:
+                return data
+
+        data = get_filesystem(path).cat_file(path)
+        if self.cache is not None:
+            self.cache.put(path, data)
+        return data
+
+    @contextlib.contextmanager
+    def local_file(self, path: str):
+        """Context which gives the path of a local copy of a whole file
+
+        The copy keeps the suffix of the file, since the sample classes choose how to load a file
+        from its suffix. It is deleted when the context exits.
+
+        Args:
+            path: The path of the file, including its protocol
+        """
+        data = self.read_file(path)
+        fd, local_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1])
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            yield local_path
+        finally:
+            os.remove(local_path)
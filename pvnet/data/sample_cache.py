@@ -0,0 +1,277 @@
+"""Shared-memory cache of premade samples
+
+Without a cache every epoch re-reads and re-decodes every sample from disk, and each DataLoader
+worker does this independently. `SharedSampleCache` holds pickled samples in a shared-memory arena
+with a fixed byte budget, so a sample loaded by any worker can be served from RAM to all workers in
+later epochs.
+
+The arena is split into equal sized slots. The slot size is set from the first sample stored, with
+some headroom, since premade samples from the same configuration are all close to the same size.
+Samples which are too large for a slot are not cached. When all slots are full the least recently
+used sample is evicted.
+"""
+
+import multiprocessing
+import os
+import pickle
+import weakref
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from ocf_data_sampler.sample.base import NumpySample
+from torch.utils.data import Dataset
+
+from pvnet.data.utils import flatten_sample, is_constant_key, unflatten_sample
+
+# Fraction of extra space added to the size of the first sample to set the slot size
+_SLOT_HEADROOM = 0.25
+
+# Positions of the scalar values at the start of the table
+_SLOT_SIZE, _NUM_SLOTS, _CLOCK, _HITS, _MISSES = range(5)
+_NUM_SCALARS = 5
+
+
+class SharedSampleCache:
+    """Byte-budgeted least-recently-used cache of samples in shared memory
+
+    The cache is created in the main process and can then be passed to DataLoader workers, which
+    all read from and write to the same shared memory.
+
+    Args:
+        max_bytes: The size of the shared-memory arena used to store samples
+        num_samples: The number of samples in the dataset being cached
+    """
+
+    def __init__(self, max_bytes: int, num_samples: int):
+        """Byte-budgeted least-recently-used cache of samples in shared memory"""
+        if max_bytes < 1:
+            raise ValueError(f"`max_bytes` must be positive - got {max_bytes}")
+
+        self.max_bytes = max_bytes
+        self.num_samples = num_samples
+
+        self._arena = SharedMemory(create=True, size=max_bytes)
+        self._table_shm = SharedMemory(
+            create=True, size=(_NUM_SCALARS + 4 * max(num_samples, 1)) * 8
+        )
+        # A lock from the spawn context can be shared with workers started by any method
+        self._lock = multiprocessing.get_context("spawn").Lock()
+        self._attach_table()
+
+        self._table[:] = 0
+        self._sample_slots[:] = -1
+        self._slot_samples[:] = -1
+
+        # Only the process which created the shared memory unlinks it. Forked workers inherit this
+        # object, so the creator's PID is checked too
+        self._finalizer = weakref.finalize(
+            self, _unlink_shared_memory, os.getpid(), self._arena, self._table_shm
+        )
+
+    def _attach_table(self) -> None:
+        n = self.num_samples
+        self._table = np.ndarray(
+            (_NUM_SCALARS + 4 * max(n, 1),), dtype=np.int64, buffer=self._table_shm.buf
+        )
+        tables = self._table[_NUM_SCALARS:]
+        # The slot of each sample, and the sample, last use and size of each slot
+        self._sample_slots = tables[:n]
+        self._slot_samples = tables[n : 2 * n]
+        self._slot_last_used = tables[2 * n : 3 * n]
+        self._slot_nbytes = tables[3 * n : 4 * n]
+
+    def __getstate__(self):
+        # Workers attach to the shared memory by name
+        return dict(
+            max_bytes=self.max_bytes,
+            num_samples=self.num_samples,
+            arena_name=self._arena.name,
+            table_name=self._table_shm.name,
+            lock=self._lock,
+        )
+
+    def __setstate__(self, state):
+        self.max_bytes = state["max_bytes"]
+        self.num_samples = state["num_samples"]
+        self._arena = SharedMemory(name=state["arena_name"])
+        self._table_shm = SharedMemory(name=state["table_name"])
+        self._lock = state["lock"]
+        self._attach_table()
+
+        # The shared memory is owned by the main process, so stop the resource tracker from
+        # unlinking it when this worker exits
+        for shm in [self._arena, self._table_shm]:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        self._finalizer = None
+
+    def close(self) -> None:
+        """Release the shared memory. The cache cannot be used afterwards"""
+        # The arrays viewing the table must be deleted before the shared memory can be closed
+        del self._table, self._sample_slots, self._slot_samples
+        del self._slot_last_used, self._slot_nbytes
+        self._arena.close()
+        self._table_shm.close()
+        if self._finalizer is not None:
+            self._finalizer()
+
+    @property
+    def hits(self) -> int:
+        """The number of samples served from the cache by all processes"""
+        return int(self._table[_HITS])
+
+    @property
+    def misses(self) -> int:
+        """The number of samples not found in the cache by all processes"""
+        return int(self._table[_MISSES])
+
+    @property
+    def nbytes(self) -> int:
+        """The total size of the samples currently held in the cache"""
+        return int(self._slot_nbytes.sum())
+
+    def get_stats(self) -> dict[str, float]:
+        """Get the hit and miss counts, hit rate and used bytes of the cache"""
+        hits, misses = self.hits, self.misses
+        return dict(
+            hits=hits,
+            misses=misses,
+            hit_rate=hits / max(hits + misses, 1),
+            nbytes=self.nbytes,
+        )
+
+    def get(self, idx: int) -> NumpySample | None:
+        """Get a sample from the cache
+
+        Args:
+            idx: The index of the sample in the dataset
+
+        Returns:
+            The sample, or None if it is not in the cache
+        """
+        with self._lock:
+            slot = self._sample_slots[idx]
+            if slot < 0:
+                self._table[_MISSES] += 1
+                return None
+
+            self._table[_HITS] += 1
+            self._table[_CLOCK] += 1
+            self._slot_last_used[slot] = self._table[_CLOCK]
+
+            start = slot * self._table[_SLOT_SIZE]
+            record = bytes(self._arena.buf[start : start + self._slot_nbytes[slot]])
+
+        return pickle.loads(record)
+
+    def put(self, idx: int, sample: NumpySample) -> None:
+        """Store a sample in the cache, evicting the least recently used sample if required
+
+        Args:
+            idx: The index of the sample in the dataset
+            sample: The sample to store
+        """
+        record = pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            if self._table[_SLOT_SIZE] == 0:
+                slot_size = int(len(record) * (1 + _SLOT_HEADROOM))
+                self._table[_SLOT_SIZE] = slot_size
+                self._table[_NUM_SLOTS] = min(self.max_bytes // slot_size, self.num_samples)
+
+            num_slots = self._table[_NUM_SLOTS]
+            if (
+                len(record) > self._table[_SLOT_SIZE]
+                or num_slots == 0
+                or self._sample_slots[idx] >= 0
+            ):
+                return
+
+            # Use a free slot if there is one, else evict the least recently used sample
+            slot = int(np.argmin(self._slot_last_used[:num_slots]))
+            evicted = self._slot_samples[slot]
+            if evicted >= 0:
+                self._sample_slots[evicted] = -1
+
+            start = slot * self._table[_SLOT_SIZE]
+            self._arena.buf[start : start + len(record)] = record
+
+            self._table[_CLOCK] += 1
+            self._slot_last_used[slot] = self._table[_CLOCK]
+            self._slot_nbytes[slot] = len(record)
+            self._slot_samples[slot] = idx
+            self._sample_slots[idx] = slot
+
+
+def _unlink_shared_memory(owner_pid: int, *shms: SharedMemory) -> None:
+    """Unlink the shared memory if this is the process which created it"""
+    if os.getpid() == owner_pid:
+        for shm in shms:
+            shm.unlink()
+
+
+def _unstack_batch(batch: dict, batch_size: int) -> list[NumpySample]:
+    """Split a batch stacked by `stack_np_samples_into_batch()` back into its samples
+
+    The arrays of the samples are views into the arrays of the batch.
+    """
+    flat_batch = flatten_sample(batch)
+    return [
+        unflatten_sample({k: v if is_constant_key(k) else v[i] for k, v in flat_batch.items()})
+        for i in range(batch_size)
+    ]
+
+
+class CachedDataset(Dataset):
+    """Wrapper around a premade samples dataset which caches samples in shared memory
+
+    The cache holds the samples returned by the wrapped dataset, which have their NWP and satellite
+    arrays decoded to float32. So with a float16 or uint8 `image_encoding` each cached sample takes
+    two or four times its size on disk out of the budget.
+
+    Args:
+        dataset: The dataset to wrap
+        max_bytes: The byte budget of the cache
+    """
+
+    def __init__(self, dataset: Dataset, max_bytes: int):
+        """Wrapper around a premade samples dataset which caches samples in shared memory"""
+        self.dataset = dataset
+        self.cache = SharedSampleCache(max_bytes, num_samples=len(dataset))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.cache.get(idx)
+        if sample is None:
+            sample = self.dataset[idx]
+            self.cache.put(idx, sample)
+        return sample
+
+    def __getitems__(self, indices: list[int]) -> list[NumpySample]:
+        """Load a batch of samples, serving those in the cache from memory
+
+        The samples which are not in the cache are loaded together with the `__getitems__()` of
+        the wrapped dataset if it has one, so they can still be read as one block.
+
+        Returns:
+            The samples, which are stacked by the collate function
+        """
+        samples = [self.cache.get(idx) for idx in indices]
+        missing = [i for i, sample in enumerate(samples) if sample is None]
+        if len(missing) == 0:
+            return samples
+
+        missing_indices = [indices[i] for i in missing]
+        if hasattr(self.dataset, "__getitems__"):
+            loaded = self.dataset.__getitems__(missing_indices)
+            if isinstance(loaded, dict):
+                loaded = _unstack_batch(loaded, len(missing_indices))
+        else:
+            loaded = [self.dataset[idx] for idx in missing_indices]
+
+        for i, idx, sample in zip(missing, missing_indices, loaded):
+            self.cache.put(idx, sample)
+            samples[i] = sample
+        return samples
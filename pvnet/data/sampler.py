@@ -0,0 +1,81 @@
+"""Deterministic sampler which can resume part way through an epoch
+
+The order of the samples in each epoch depends only on the seed and the epoch number, so a run
+restarted from a checkpoint sees the same order as the original run. The datamodules store the
+epoch and the number of samples used so far in the checkpoint, and the sampler skips the samples
+which had already been used when the run was stopped.
+
+The samples are split between distributed ranks in the same way as `DistributedSampler`, which
+this subclasses so that Lightning does not replace it. The indices are all drawn in the main
+process, so the order does not depend on the number of dataloader workers.
+"""
+
+from torch.utils.data import Dataset, DistributedSampler
+
+from pvnet.data.packed_samples import _get_rank_and_world_size
+
+
+class ResumableSampler(DistributedSampler):
+    """Deterministic sampler which can resume part way through an epoch
+
+    Args:
+        dataset: The map-style dataset to sample from
+        shuffle: Whether to shuffle the samples each epoch
+        seed: The seed used to shuffle the samples. The same on all ranks
+        drop_last: Whether to drop the last samples so the data splits evenly between ranks,
+            rather than repeating some samples
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        """Deterministic sampler which can resume part way through an epoch"""
+        rank, world_size = _get_rank_and_world_size()
+        super().__init__(
+            dataset,
+            num_replicas=world_size,
+            rank=rank,
+            shuffle=shuffle,
+            seed=seed,
+            drop_last=drop_last,
+        )
+        self._resume_epoch: int | None = None
+        self._resume_index = 0
+        self._resume_started = False
+
+    def resume(self, epoch: int, num_samples_seen: int) -> None:
+        """Skip the samples already used in an epoch the next time that epoch is iterated
+
+        Args:
+            epoch: The epoch which was in progress
+            num_samples_seen: The number of samples of the epoch already used by this rank
+        """
+        self._resume_epoch = epoch
+        self._resume_index = num_samples_seen
+        self._resume_started = False
+
+    def _num_skipped(self) -> int:
+        """The number of samples skipped from the start of the current epoch"""
+        if self._resume_epoch != self.epoch:
+            return 0
+        return min(self._resume_index, self.num_samples)
+
+    def __len__(self) -> int:
+        # Stays shortened until the resumed epoch ends, so the dataloader length and the
+        # Lightning progress bar match the samples actually drawn
+        return self.num_samples - self._num_skipped()
+
+    def __iter__(self):
+        if self._resume_started:
+            # Only the first pass through the resumed epoch is shortened
+            self._resume_epoch = None
+            self._resume_index = 0
+            self._resume_started = False
+        indices = list(super().__iter__())
+        num_skipped = self._num_skipped()
+        self._resume_started = self._resume_epoch == self.epoch
+        return iter(indices[num_skipped:])
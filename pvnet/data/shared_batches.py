@@ -0,0 +1,390 @@
+"""Shared-memory transport of batches from DataLoader workers to the main process
+
+By default each tensor of each batch made in a DataLoader worker is moved into its own block of
+shared memory and a handle to it is pickled and sent to the main process. With many workers this
+opens a very large number of shared memory files. `SharedBatchSlots` instead preallocates one
+shared-memory arena which is split into a fixed number of equal sized slots.
+
+A `SharedBatchCollator` in each worker stacks the samples straight into a free slot and only sends
+the slot number and the layout of the arrays in it. When this is unpickled in the main process, the
+batch arrays are created as views of the slot without copying. The slot is freed once all tensors
+of the batch have been garbage collected, so batches can be held for as long as they are needed.
+
+Each slot is free, being written by a worker, or holding a batch. Batches which were written but
+never read, for example because the dataloader iterator was stopped early, are reclaimed when a
+`SharedBatchDataLoader` starts a new iterator. So are slots left being written by a worker which
+was killed part way through collating a batch.
+
+Slots are released from garbage collection finalizers, which can run while the main process holds
+the lock shared with the workers. Released slots are therefore queued and freed by whichever code
+holds the lock in this process once it is done, rather than waiting for the lock.
+
+Batches which are too large for a slot, or for which no slot is freed within a timeout, are
+collated and sent as normal.
+"""
+
+import contextlib
+import multiprocessing
+import os
+import threading
+import weakref
+from collections import deque
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable
+
+import numpy as np
+from ocf_data_sampler.sample.base import NumpyBatch, NumpySample, TensorBatch, batch_to_tensor
+from torch.utils.data import DataLoader, get_worker_info
+
+from pvnet.data.sample_cache import _unlink_shared_memory
+from pvnet.data.utils import flatten_sample, is_constant_key, unflatten_sample
+
+# The arrays in each slot start at multiples of this many bytes
+_ALIGNMENT = 64
+
+# States of each slot
+_FREE, _WRITING, _WRITTEN = range(3)
+
+# The slots which this process has attached to, by the name of their arena
+_attached_slots: dict[str, "SharedBatchSlots"] = {}
+
+
+def _reset_after_fork() -> None:
+    """Reset the in-process state of the slots in a forked worker
+
+    Another thread of the parent may have held the thread lock when the worker was forked.
+    """
+    for slots in _attached_slots.values():
+        slots._thread_lock = threading.Lock()
+        slots._pending_release = deque()
+        slots._open = set()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class SharedBatchSlots:
+    """A fixed set of preallocated shared-memory slots which batches are written into
+
+    The slots are created in the main process and can then be passed to DataLoader workers.
+
+    Args:
+        num_slots: The number of slots. This should be larger than the number of batches which can
+            be in flight from the workers plus the number held by the trainer
+        slot_bytes: The size of each slot. Batches larger than this are sent as normal
+    """
+
+    def __init__(self, num_slots: int, slot_bytes: int):
+        """A fixed set of preallocated shared-memory slots which batches are written into"""
+        if num_slots < 1:
+            raise ValueError(f"`num_slots` must be positive - got {num_slots}")
+        if slot_bytes < 1:
+            raise ValueError(f"`slot_bytes` must be positive - got {slot_bytes}")
+
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+
+        self._arena = SharedMemory(create=True, size=num_slots * slot_bytes)
+        # The state of each slot and the PID of the process which last acquired it
+        self._table_shm = SharedMemory(create=True, size=2 * num_slots * 8)
+        # Locks from the spawn context can be shared with workers started by any method
+        ctx = multiprocessing.get_context("spawn")
+        self._lock = ctx.Lock()
+        self._num_free = ctx.Semaphore(num_slots)
+        self._attach()
+        self._states[:] = _FREE
+        self._writers[:] = 0
+
+        # Only the process which created the shared memory unlinks it. Forked workers inherit this
+        # object, so the creator's PID is checked too
+        self._finalizer = weakref.finalize(
+            self, _unlink_shared_memory, os.getpid(), self._arena, self._table_shm
+        )
+
+    def _attach(self) -> None:
+        table = np.ndarray((2, self.num_slots), dtype=np.int64, buffer=self._table_shm.buf)
+        self._states, self._writers = table[0], table[1]
+        # The slots holding batches which are open in this process
+        self._open: set[int] = set()
+        # The slots released in this process which have not been freed yet
+        self._pending_release: deque[int] = deque()
+        # Held by the thread of this process which holds the lock shared with the workers
+        self._thread_lock = threading.Lock()
+        _attached_slots[self.name] = self
+
+    def __getstate__(self):
+        # Workers attach to the shared memory by name
+        return dict(
+            num_slots=self.num_slots,
+            slot_bytes=self.slot_bytes,
+            arena_name=self._arena.name,
+            table_name=self._table_shm.name,
+            lock=self._lock,
+            num_free=self._num_free,
+        )
+
+    def __setstate__(self, state):
+        self.num_slots = state["num_slots"]
+        self.slot_bytes = state["slot_bytes"]
+        self._arena = SharedMemory(name=state["arena_name"])
+        self._table_shm = SharedMemory(name=state["table_name"])
+        self._lock = state["lock"]
+        self._num_free = state["num_free"]
+        self._attach()
+
+        # The shared memory is owned by the main process, so stop the resource tracker from
+        # unlinking it when this worker exits
+        for shm in [self._arena, self._table_shm]:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        self._finalizer = None
+
+    @property
+    def name(self) -> str:
+        """The name of the shared-memory arena"""
+        return self._arena.name
+
+    @property
+    def num_free(self) -> int:
+        """The number of free slots"""
+        return int((self._states == _FREE).sum())
+
+    def get_slot(self, slot: int) -> memoryview:
+        """Get the memory of a slot"""
+        start = slot * self.slot_bytes
+        return self._arena.buf[start : start + self.slot_bytes]
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock shared with the workers, then free the slots released meanwhile"""
+        with self._thread_lock, self._lock:
+            yield
+        self._free_pending()
+
+    def _free_pending(self) -> None:
+        """Free the released slots, unless the lock is already held in this process"""
+        while self._pending_release:
+            if not self._thread_lock.acquire(blocking=False):
+                # The holder frees them once it is done
+                return
+            try:
+                with self._lock:
+                    while self._pending_release:
+                        self._free(self._pending_release.popleft())
+            finally:
+                self._thread_lock.release()
+
+    def _free(self, slot: int) -> None:
+        """Free a slot. The lock must be held"""
+        if self._states[slot] != _FREE:
+            self._states[slot] = _FREE
+            self._num_free.release()
+
+    def acquire(self, timeout: float | None = None) -> int | None:
+        """Take a free slot to write a batch into
+
+        Args:
+            timeout: The number of seconds to wait for a slot to be freed. Waits forever if None
+
+        Returns:
+            The slot, or None if no slot was freed in time
+        """
+        if not self._num_free.acquire(timeout=timeout):
+            return None
+        with self._locked():
+            slot = int(np.argmax(self._states == _FREE))
+            self._states[slot] = _WRITING
+            self._writers[slot] = os.getpid()
+        return slot
+
+    def mark_written(self, slot: int) -> None:
+        """Mark that a batch has been written to a slot and is ready to be read"""
+        with self._locked():
+            self._states[slot] = _WRITTEN
+
+    def release(self, slot: int) -> None:
+        """Free a slot so it can be written to again
+
+        This is called when a batch is garbage collected, which can happen while this process
+        holds the lock, so it never waits for the lock.
+        """
+        self._open.discard(slot)
+        self._pending_release.append(slot)
+        self._free_pending()
+
+    def reclaim(self) -> int:
+        """Free the slots of batches which are not open in this process or whose writer has exited
+
+        This should only be called in the main process when no batches are in flight, for example
+        before starting a new dataloader iterator.
+
+        Returns:
+            The number of slots freed
+        """
+        freed = 0
+        with self._locked():
+            for slot in np.flatnonzero(self._states == _WRITTEN):
+                if slot not in self._open:
+                    self._free(slot)
+                    freed += 1
+            # Slots being written by a worker which was killed part way through would never be
+            # freed
+            for slot in np.flatnonzero(self._states == _WRITING):
+                if not _is_process_alive(int(self._writers[slot])):
+                    self._free(slot)
+                    freed += 1
+        return freed
+
+    def open_batch(self, slot: int, layout: dict, values: dict) -> TensorBatch:
+        """Create a batch from the arrays in a slot without copying them
+
+        The slot is released when all of the batch arrays have been garbage collected.
+
+        Args:
+            slot: The slot holding the batch
+            layout: The offset, shape and dtype of each array in the slot by its flattened key
+            values: The other values of the batch by their flattened key
+        """
+        buffer = self.get_slot(slot)
+        self._open.add(slot)
+        # The arrays are all views of this buffer, so it is collected only once they all are
+        weakref.finalize(buffer, self.release, slot)
+
+        flat_batch = dict(values)
+        for key, (offset, shape, dtype) in layout.items():
+            count = int(np.prod(shape))
+            flat_batch[key] = np.frombuffer(
+                buffer, dtype=dtype, count=count, offset=offset
+            ).reshape(shape)
+        return batch_to_tensor(unflatten_sample(flat_batch))
+
+
+def _is_process_alive(pid: int) -> bool:
+    """Check if a process on this machine is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _open_shared_batch(name: str, slot: int, layout: dict, values: dict) -> TensorBatch:
+    """Open a batch written by a worker when it is unpickled in the main process"""
+    return _attached_slots[name].open_batch(slot, layout, values)
+
+
+class _SharedBatch:
+    """A batch written into a slot, which is unpickled as a tensor batch viewing the slot"""
+
+    def __init__(self, slots: SharedBatchSlots, slot: int, layout: dict, values: dict):
+        self.slots = slots
+        self.slot = slot
+        self.layout = layout
+        self.values = values
+
+    def __reduce__(self):
+        return _open_shared_batch, (self.slots.name, self.slot, self.layout, self.values)
+
+
+class SharedBatchCollator:
+    """Collate samples in DataLoader workers straight into shared-memory slots
+
+    Outside of DataLoader workers the samples are collated using `collate_fn` as normal.
+
+    Args:
+        slots: The slots to write the batches into
+        collate_fn: The collate function used outside of workers, and for batches which do not
+            fit in a slot
+        acquire_timeout: The number of seconds to wait for a free slot before sending a batch as
+            normal
+    """
+
+    def __init__(
+        self,
+        slots: SharedBatchSlots,
+        collate_fn: Callable[[list[NumpySample] | NumpyBatch], TensorBatch],
+        acquire_timeout: float = 10.0,
+    ):
+        """Collate samples in DataLoader workers straight into shared-memory slots"""
+        self.slots = slots
+        self.collate_fn = collate_fn
+        self.acquire_timeout = acquire_timeout
+
+    def _stack_values(self, samples: list[NumpySample] | NumpyBatch) -> tuple[dict, dict]:
+        """Split a batch into lists of arrays to stack into the slot, and other values"""
+        if isinstance(samples, dict):
+            arrays, values = {}, {}
+            for key, value in flatten_sample(samples).items():
+                if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.number):
+                    arrays[key] = value
+                else:
+                    values[key] = value
+            return arrays, values
+
+        flat_samples = [flatten_sample(sample) for sample in samples]
+        arrays, values = {}, {}
+        for key, value in flat_samples[0].items():
+            if is_constant_key(key):
+                values[key] = value
+                continue
+            stack = [np.asarray(sample[key]) for sample in flat_samples]
+            first = stack[0]
+            if np.issubdtype(first.dtype, np.number) and all(
+                v.shape == first.shape and v.dtype == first.dtype for v in stack
+            ):
+                arrays[key] = stack
+            else:
+                values[key] = np.stack(stack)
+        return arrays, values
+
+    def _write(self, slot: int, layout: dict, arrays: dict) -> None:
+        """Stack or copy the arrays into a slot"""
+        buffer = self.slots.get_slot(slot)
+        for key, (offset, shape, dtype) in layout.items():
+            out = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset)
+            if isinstance(arrays[key], list):
+                np.stack(arrays[key], out=out.reshape(shape))
+            else:
+                np.copyto(out.reshape(shape), arrays[key])
+
+    def __call__(self, samples: list[NumpySample] | NumpyBatch) -> TensorBatch | _SharedBatch:
+        """Collate a list of samples, or an already stacked batch"""
+        if get_worker_info() is None:
+            return self.collate_fn(samples)
+
+        arrays, values = self._stack_values(samples)
+
+        layout = {}
+        offset = 0
+        for key, value in arrays.items():
+            if isinstance(value, list):
+                shape, dtype = (len(value), *value[0].shape), value[0].dtype
+            else:
+                shape, dtype = value.shape, value.dtype
+            layout[key] = (offset, shape, dtype.str)
+            offset += -(-int(np.prod(shape)) * dtype.itemsize // _ALIGNMENT) * _ALIGNMENT
+
+        if offset > self.slots.slot_bytes:
+            return self.collate_fn(samples)
+        slot = self.slots.acquire(timeout=self.acquire_timeout)
+        if slot is None:
+            return self.collate_fn(samples)
+
+        self._write(slot, layout, arrays)
+        self.slots.mark_written(slot)
+
+        return _SharedBatch(self.slots, slot, layout, values)
+
+
+class SharedBatchDataLoader(DataLoader):
+    """DataLoader which reclaims the shared-memory slots of unread batches for each new iterator
+
+    The `collate_fn` must be a `SharedBatchCollator`.
+    """
+
+    def __iter__(self):
+        # Batches left in flight by earlier iterators will never be read
+        self.collate_fn.slots.reclaim()
+        return super().__iter__()
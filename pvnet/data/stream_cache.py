@@ -0,0 +1,126 @@
+"""Write-through disk cache for streamed samples
+
+Streaming samples with an ocf-data-sampler configuration re-generates every sample from the zarr
+stores in every epoch and every run. `StreamedSampleCache` wraps a streamed dataset and saves each
+sample the first time it is generated. Later requests for the same sample, in later epochs or in
+later runs with the same data configuration, are loaded from the cache instead.
+
+Samples are keyed by their init-time, their GSP or site ID, and a hash of the data configuration,
+so changing the configuration starts a new cache. A cache directory looks like:
+
+    cache_dir/
+        <config hash>/
+            format.json
+            data_configuration.json
+            20230101/
+                20230101T1200_12.bin
+                ...
+            ...
+
+Each sample file is written to a temporary file and then renamed, so the cache can be shared by
+the dataloader workers and by concurrent runs.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import pandas as pd
+from ocf_data_sampler.config import Configuration
+from ocf_data_sampler.sample.base import NumpySample
+from torch.utils.data import Dataset
+
+from pvnet.data.compression import compress_sample, decompress_sample, get_codec
+from pvnet.data.encoding import check_image_encoding, decode_sample, encode_sample
+from pvnet.data.utils import (
+    get_sample_coords,
+    read_sample_format,
+    sample_to_numpy,
+    write_sample_format,
+)
+
+
+def get_config_hash(config: Configuration) -> str:
+    """Get a short hash which identifies a data configuration
+
+    Args:
+        config: The ocf-data-sampler configuration
+    """
+    return hashlib.sha256(config.model_dump_json().encode()).hexdigest()[:16]
+
+
+class StreamedSampleCache(Dataset):
+    """Wrapper around a streamed dataset which caches each generated sample on disk
+
+    Args:
+        dataset: A `PVNetUKRegionalDataset` or `SitesDataset`
+        cache_dir: The directory to store the cached samples in. The samples of each data
+            configuration are stored in their own subdirectory
+        image_encoding: The encoding used to store the NWP and satellite arrays. See
+            `pvnet.data.encoding`
+        codec: The codec used to compress each sample. See `pvnet.data.compression`
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        cache_dir: str,
+        image_encoding: str = "float32",
+        codec: str = "none",
+    ):
+        """Wrapper around a streamed dataset which caches each generated sample on disk"""
+        check_image_encoding(image_encoding)
+        self.dataset = dataset
+        self.sample_dir = f"{cache_dir}/{get_config_hash(dataset.config)}"
+        self.image_encoding = image_encoding
+        self.codec = get_codec(codec)
+
+        sample_format = dict(
+            format="stream_cache",
+            image_encoding=image_encoding,
+            codec=None if self.codec is None else self.codec.get_config(),
+        )
+        os.makedirs(self.sample_dir, exist_ok=True)
+        existing_format = read_sample_format(self.sample_dir)
+        if existing_format is None:
+            write_sample_format(self.sample_dir, sample_format)
+            with open(f"{self.sample_dir}/data_configuration.json", "w") as f:
+                f.write(dataset.config.model_dump_json(indent=4))
+        elif existing_format != sample_format:
+            raise ValueError(
+                f"The cache in {self.sample_dir} was created with format {existing_format}, not "
+                f"{sample_format}"
+            )
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def get_sample_path(self, idx: int) -> str:
+        """Get the path of the cache file for a sample"""
+        t0, target_id = get_sample_coords(self.dataset, idx)
+        t0 = pd.Timestamp(t0)
+        return f"{self.sample_dir}/{t0:%Y%m%d}/{t0:%Y%m%dT%H%M}_{target_id}.bin"
+
+    def _save(self, path: str, sample: NumpySample) -> None:
+        record = compress_sample(encode_sample(sample, self.image_encoding), self.codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Rename a complete temporary file so no process can read a partly written sample
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(record)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def __getitem__(self, idx):
+        path = self.get_sample_path(idx)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                sample = decompress_sample(f.read(), self.codec)
+            return decode_sample(sample, self.image_encoding)
+
+        sample = sample_to_numpy(self.dataset[idx])
+        self._save(path, sample)
+        return sample
@@ -0,0 +1,96 @@
+"""Timing of the stages of the data pipeline
+
+When training is input-bound, the time spent by the dataloader workers in each stage shows where
+to optimise. The datasets and the collate function time these stages:
+
+- read: Reading the premade samples from disk or a remote filesystem
+- to_numpy: Converting one-sample-per-file samples to numpy arrays
+- project: Reducing the samples to the inputs used by the model. See `pvnet.data.projection`
+- decode: Decompressing and decoding premade samples
+- generate: Generating streamed samples from the data configuration, or loading them from the
+    stream cache
+- collate: Stacking the samples into a batch
+- to_tensor: Converting the stacked batch into tensors
+
+A `StageTimer` keeps the total time of each stage for each dataloader worker in shared memory, so
+the main process can read the totals while the workers are running. Timing is off unless a timer
+is passed to the datasets, and then `time_stage()` returns a shared no-op context, so the overhead
+is a single function call per stage.
+"""
+
+import contextlib
+import multiprocessing
+import time
+
+from torch.utils.data import Dataset, get_worker_info
+
+DATA_STAGES = ("read", "to_numpy", "project", "decode", "generate", "collate", "to_tensor")
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class StageTimer:
+    """Total time spent in each stage of the data pipeline by each dataloader worker
+
+    Each worker only adds to its own totals, so no lock is needed.
+
+    Args:
+        num_workers: The number of dataloader workers which use the timer
+    """
+
+    def __init__(self, num_workers: int = 0):
+        """Total time spent in each stage of the data pipeline by each dataloader worker"""
+        self.num_slots = max(num_workers, 1)
+        self._seconds = multiprocessing.RawArray("d", self.num_slots * len(DATA_STAGES))
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        """Context which adds the time spent inside it to the total of a stage"""
+        worker_info = get_worker_info()
+        slot = 0 if worker_info is None else worker_info.id % self.num_slots
+        index = slot * len(DATA_STAGES) + DATA_STAGES.index(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._seconds[index] += time.perf_counter() - start
+
+    def get_seconds(self) -> dict[str, float]:
+        """Get the total seconds spent in each stage, summed over the workers"""
+        n = len(DATA_STAGES)
+        return {stage: sum(self._seconds[i::n]) for i, stage in enumerate(DATA_STAGES)}
+
+
+def time_stage(timer: StageTimer | None, stage: str):
+    """Time a stage of the data pipeline if there is a timer
+
+    Args:
+        timer: The timer to add the time to. Nothing is timed if None
+        stage: The name of the stage. One of `DATA_STAGES`
+    """
+    if timer is None:
+        return _NULL_CONTEXT
+    return timer.time(stage)
+
+
+class TimedDataset(Dataset):
+    """Wrapper around a dataset which times how long each of its samples takes to load
+
+    Args:
+        dataset: The dataset to wrap
+        timer: The timer to add the time to
+        stage: The stage to add the time to
+    """
+
+    def __init__(self, dataset: Dataset, timer: StageTimer, stage: str = "generate"):
+        """Wrapper around a dataset which times how long each of its samples takes to load"""
+        self.dataset = dataset
+        self.timer = timer
+        self.stage = stage
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        with self.timer.time(self.stage):
+            return self.dataset[idx]
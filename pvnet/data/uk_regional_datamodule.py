@@ -4,7 +4,8 @@ from ocf_data_sampler.sample.uk_regional import UKRegionalSample
 from ocf_data_sampler.torch_datasets.datasets.pvnet_uk import PVNetUKRegionalDataset
 from torch.utils.data import Dataset
 
-from pvnet.data.base_datamodule import BaseDataModule, PremadeSamplesDataset
+from pvnet.data.base_datamodule import BaseDataModule, get_premade_samples_dataset
+from pvnet.data.projection import SampleProjection
 
 
 class DataModule(BaseDataModule):
@@ -19,6 +20,22 @@ class DataModule(BaseDataModule):
         prefetch_factor: int | None = None,
         train_period: list[str | None] = [None, None],
         val_period: list[str | None] = [None, None],
+        target_ids: list[int] | None = None,
+        sample_cache_bytes: int | None = None,
+        stream_shards: bool = False,
+        shuffle_buffer_size: int = 1000,
+        projection: SampleProjection | None = None,
+        use_model_input_spec: bool = False,
+        reuse_collate_buffers: bool = False,
+        pin_collate_buffers: bool = False,
+        shared_batch_slot_bytes: int | None = None,
+        prefetch_to_device: int | None = None,
+        stream_cache_dir: str | None = None,
+        resumable_sampler: bool = False,
+        sampler_seed: int = 0,
+        remote_cache_dir: str | None = None,
+        remote_cache_bytes: int | None = None,
+        time_data_stages: bool = False,
     ):
         """Datamodule for training pvnet architecture.
 
@@ -27,12 +44,41 @@ class DataModule(BaseDataModule):
         Args:
             configuration: Path to configuration file.
             sample_dir: Path to the directory of pre-saved samples. Cannot be used together with
-                `configuration` or '[train/val]_period'.
+                `configuration`.
             batch_size: Batch size.
             num_workers: Number of workers to use in multiprocess batch loading.
             prefetch_factor: Number of data will be prefetched at the end of each worker process.
             train_period: Date range filter for train dataloader.
             val_period: Date range filter for val dataloader.
+            target_ids: If set, only use samples for these GSP IDs. With pre-saved samples, the
+                filters require the sample directories to have manifests.
+            sample_cache_bytes: If set, pre-saved samples are cached in shared memory with this
+                byte budget for each of the train and val sets.
+            stream_shards: If True, pre-saved samples in the packed format are streamed from each
+                shard in order with a shuffle buffer, rather than read in a random order.
+            shuffle_buffer_size: The number of samples in the shuffle buffer if `stream_shards`.
+            projection: If set, the samples are reduced to the inputs used by the model inside the
+                dataloader workers.
+            use_model_input_spec: If True, the samples are reduced using the input spec declared
+                by the model being trained.
+            reuse_collate_buffers: If True, batches are stacked into a ring of preallocated,
+                reused tensor buffers rather than allocated for each batch.
+            pin_collate_buffers: If True, the reused collate buffers are pinned. Only used if
+                `reuse_collate_buffers` and `num_workers` is 0.
+            shared_batch_slot_bytes: If set, the dataloader workers send batches through a fixed
+                set of preallocated shared-memory slots of this size.
+            prefetch_to_device: If set, this many batches are copied to the device of the trainer
+                ahead of time on a background thread.
+            stream_cache_dir: If set, each streamed sample is saved to this directory the first
+                time it is generated and loaded from it afterwards.
+            resumable_sampler: If True, the train samples are shuffled deterministically and a run
+                resumed from a checkpoint continues from the next sample of the epoch.
+            sampler_seed: The seed of the resumable sampler.
+            remote_cache_dir: If set and `sample_dir` is on a remote filesystem, what is read from
+                the remote samples is cached in this local directory.
+            remote_cache_bytes: The byte budget of the remote sample cache.
+            time_data_stages: If True, the time the dataloader workers spend in each stage of
+                loading the samples is recorded.
 
         """
         super().__init__(
@@ -43,12 +89,33 @@ class DataModule(BaseDataModule):
             prefetch_factor=prefetch_factor,
             train_period=train_period,
             val_period=val_period,
+            target_ids=target_ids,
+            sample_cache_bytes=sample_cache_bytes,
+            stream_shards=stream_shards,
+            shuffle_buffer_size=shuffle_buffer_size,
+            projection=projection,
+            use_model_input_spec=use_model_input_spec,
+            reuse_collate_buffers=reuse_collate_buffers,
+            pin_collate_buffers=pin_collate_buffers,
+            shared_batch_slot_bytes=shared_batch_slot_bytes,
+            prefetch_to_device=prefetch_to_device,
+            stream_cache_dir=stream_cache_dir,
+            resumable_sampler=resumable_sampler,
+            sampler_seed=sampler_seed,
+            remote_cache_dir=remote_cache_dir,
+            remote_cache_bytes=remote_cache_bytes,
+            time_data_stages=time_data_stages,
         )
 
     def _get_streamed_samples_dataset(self, start_time, end_time) -> Dataset:
-        return PVNetUKRegionalDataset(self.configuration, start_time=start_time, end_time=end_time)
+        return PVNetUKRegionalDataset(
+            self.configuration,
+            start_time=start_time,
+            end_time=end_time,
+            gsp_ids=self.target_ids,
+        )
 
-    def _get_premade_samples_dataset(self, subdir) -> Dataset:
+    def _get_premade_samples_dataset(self, subdir, **kwargs) -> Dataset:
         split_dir = f"{self.sample_dir}/{subdir}"
         # Returns a dict of np arrays
-        return PremadeSamplesDataset(split_dir, UKRegionalSample)
+        return get_premade_samples_dataset(split_dir, UKRegionalSample, **kwargs)
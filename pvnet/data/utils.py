@@ -0,0 +1,177 @@
+"""Utility functions shared by the premade sample formats"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from ocf_data_sampler.sample.base import NumpySample
+from ocf_data_sampler.torch_datasets.datasets.pvnet_uk import PVNetUKRegionalDataset
+from ocf_data_sampler.torch_datasets.datasets.site import SitesDataset
+from torch.utils.data import Dataset
+
+from pvnet.data.remote import get_filesystem, is_remote_path
+
+# Name of the file which describes the storage format of a premade sample directory. Directories
+# without this file hold one sample per file, as saved by `scripts/save_samples.py`
+FORMAT_FILENAME = "format.json"
+
+
+def sample_to_numpy(sample: NumpySample) -> NumpySample:
+    """Convert any torch tensors inside a (nested) sample into numpy arrays
+
+    Args:
+        sample: Sample which may contain a mix of numpy arrays and torch tensors
+    """
+    numpy_sample = {}
+    for k, v in sample.items():
+        if isinstance(v, dict):
+            numpy_sample[k] = sample_to_numpy(v)
+        elif isinstance(v, torch.Tensor):
+            numpy_sample[k] = v.numpy()
+        else:
+            numpy_sample[k] = v
+    return numpy_sample
+
+
+def flatten_sample(sample: NumpySample, prefix: str = "") -> dict:
+    """Flatten a nested sample into a single dictionary with "/" separated keys
+
+    For example `sample["nwp"]["ukv"]["nwp"]` is stored under the key "nwp/ukv/nwp".
+
+    Args:
+        sample: The (nested) sample to flatten
+        prefix: Prefix to add to all keys
+    """
+    flat_sample = {}
+    for k, v in sample.items():
+        if isinstance(v, dict):
+            flat_sample.update(flatten_sample(v, prefix=f"{prefix}{k}/"))
+        else:
+            flat_sample[f"{prefix}{k}"] = v
+    return flat_sample
+
+
+def unflatten_sample(flat_sample: dict) -> NumpySample:
+    """Reverse `flatten_sample()`
+
+    Args:
+        flat_sample: Dictionary with "/" separated keys
+    """
+    sample = {}
+    for key, v in flat_sample.items():
+        *parents, leaf = key.split("/")
+        d = sample
+        for parent in parents:
+            d = d.setdefault(parent, {})
+        d[leaf] = v
+    return sample
+
+
+def is_constant_key(key: str) -> bool:
+    """Check if a key is for a value which is the same for all samples
+
+    These values are not stacked when samples are collated into a batch. This matches the rule used
+    by `ocf_data_sampler.numpy_sample.collate`.
+    """
+    return key.endswith("t0_idx") or key.endswith("channel_names")
+
+
+def get_sample_coords(dataset: Dataset, idx: int) -> tuple[pd.Timestamp, int]:
+    """Get the init-time and location ID of a sample in a streamed dataset without generating it
+
+    Args:
+        dataset: A `PVNetUKRegionalDataset` or `SitesDataset`
+        idx: Index of the sample in the dataset
+    """
+    if isinstance(dataset, PVNetUKRegionalDataset):
+        t_index, loc_index = dataset.index_pairs[idx]
+        return dataset.valid_t0_times[t_index], int(dataset.locations[loc_index].id)
+    elif isinstance(dataset, SitesDataset):
+        t0, site_id = dataset.valid_t0_and_site_ids.iloc[idx]
+        return pd.Timestamp(t0), int(site_id)
+    else:
+        raise ValueError(f"Cannot get sample coordinates from dataset type {type(dataset)}")
+
+
+def get_all_sample_coords(dataset: Dataset) -> pd.DataFrame:
+    """Get the init-times and location IDs of all samples in a streamed dataset
+
+    Args:
+        dataset: A `PVNetUKRegionalDataset` or `SitesDataset`
+
+    Returns:
+        Dataframe with columns "t0" and "target_id", in the order of the samples in the dataset
+    """
+    if isinstance(dataset, PVNetUKRegionalDataset):
+        t_index, loc_index = np.asarray(dataset.index_pairs).reshape(-1, 2).T
+        location_ids = np.array([int(location.id) for location in dataset.locations])
+        t0 = pd.DatetimeIndex(dataset.valid_t0_times)[t_index]
+        target_id = location_ids[loc_index]
+    elif isinstance(dataset, SitesDataset):
+        t0_and_site_ids = dataset.valid_t0_and_site_ids
+        t0 = pd.to_datetime(t0_and_site_ids.iloc[:, 0].values)
+        target_id = t0_and_site_ids.iloc[:, 1].values.astype(int)
+    else:
+        raise ValueError(f"Cannot get sample coordinates from dataset type {type(dataset)}")
+    return pd.DataFrame({"t0": t0, "target_id": target_id})
+
+
+class IndexedDataset(Dataset):
+    """Wrapper around a dataset which returns the index of each sample along with the sample
+
+    Args:
+        dataset: The dataset to wrap
+    """
+
+    def __init__(self, dataset: Dataset):
+        """Wrapper around a dataset which returns the index of each sample along with the sample"""
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return idx, self.dataset[idx]
+
+
+def read_sample_format(sample_dir: str) -> dict | None:
+    """Read the format description of a premade sample directory
+
+    Args:
+        sample_dir: Path to the directory of premade samples
+
+    Returns:
+        The format description, or None if the directory holds one sample per file
+    """
+    path = f"{sample_dir}/{FORMAT_FILENAME}"
+    if is_remote_path(path):
+        fs = get_filesystem(path)
+        if not fs.isfile(path):
+            return None
+        with fs.open(path, "r") as f:
+            return json.load(f)
+
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_sample_format(sample_dir: str, sample_format: dict) -> None:
+    """Write the format description of a premade sample directory
+
+    Args:
+        sample_dir: Path to the directory of premade samples
+        sample_format: Dictionary describing the format. Must include the key "format"
+    """
+    with open(f"{sample_dir}/{FORMAT_FILENAME}", "w") as f:
+        json.dump(sample_format, f, indent=4, default=_json_default)
+
+
+def _json_default(obj):
+    """Make numpy scalars JSON serialisable"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj)} is not JSON serialisable")
@@ -20,6 +20,7 @@ from huggingface_hub.file_download import hf_hub_download
 from huggingface_hub.hf_api import HfApi
 from ocf_datapipes.batch import copy_batch_to_device
 
+from pvnet.data.projection import SampleProjection
 from pvnet.models.utils import (
     BatchAccumulator,
     MetricAccumulator,
@@ -412,6 +413,23 @@ class BaseModel(pl.LightningModule, PVNetModelHubMixin):
         # save all validation results to array, so we can save these to weights n biases
         self.validation_epoch_results = []
 
+    def get_input_schema(self) -> dict[str, tuple[int | None, ...] | None] | None:
+        """Declare the batch keys read by the model and the shape of each for a single sample
+
+        The keys are flattened batch keys like "nwp/ukv/nwp". Dimensions which can vary are None,
+        as is the whole shape if it is not fixed. Models which do not declare their inputs return
+        None.
+        """
+        return None
+
+    def get_input_spec(self) -> SampleProjection | None:
+        """Declare how the datamodules should reduce samples to the inputs used by the model
+
+        By default all keys which are not in the input schema are dropped.
+        """
+        schema = self.get_input_schema()
+        return None if schema is None else SampleProjection(keys=list(schema))
+
     def transfer_batch_to_device(self, batch, device, dataloader_idx):
         """Method to move custom batches to a given device"""
         return copy_batch_to_device(batch, device)
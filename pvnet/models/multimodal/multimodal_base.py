@@ -1,25 +1,123 @@
 """Base model class for multimodal model and unimodal teacher"""
 from torchvision.transforms.functional import center_crop
 
+from pvnet.data.projection import ImageProjection, SampleProjection
 from pvnet.models.base_model import BaseModel
 
 
 class MultimodalBaseModel(BaseModel):
     """Base model class for multimodal model and unimodal teacher"""
 
+    def _get_series_len(self) -> int:
+        """Get the number of time steps of the target time series used by the model
+
+        This includes the ignored forecast steps, which the sun and time features still cover.
+        """
+        return self.forecast_len + self.forecast_len_ignore + self.history_len + 1
+
+    def get_input_schema(self) -> dict[str, tuple[int | None, ...] | None] | None:
+        """Declare the batch keys read by the model and the shape of each for a single sample
+
+        The shapes are those after `_adapt_batch()`. Returns None if one of the site encoders does
+        not declare the keys it reads.
+        """
+        key = self._target_key
+        series_len = self._get_series_len()
+
+        schema = {
+            key: (None,),
+            f"{key}_id": (),
+            f"{key}_t0_idx": (),
+            f"{key}_time_utc": (None,),
+        }
+
+        if self.include_sat:
+            size = self.sat_encoder.image_size_pixels
+            schema["satellite_actual"] = (self.sat_sequence_len, None, size, size)
+
+        if self.include_nwp:
+            for nwp_source, encoder in self.nwp_encoders_dict.items():
+                size = encoder.image_size_pixels
+                schema[f"nwp/{nwp_source}/nwp"] = (encoder.sequence_length, None, size, size)
+
+        site_encoders = [
+            self.pv_encoder if self.include_pv else None,
+            self.sensor_encoder if self.include_sensor else None,
+        ]
+        for encoder in site_encoders:
+            if encoder is None:
+                continue
+            input_keys = encoder.get_input_keys()
+            if input_keys is None:
+                return None
+            for input_key in input_keys:
+                schema.setdefault(input_key, None)
+
+        if self.include_sun:
+            for s in ["solar_azimuth", "solar_elevation"]:
+                schema[f"{key}_{s}"] = (series_len,)
+
+        if self.include_time:
+            for s in ["date_sin", "date_cos", "time_sin", "time_cos"]:
+                schema[f"{key}_{s}"] = (series_len,)
+
+        return schema
+
+    def get_input_spec(self) -> SampleProjection:
+        """Declare how the datamodules should reduce samples to the inputs used by the model
+
+        This drops the keys which are not in the input schema and applies the same time slices
+        and crops as `_adapt_batch()`. The datamodules apply it to each sample in the dataloader
+        workers, so batches already have the shapes which `_adapt_batch()` would slice them to.
+        """
+        nwp = {}
+        if self.include_nwp:
+            for nwp_source, encoder in self.nwp_encoders_dict.items():
+                nwp[nwp_source] = ImageProjection(
+                    image_size_pixels=encoder.image_size_pixels,
+                    sequence_length=encoder.sequence_length,
+                )
+
+        satellite = None
+        if self.include_sat:
+            satellite = ImageProjection(
+                image_size_pixels=self.sat_encoder.image_size_pixels,
+                sequence_length=self.sat_sequence_len,
+            )
+
+        series_len = self._get_series_len()
+        series = {"gsp": series_len, "gsp_time_utc": series_len}
+        if self.include_sun:
+            for s in ["solar_azimuth", "solar_elevation"]:
+                series[f"{self._target_key}_{s}"] = series_len
+
+        schema = self.get_input_schema()
+        return SampleProjection(
+            nwp=nwp,
+            satellite=satellite,
+            include_satellite=self.include_sat,
+            series=series,
+            keys=None if schema is None else list(schema),
+        )
+
     def _adapt_batch(self, batch):
         """Slice batches into appropriate shapes for model
 
+        The GSP and sun series keep the ignored forecast steps, so the last `forecast_len` steps of
+        the GSP series are the target, as they are for batches which are not adapted.
+
         We make some specific assumptions about the original batch and the derived sliced batch:
         - We are only limiting the future projections. I.e. we are never shrinking the batch from
           the left hand side of the time axis, only slicing it from the right
         - We are only shrinking the spatial crop of the satellite and NWP data
 
+        If the datamodule applied `get_input_spec()` to the samples, the batch already has these
+        shapes and this has no effect.
         """
 
         if "gsp" in batch.keys():
             # Slice off the end of the GSP data
-            gsp_len = self.forecast_len + self.history_len + 1
+            gsp_len = self._get_series_len()
             batch["gsp"] = batch["gsp"][:, :gsp_len]
             batch["gsp_time_utc"] = batch["gsp_time_utc"][:, :gsp_len]
 
@@ -45,7 +143,7 @@ class MultimodalBaseModel(BaseModel):
             for s in ["solar_azimuth", "solar_elevation"]:
                 key = f"{self._target_key}_{s}"
                 if key in batch.keys():
-                    sun_len = self.forecast_len + self.history_len + 1
+                    sun_len = self._get_series_len()
                     batch[key] = batch[key][:, :sun_len]
 
         return batch
@@ -29,6 +29,13 @@ class AbstractSitesEncoder(nn.Module, metaclass=ABCMeta):
         self.num_sites = num_sites
         self.out_features = out_features
 
+    def get_input_keys(self) -> list[str] | None:
+        """Get the flattened batch keys which the encoder reads
+
+        Returns None if the encoder does not declare its inputs.
+        """
+        return None
+
     @abstractmethod
     def forward(self):
         """Run model forward"""
@@ -205,6 +205,14 @@ class SingleAttentionNetwork(AbstractSitesEncoder):
             batch_first=True,
         )
 
+    def get_input_keys(self) -> list[str]:
+        """Get the flattened batch keys which the encoder reads"""
+        if self.target_key_to_use == "gsp":
+            id_key = f"{self.target_key_to_use}_id"
+        else:
+            id_key = f"{self.input_key_to_use}_id"
+        return [self.input_key_to_use, id_key]
+
     def _encode_inputs(self, x):
         # Shape: [batch size, sequence length, number of sites]
         # Shape: [batch size,  station_id, sequence length,  channels]
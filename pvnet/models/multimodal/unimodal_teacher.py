@@ -98,6 +98,8 @@ class Model(MultimodalBaseModel):
         self.include_sat = False
         self.include_nwp = False
         self.include_pv = False
+        self.include_sensor = False
+        self.include_time = False
         self.adapt_batches = adapt_batches
 
         # This is set but modified later based on the teachers
@@ -36,6 +36,7 @@ import xarray as xr
 from ocf_datapipes.batch import (
     BatchKey,
     NumpyBatch,
+    TensorBatch,
     batch_to_tensor,
     copy_batch_to_device,
 )
@@ -53,6 +54,7 @@ from torch.utils.data import DataLoader
 from torch.utils.data.datapipes.iter import IterableWrapper
 from tqdm import tqdm
 
+from pvnet.data.prefetch import DevicePrefetcher
 from pvnet.load_model import get_model_from_checkpoints
 
 # ------------------------------------------------------------------
@@ -232,11 +234,14 @@ class ModelPipe:
         self.summation_model = summation_model
         self.ds_gsp = ds_gsp
 
-    def predict_batch(self, batch: NumpyBatch) -> xr.Dataset:
+    def predict_batch(
+        self, batch: NumpyBatch, device_batch: TensorBatch | None = None
+    ) -> xr.Dataset:
         """Run the batch through the model and compile the predictions into an xarray DataArray
 
         Args:
             batch: A batch of samples with inputs for each GSP for the same init-time
+            device_batch: The batch already copied to the device. Copied here if not given
 
         Returns:
             xarray.Dataset of all GSP and national forecasts for the batch
@@ -278,7 +283,8 @@ class ModelPipe:
 
         with torch.no_grad():
             # Run batch through model to get 0-1 predictions for all GSPs
-            device_batch = copy_batch_to_device(batch_to_tensor(batch), device)
+            if device_batch is None:
+                device_batch = copy_batch_to_device(batch_to_tensor(batch), device)
             y_normed_gsp = model(device_batch).detach().cpu().numpy()
 
         da_normed_gsp = preds_to_dataarray(y_normed_gsp, model, valid_times, ALL_GSP_IDS)
@@ -409,11 +415,14 @@ def main(config: DictConfig):
     # Create object to make predictions for each input batch
     model_pipe = ModelPipe(model, summation_model, ds_gsp)
 
+    # Copy the next batches to the device in the background while predicting
+    prefetcher = DevicePrefetcher(dataloader, device, keep_host_batch=True)
+
     # Loop through the batches
     pbar = tqdm(total=num_batches)
-    for i, batch in zip(range(num_batches), dataloader):
+    for i, (batch, device_batch) in zip(range(num_batches), prefetcher):
         # Make predictions for the init-time
-        ds_abs_all = model_pipe.predict_batch(batch)
+        ds_abs_all = model_pipe.predict_batch(batch, device_batch)
 
         t0 = ds_abs_all.init_time_utc.values[0]
 
@@ -425,7 +434,7 @@ def main(config: DictConfig):
 
     # Close down
     pbar.close()
-    del dataloader
+    del prefetcher, dataloader
 
 
 if __name__ == "__main__":
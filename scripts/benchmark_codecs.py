@@ -0,0 +1,123 @@
+"""Command line tool to compare the compression codecs for packed sample shards
+
+For each codec this packs a subset of a sample directory and reports:
+
+- ratio: The uncompressed size divided by the compressed size
+- encode_MBps: Uncompressed megabytes compressed per second on one core
+- decode_MBps: Uncompressed megabytes decompressed per second on one core
+- samples_per_sec: Samples per second loaded end-to-end through a DataLoader
+
+Codecs are given as the codec name with an optional compression level after a colon.
+
+use:
+```
+python benchmark_codecs.py "/mnt/disks/samples_v0/train" \
+    --renewable="pv_uk" \
+    --codecs="none" --codecs="lz4" --codecs="zstd:3" --codecs="zstd:9" --codecs="blosc" \
+    --num-samples=256 \
+    --batch-size=8 \
+    --num-workers=4
+```
+"""
+
+import tempfile
+import time
+
+import pandas as pd
+import typer
+from ocf_data_sampler.sample.site import SiteSample
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+from torch.utils.data import DataLoader
+
+from pvnet.data.base_datamodule import collate_fn, get_premade_samples_dataset
+from pvnet.data.compression import compress_sample, decompress_sample, get_codec
+from pvnet.data.packed_samples import PackedSamplesDataset, PackedSampleWriter
+from pvnet.data.utils import sample_to_numpy
+
+
+def benchmark_codec(
+    samples: list[dict],
+    codec_spec: str,
+    batch_size: int,
+    num_workers: int,
+) -> dict:
+    """Benchmark one codec on a list of numpy samples"""
+    name, _, level = codec_spec.partition(":")
+    codec = get_codec(name, int(level) if level else None)
+
+    raw_nbytes = sum(len(compress_sample(sample, None)) for sample in samples)
+
+    start = time.perf_counter()
+    records = [compress_sample(sample, codec) for sample in samples]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for record in records:
+        decompress_sample(record, codec)
+    decode_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writer = PackedSampleWriter(
+            tmp_dir, codec=name, compression_level=int(level) if level else None
+        )
+        with writer:
+            for sample in samples:
+                writer.write(sample)
+
+        dataloader = DataLoader(
+            PackedSamplesDataset(tmp_dir),
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+        )
+        start = time.perf_counter()
+        for _ in dataloader:
+            pass
+        load_time = time.perf_counter() - start
+
+    return dict(
+        codec=codec_spec,
+        ratio=raw_nbytes / sum(len(record) for record in records),
+        encode_MBps=raw_nbytes / encode_time / 1e6,
+        decode_MBps=raw_nbytes / decode_time / 1e6,
+        samples_per_sec=len(samples) / load_time,
+    )
+
+
+def main(
+    sample_dir: str,
+    renewable: str = "pv_uk",
+    codecs: list[str] = ["none", "lz4", "zstd:1", "zstd:3", "zstd:9", "blosc"],
+    num_samples: int = 256,
+    batch_size: int = 8,
+    num_workers: int = 0,
+):
+    """Compare the compression ratio and speed of the codecs on a premade sample directory
+
+    Args:
+        sample_dir: Path to a directory of premade samples in any format
+        renewable: The renewable type of the samples. One of "pv_uk" or "site"
+        codecs: The codecs to benchmark, e.g. "zstd:3" for zstd with compression level 3
+        num_samples: The number of samples to benchmark with
+        batch_size: Batch size used in the end-to-end loading benchmark
+        num_workers: Number of dataloader workers used in the end-to-end loading benchmark
+    """
+    if renewable == "pv_uk":
+        sample_class = UKRegionalSample
+    elif renewable == "site":
+        sample_class = SiteSample
+    else:
+        raise ValueError(f"Unknown renewable: {renewable}")
+
+    dataset = get_premade_samples_dataset(sample_dir, sample_class)
+    samples = [sample_to_numpy(dataset[i]) for i in range(min(num_samples, len(dataset)))]
+
+    results = pd.DataFrame(
+        [benchmark_codec(samples, codec, batch_size, num_workers) for codec in codecs]
+    )
+    print(results.to_string(index=False, float_format="{:.2f}".format))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,299 @@
+"""Command line tool to measure how fast a datamodule can feed the model
+
+This iterates the train and val dataloaders of a datamodule config without a model, for each
+combination of `num_workers` and `prefetch_factor`, and reports:
+
+- samples_per_sec: Samples per second delivered to the main process, after the first batch
+- startup_s: Seconds until the first batch arrived, including starting the workers
+- fetch_ms: Mean worker time to load the samples of a batch, including reading and decoding them
+- collate_fn_ms: Mean worker time in the collate function for each batch
+- <stage>_ms: Mean worker time per batch in each stage of the data pipeline, such as read_ms,
+    project_ms, decode_ms and collate_ms. See `pvnet.data.timing`
+- transfer_ms: Mean time to copy a batch to the device
+- wait_ms: Mean time the main process waited for each batch. The model would be idle for this long
+- worker_idle: Fraction of the time the workers were not loading or collating batches
+- peak_rss_MB: Peak resident memory of the main process plus the peaks of each worker. The main
+    process peak is over the whole benchmark so far
+
+The datamodule is built from its config with the `num_workers` and `prefetch_factor` overridden.
+Everything else, such as `stream_shards`, `projection`, `shared_batch_slot_bytes`,
+`resumable_sampler` and `prefetch_to_device`, is used as configured. With `prefetch_to_device` the
+batches arrive already on the device, so transfer_ms only counts what is left to copy.
+
+use:
+```
+python scripts/benchmark_dataloader.py "configs/datamodule/premade_batches.yaml" \
+    --num-workers=0 --num-workers=4 --num-workers=8 \
+    --prefetch-factors=2 --prefetch-factors=4 \
+    --num-batches=100
+```
+"""
+
+import multiprocessing
+import resource
+import time
+
+import hydra
+import pandas as pd
+import torch
+import typer
+from lightning.fabric.utilities.apply_func import move_data_to_device
+from omegaconf import OmegaConf
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from pvnet.data.base_datamodule import BaseDataModule
+from pvnet.data.prefetch import DevicePrefetcher
+from pvnet.data.timing import StageTimer
+from pvnet.data.utils import flatten_sample
+
+_STAGES = ["fetch", "collate_fn"]
+
+
+def _worker_id() -> int:
+    worker_info = get_worker_info()
+    return 0 if worker_info is None else worker_info.id
+
+
+class _StageTimes:
+    """Time spent in each stage by each dataloader worker, kept in shared memory
+
+    Each worker only writes to its own entries, so no lock is needed.
+    """
+
+    def __init__(self, num_workers: int):
+        n = max(num_workers, 1)
+        self.seconds = multiprocessing.RawArray("d", n * len(_STAGES))
+        self.num_batches = multiprocessing.RawArray("q", n)
+        self.peak_rss = multiprocessing.RawArray("q", n)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.seconds[_worker_id() * len(_STAGES) + _STAGES.index(stage)] += seconds
+
+    def total(self, stage: str) -> float:
+        return sum(self.seconds[_STAGES.index(stage) :: len(_STAGES)])
+
+
+class _TimedDataset(Dataset):
+    """Wrapper around a map-style dataset which times how long its samples take to load"""
+
+    def __init__(self, dataset: Dataset, times: _StageTimes):
+        self.dataset = dataset
+        self.times = times
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        start = time.perf_counter()
+        sample = self.dataset[idx]
+        self.times.add("fetch", time.perf_counter() - start)
+        return sample
+
+    def __getitems__(self, indices: list[int]):
+        start = time.perf_counter()
+        if hasattr(self.dataset, "__getitems__"):
+            samples = self.dataset.__getitems__(indices)
+        else:
+            samples = [self.dataset[idx] for idx in indices]
+        self.times.add("fetch", time.perf_counter() - start)
+        return samples
+
+
+class _TimedIterableDataset(IterableDataset):
+    """Wrapper around an iterable dataset which times how long its samples take to load"""
+
+    def __init__(self, dataset: IterableDataset, times: _StageTimes):
+        self.dataset = dataset
+        self.times = times
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        samples = iter(self.dataset)
+        while True:
+            start = time.perf_counter()
+            try:
+                sample = next(samples)
+            except StopIteration:
+                return
+            self.times.add("fetch", time.perf_counter() - start)
+            yield sample
+
+
+class _TimedCollate:
+    """Wrapper around a collate function which times it and records the peak memory of the worker"""
+
+    def __init__(self, collate_fn, times: _StageTimes):
+        self.collate_fn = collate_fn
+        self.times = times
+
+    def __call__(self, samples):
+        start = time.perf_counter()
+        batch = self.collate_fn(samples)
+        self.times.add("collate_fn", time.perf_counter() - start)
+
+        worker_id = _worker_id()
+        self.times.num_batches[worker_id] += 1
+        # On Linux the peak resident memory is reported in kilobytes
+        self.times.peak_rss[worker_id] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return batch
+
+    @property
+    def slots(self):
+        """The shared-memory slots of a wrapped `SharedBatchCollator`"""
+        return self.collate_fn.slots
+
+
+def _get_batch_size(batch) -> int:
+    return next(
+        v.shape[0]
+        for v in flatten_sample(batch).values()
+        if isinstance(v, torch.Tensor) and v.ndim > 0
+    )
+
+
+def benchmark_dataloader(
+    datamodule: BaseDataModule,
+    split: str,
+    num_batches: int,
+    device: torch.device,
+) -> dict:
+    """Time the loading of batches from one of the dataloaders of a datamodule
+
+    Args:
+        datamodule: The datamodule to benchmark
+        split: One of "train" or "val"
+        num_batches: The number of batches to load
+        device: The device to copy the batches to
+    """
+    if split == "train":
+        period, shuffle = datamodule.train_period, True
+    elif split == "val":
+        period, shuffle = datamodule.val_period, False
+    else:
+        raise ValueError(f"Unknown split: {split}")
+
+    num_workers = datamodule._common_dataloader_kwargs["num_workers"]
+    times = _StageTimes(num_workers)
+    stage_timer = StageTimer(num_workers)
+
+    # Build the dataloader the same way as the datamodule, but with the loading steps timed
+    dataset = datamodule._get_split_dataset(split, period, shuffle=shuffle, stage_timer=stage_timer)
+    if isinstance(dataset, IterableDataset):
+        dataset = _TimedIterableDataset(dataset, times)
+        shuffle = False
+    else:
+        dataset = _TimedDataset(dataset, times)
+    sampler = None
+    if split == "train" and datamodule.resumable_sampler and shuffle:
+        sampler = datamodule._get_train_sampler(dataset)
+    dataloader = datamodule._get_dataloader(
+        dataset, shuffle=shuffle, sampler=sampler, stage_timer=stage_timer
+    )
+    # The shared batch dataloader reads the slots through the collate function
+    dataloader.collate_fn = _TimedCollate(dataloader.collate_fn, times)
+    if datamodule.prefetch_to_device is not None:
+        dataloader = DevicePrefetcher(dataloader, device, num_batches=datamodule.prefetch_to_device)
+
+    start = time.perf_counter()
+    batches = iter(dataloader)
+    startup_time = timed_start = None
+    wait_time = transfer_time = 0.0
+    num_samples = num_loaded = 0
+    for _ in range(num_batches + 1):
+        wait_start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            break
+        transfer_start = time.perf_counter()
+        device_batch = move_data_to_device(batch, device)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        transfer_end = time.perf_counter()
+
+        # The first batch includes starting the workers, so is reported separately
+        if startup_time is None:
+            startup_time = transfer_start - start
+            timed_start = transfer_end
+        else:
+            wait_time += transfer_start - wait_start
+            transfer_time += transfer_end - transfer_start
+            num_samples += _get_batch_size(batch)
+            num_loaded += 1
+        del batch, device_batch
+
+    end = time.perf_counter()
+    # Shut down the workers before reading their times
+    del batches
+
+    if startup_time is None:
+        raise ValueError(f"The {split} dataloader has no batches")
+
+    num_collated = max(sum(times.num_batches), 1)
+    busy_time = times.total("fetch") + times.total("collate_fn")
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if num_workers > 0:
+        peak_rss += sum(times.peak_rss)
+
+    return dict(
+        split=split,
+        num_workers=num_workers,
+        prefetch_factor=datamodule._common_dataloader_kwargs["prefetch_factor"],
+        samples_per_sec=num_samples / (end - timed_start) if num_loaded else float("nan"),
+        startup_s=startup_time,
+        fetch_ms=1e3 * times.total("fetch") / num_collated,
+        collate_fn_ms=1e3 * times.total("collate_fn") / num_collated,
+        **{
+            f"{stage}_ms": 1e3 * seconds / num_collated
+            for stage, seconds in stage_timer.get_seconds().items()
+        },
+        transfer_ms=1e3 * transfer_time / max(num_loaded, 1),
+        wait_ms=1e3 * wait_time / max(num_loaded, 1),
+        worker_idle=1 - busy_time / (num_workers * (end - start)) if num_workers else float("nan"),
+        peak_rss_MB=peak_rss / 1e6,
+    )
+
+
+def main(
+    datamodule_config: str,
+    num_workers: list[int] = [0, 4],
+    prefetch_factors: list[int] = [2],
+    num_batches: int = 50,
+    splits: list[str] = ["train", "val"],
+    device: str | None = None,
+):
+    """Measure the throughput of the dataloaders of a datamodule config without a model
+
+    Args:
+        datamodule_config: Path to a datamodule config yaml, such as those in
+            `configs.example/datamodule`
+        num_workers: The numbers of dataloader workers to benchmark
+        prefetch_factors: The prefetch factors to benchmark. Only used with workers
+        num_batches: The number of batches to load from each dataloader, after the first batch
+        splits: The dataloaders to benchmark
+        device: The device to copy the batches to. Defaults to CUDA if it is available
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+
+    config = OmegaConf.load(datamodule_config)
+
+    results = []
+    for workers in num_workers:
+        for prefetch_factor in prefetch_factors if workers > 0 else [None]:
+            datamodule = hydra.utils.instantiate(
+                config, num_workers=workers, prefetch_factor=prefetch_factor
+            )
+            for split in splits:
+                print(f"Benchmarking {split}: num_workers={workers}, prefetch={prefetch_factor}")
+                results.append(benchmark_dataloader(datamodule, split, num_batches, device))
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False, float_format="{:.2f}".format))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,91 @@
+"""Command line tool to convert a directory of presaved samples into packed shards or memmaps
+
+Packing reduces the number of files in a sample directory and lets the training datamodules read
+many samples from each open file. The memmap format stores each key in one contiguous array so
+samples can be loaded without copying.
+
+use:
+```
+python pack_samples.py "/mnt/disks/samples_v0" "/mnt/disks/samples_v0_packed" \
+    --renewable="pv_uk" \
+    --sample-format="packed" \
+    --samples-per-shard=1024 \
+    --image-encoding="float16" \
+    --codec="zstd" \
+    --compression-level=3
+```
+"""
+
+import os
+
+import typer
+from ocf_data_sampler.sample.site import SiteSample
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.data.encoding import check_image_encoding
+from pvnet.data.memmap_samples import convert_to_memmap
+from pvnet.data.packed_samples import pack_samples
+
+
+def main(
+    sample_dir: str,
+    output_dir: str,
+    renewable: str = "pv_uk",
+    sample_format: str = "packed",
+    samples_per_shard: int = 1024,
+    image_encoding: str = "float32",
+    codec: str = "none",
+    compression_level: int | None = None,
+):
+    """Pack the train and val samples of a presaved sample directory
+
+    Args:
+        sample_dir: Path to the sample directory containing train and val subdirectories
+        output_dir: Path to the new directory of packed samples
+        renewable: The renewable type of the samples. One of "pv_uk" or "site"
+        sample_format: The format to pack the samples into. One of "packed" or "memmap"
+        samples_per_shard: Number of samples to store in each shard file. Only used for the
+            "packed" format
+        image_encoding: The encoding used to store the NWP and satellite arrays. One of "float32",
+            "float16", "bfloat16", "uint8" or "uint16"
+        codec: The codec used to compress each sample. One of "none", "lz4", "zstd" or "blosc".
+            Only used for the "packed" format
+        compression_level: The compression level of the codec. Uses the codec default if not set
+    """
+    if renewable == "pv_uk":
+        sample_class = UKRegionalSample
+    elif renewable == "site":
+        sample_class = SiteSample
+    else:
+        raise ValueError(f"Unknown renewable: {renewable}")
+
+    if sample_format not in ["packed", "memmap"]:
+        raise ValueError(f"Unknown sample format: {sample_format}")
+    check_image_encoding(image_encoding)
+
+    os.makedirs(output_dir, exist_ok=False)
+
+    for subdir in ["train", "val"]:
+        if os.path.isdir(f"{sample_dir}/{subdir}"):
+            print(f"----- Packing {subdir} samples -----")
+            if sample_format == "packed":
+                pack_samples(
+                    f"{sample_dir}/{subdir}",
+                    f"{output_dir}/{subdir}",
+                    sample_class,
+                    samples_per_shard=samples_per_shard,
+                    image_encoding=image_encoding,
+                    codec=codec,
+                    compression_level=compression_level,
+                )
+            else:
+                convert_to_memmap(
+                    f"{sample_dir}/{subdir}",
+                    f"{output_dir}/{subdir}",
+                    sample_class,
+                    image_encoding=image_encoding,
+                )
+
+
+if __name__ == "__main__":
+    typer.run(main)
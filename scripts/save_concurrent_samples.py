@@ -14,6 +14,15 @@ python save_concurrent_samples.py \
     +datamodule.num_val_samples=20
 ```
 
+To split the work between several processes or machines which share a filesystem, run the same
+command in each of them with `+datamodule.work_ledger=True`. Each process claims blocks of
+`ledger_block_size` init-times from a ledger in the sample directory until all are saved, and the
+last process to finish writes a manifest of the samples. See `pvnet.data.ledger`.
+
+With `+datamodule.deduplicate_crops=True` the NWP and satellite crops of all GSPs are stored once
+as the part of the field which covers them, with the position of each crop. This makes the samples
+much smaller. They can be loaded with `pvnet.data.concurrent_samples.load_concurrent_sample()`,
+which rebuilds the crops.
 """
 # Ensure this block of code runs only in the main process to avoid issues with worker processes.
 if __name__ == "__main__":
@@ -44,6 +53,9 @@ from sqlalchemy import exc as sa_exc
 from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 
+from pvnet.data.concurrent_samples import DeduplicatedConcurrentDataset
+from pvnet.data.ledger import save_samples_with_ledger
+from pvnet.data.manifest import get_config_sources
 from pvnet.utils import print_config
 
 # ------- filter warning and set up config  -------
@@ -64,9 +76,15 @@ class SaveFuncFactory:
         """Factory for creating a function to save a sample to disk."""
         self.save_dir = save_dir
 
-    def __call__(self, sample, sample_num: int):
-        """Save a sample to disk"""
-        torch.save(sample, f"{self.save_dir}/{sample_num:08}.pt")
+    def __call__(self, sample, sample_num: int, save_dir: str | None = None) -> str:
+        """Save a sample to disk and return its filename
+
+        The sample is saved in `save_dir` if set, rather than the directory of the factory.
+        """
+        check_sample(sample)
+        filename = f"{save_dir or self.save_dir}/{sample_num:08}.pt"
+        torch.save(sample, filename)
+        return filename
 
 
 def save_samples_with_dataloader(
@@ -74,15 +92,47 @@ def save_samples_with_dataloader(
     save_dir: str,
     num_samples: int,
     dataloader_kwargs: dict,
+    work_ledger: bool = False,
+    ledger_block_size: int = 16,
+    deduplicate_crops: bool = False,
 ) -> None:
-    """Save samples from a dataset using a dataloader."""
+    """Save samples from a dataset using a dataloader.
+
+    Args:
+        dataset: The dataset to save samples from
+        save_dir: The directory to save the samples to
+        num_samples: The number of samples to save
+        dataloader_kwargs: Keyword arguments for the dataloader
+        work_ledger: Whether to share the work with other processes saving to the same directory
+            through a ledger
+        ledger_block_size: The number of samples in each block claimed from the ledger
+        deduplicate_crops: Whether to store the NWP and satellite crops of all GSPs as the part of
+            the field which covers them. See `pvnet.data.concurrent_samples`
+    """
     save_func = SaveFuncFactory(save_dir)
+    generation_dataset = DeduplicatedConcurrentDataset(dataset) if deduplicate_crops else dataset
+
+    if work_ledger:
+        sources = get_config_sources(dataset.config)
+
+        def get_manifest_row(idx):
+            return dict(t0=dataset.valid_t0_times[idx], sources=sources)
+
+        save_samples_with_ledger(
+            generation_dataset,
+            save_dir,
+            num_samples,
+            dataloader_kwargs,
+            save_func=save_func,
+            get_manifest_row=get_manifest_row,
+            block_size=ledger_block_size,
+        )
+        return
 
-    dataloader = DataLoader(dataset, **dataloader_kwargs)
+    dataloader = DataLoader(generation_dataset, **dataloader_kwargs)
 
     pbar = tqdm(total=num_samples)
     for i, sample in zip(range(num_samples), dataloader):
-        check_sample(sample)
         save_func(sample, i)
         pbar.update()
     pbar.close()
@@ -103,8 +153,10 @@ def main(config: DictConfig) -> None:
 
     print_config(config, resolve=False)
 
-    # Set up directory
-    os.makedirs(config_dm.sample_output_dir, exist_ok=False)
+    work_ledger = config_dm.get("work_ledger", False)
+
+    # Set up directory. Processes sharing a ledger all use the same directory
+    os.makedirs(config_dm.sample_output_dir, exist_ok=work_ledger)
 
     # Copy across configs which define the samples into the new sample directory
     with open(f"{config_dm.sample_output_dir}/datamodule.yaml", "w") as f:
@@ -136,7 +188,7 @@ def main(config: DictConfig) -> None:
         val_output_dir = f"{config_dm.sample_output_dir}/val"
 
         # Make directory for val samples
-        os.mkdir(val_output_dir)
+        os.makedirs(val_output_dir, exist_ok=work_ledger)
 
         # Get the dataset
         val_dataset = PVNetUKConcurrentDataset(
@@ -151,6 +203,9 @@ def main(config: DictConfig) -> None:
             save_dir=val_output_dir,
             num_samples=config_dm.num_val_samples,
             dataloader_kwargs=dataloader_kwargs,
+            work_ledger=work_ledger,
+            ledger_block_size=config_dm.get("ledger_block_size", 16),
+            deduplicate_crops=config_dm.get("deduplicate_crops", False),
         )
 
         del val_dataset
@@ -161,7 +216,7 @@ def main(config: DictConfig) -> None:
         train_output_dir = f"{config_dm.sample_output_dir}/train"
 
         # Make directory for train samples
-        os.mkdir(train_output_dir)
+        os.makedirs(train_output_dir, exist_ok=work_ledger)
 
         # Get the dataset
         train_dataset = PVNetUKConcurrentDataset(
@@ -176,6 +231,9 @@ def main(config: DictConfig) -> None:
             save_dir=train_output_dir,
             num_samples=config_dm.num_train_samples,
             dataloader_kwargs=dataloader_kwargs,
+            work_ledger=work_ledger,
+            ledger_block_size=config_dm.get("ledger_block_size", 16),
+            deduplicate_crops=config_dm.get("deduplicate_crops", False),
         )
 
         del train_dataset
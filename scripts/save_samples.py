@@ -16,9 +16,26 @@ python save_samples.py \
     +datamodule.num_train_samples=0 \
     +datamodule.num_val_samples=2 \
     datamodule.num_workers=2 \
-    datamodule.prefetch_factor=2
+    datamodule.prefetch_factor=2 \
+    +datamodule.num_writers=4
 ```
-if wanting to override these values for example
+if wanting to override these values for example.
+
+To continue an interrupted run, or to top up an existing sample directory with more samples, run
+again with the same data configuration and `+datamodule.resume=True`. The samples already listed in
+the manifests are kept and counted towards `num_train_samples` and `num_val_samples`, and only new
+(init-time, location) pairs are generated.
+
+To split the work between several processes or machines which share a filesystem, run the same
+command in each of them with `+datamodule.work_ledger=True`. Each process claims blocks of
+`ledger_block_size` samples from a ledger in the sample directory until all are saved, and the last
+process to finish writes the manifest. See `pvnet.data.ledger`.
+
+By default the samples are generated in a random order, so each one reads its own chunks of the
+NWP and satellite stores. With `+datamodule.generation_order=time` the samples are chosen at random
+as before, but generated grouped by init-time, and the data for each init-time is loaded once for
+all of its locations. The manifest is shuffled at the end, so the saved samples are still read in
+a random order. See `pvnet.data.locality`.
 """
 
 # Ensure this block of code runs only in the main process to avoid issues with worker processes.
@@ -35,22 +52,51 @@ if __name__ == "__main__":
     mp.set_sharing_strategy("file_system")
 
 
+import filecmp
+import itertools
 import logging
 import os
 import shutil
 import sys
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import dask
 import hydra
+import numpy as np
+import pandas as pd
 from ocf_data_sampler.sample.site import SiteSample
 from ocf_data_sampler.sample.uk_regional import UKRegionalSample
 from ocf_data_sampler.torch_datasets.datasets import PVNetUKRegionalDataset, SitesDataset
 from omegaconf import DictConfig, OmegaConf
 from sqlalchemy import exc as sa_exc
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Subset
 from tqdm import tqdm
 
+from pvnet.data.encoding import check_image_encoding, encode_sample
+from pvnet.data.ledger import save_samples_with_ledger
+from pvnet.data.locality import (
+    TimeCachedDataset,
+    collate_sample_list,
+    get_time_blocks,
+    sort_indices_by_time,
+)
+from pvnet.data.manifest import (
+    SampleManifestWriter,
+    get_config_sources,
+    get_sample_paths,
+    load_manifest,
+    shuffle_manifest,
+)
+from pvnet.data.utils import (
+    IndexedDataset,
+    get_all_sample_coords,
+    get_sample_coords,
+    read_sample_format,
+    sample_to_numpy,
+    write_sample_format,
+)
 from pvnet.utils import print_config
 
 dask.config.set(scheduler="threads", num_workers=4)
@@ -70,14 +116,22 @@ logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
 class SaveFuncFactory:
     """Factory for creating a function to save a sample to disk."""
 
-    def __init__(self, save_dir: str, renewable: str = "pv_uk"):
+    def __init__(self, save_dir: str, renewable: str = "pv_uk", image_encoding: str = "float32"):
         """Factory for creating a function to save a sample to disk."""
+        check_image_encoding(image_encoding)
+        if renewable == "site" and image_encoding != "float32":
+            raise ValueError("Site samples can only be saved with the float32 image encoding")
+
         self.save_dir = save_dir
         self.renewable = renewable
+        self.image_encoding = image_encoding
+
+    def __call__(self, sample, sample_num: int, save_dir: str | None = None) -> str:
+        """Save a sample to disk and return its filename
 
-    def __call__(self, sample, sample_num: int):
-        """Save a sample to disk"""
-        save_path = f"{self.save_dir}/{sample_num:08}"
+        The sample is saved in `save_dir` if set, rather than the directory of the factory.
+        """
+        save_path = f"{save_dir or self.save_dir}/{sample_num:08}"
 
         if self.renewable == "pv_uk":
             sample_class = UKRegionalSample()
@@ -87,9 +141,14 @@ class SaveFuncFactory:
             filename = f"{save_path}.nc"
         else:
             raise ValueError(f"Unknown renewable: {self.renewable}")
+
+        if self.image_encoding != "float32":
+            sample = encode_sample(sample_to_numpy(sample), self.image_encoding)
+
         # Assign data and save
         sample_class._data = sample
         sample_class.save(filename)
+        return filename
 
 
 def get_dataset(
@@ -106,23 +165,189 @@ def get_dataset(
     return dataset_cls(config_path, start_time=start_time, end_time=end_time)
 
 
+def get_unsaved_indices(dataset: Dataset, manifest: pd.DataFrame) -> np.ndarray:
+    """Get the indices of the samples in a dataset which are not already listed in a manifest"""
+    coords = get_all_sample_coords(dataset)
+    saved = pd.MultiIndex.from_arrays([manifest["t0"], manifest["target_id"]])
+    is_saved = pd.MultiIndex.from_arrays([coords["t0"], coords["target_id"]]).isin(saved)
+    return np.flatnonzero(~is_saved)
+
+
 def save_samples_with_dataloader(
     dataset: Dataset,
     save_dir: str,
     num_samples: int,
     dataloader_kwargs: dict,
     renewable: str = "pv_uk",
+    image_encoding: str = "float32",
+    num_writers: int = 4,
+    max_pending_writes: int | None = None,
+    resume: bool = False,
+    work_ledger: bool = False,
+    ledger_block_size: int = 256,
+    generation_order: str = "random",
+    time_block_size: int = 32,
 ) -> None:
-    """Save samples from a dataset using a dataloader."""
-    save_func = SaveFuncFactory(save_dir, renewable=renewable)
+    """Save samples from a dataset using a dataloader.
+
+    The samples are written by a pool of background threads, so writing them to disk overlaps with
+    generating the next samples. If the writers fall behind, the loop waits for the oldest write
+    to finish before taking more samples from the dataloader. A manifest of the saved samples is
+    written alongside them, in the order the samples were generated.
+
+    If resuming, the samples already listed in the manifest of `save_dir` count towards
+    `num_samples`. New samples are numbered after them and are drawn only from the samples of the
+    dataset which have not been saved yet.
+
+    If the generation order is "time", the samples are chosen at random but generated grouped by
+    init-time, and the data for each init-time is loaded once for a block of up to
+    `time_block_size` locations. The manifest is shuffled once all samples are saved.
+
+    Args:
+        dataset: The dataset to save samples from
+        save_dir: The directory to save the samples to
+        num_samples: The number of samples to save
+        dataloader_kwargs: Keyword arguments for the dataloader
+        renewable: The renewable type of the samples. One of "pv_uk" or "site"
+        image_encoding: The precision used to store the NWP and satellite arrays
+        num_writers: The number of threads writing samples to disk
+        max_pending_writes: The maximum number of samples waiting to be written. Defaults to twice
+            `num_writers`
+        resume: Whether to keep the samples already saved in `save_dir` and add to them
+        work_ledger: Whether to share the work with other processes saving to the same directory
+            through a ledger. This is resumable without setting `resume`
+        ledger_block_size: The number of samples in each block claimed from the ledger
+        generation_order: The order to generate the samples in. One of "random" or "time"
+        time_block_size: The maximum number of samples for one init-time generated together by a
+            dataloader worker if the generation order is "time"
+    """
+    if num_writers < 1:
+        raise ValueError(f"`num_writers` must be positive - got {num_writers}")
+    if resume and work_ledger:
+        raise ValueError("Cannot use `resume` with `work_ledger`, which resumes by itself")
+    if generation_order not in ["random", "time"]:
+        raise ValueError(f"Unknown generation order: {generation_order}")
+    if max_pending_writes is None:
+        max_pending_writes = 2 * num_writers
+
+    save_func = SaveFuncFactory(save_dir, renewable=renewable, image_encoding=image_encoding)
+    sample_format = dict(format="files", image_encoding=image_encoding)
+
+    # All samples hold the same data sources
+    sources = get_config_sources(dataset.config)
+
+    if work_ledger:
+        write_sample_format(save_dir, sample_format)
+
+        def get_manifest_row(idx):
+            t0, target_id = get_sample_coords(dataset, idx)
+            return dict(t0=t0, target_id=target_id, sources=sources)
+
+        order = None
+        generation_dataset = dataset
+        if generation_order == "time":
+            # Every process chooses the same samples, since the ledger seed is fixed
+            chosen = np.random.default_rng(0).permutation(len(dataset))[:num_samples]
+            order = sort_indices_by_time(dataset, chosen)
+            generation_dataset = TimeCachedDataset(dataset)
+
+        save_samples_with_ledger(
+            generation_dataset,
+            save_dir,
+            num_samples,
+            dataloader_kwargs,
+            save_func=save_func,
+            get_manifest_row=get_manifest_row,
+            block_size=ledger_block_size,
+            seed=0,
+            num_writers=num_writers,
+            order=order,
+        )
+        return
 
-    dataloader = DataLoader(dataset, **dataloader_kwargs)
+    saved_manifest = load_manifest(save_dir) if resume else None
+    if saved_manifest is None and resume and len(get_sample_paths(save_dir)) > 0:
+        raise ValueError(
+            f"Cannot resume saving to {save_dir} since it has no manifest. One can be created "
+            "using `pvnet.data.manifest.create_manifest()`"
+        )
+    num_saved = 0 if saved_manifest is None else len(saved_manifest)
 
-    pbar = tqdm(total=num_samples)
-    for i, sample in zip(range(num_samples), dataloader):
-        save_func(sample, i)
-        pbar.update()
-    pbar.close()
+    if num_saved > 0 and read_sample_format(save_dir) != sample_format:
+        raise ValueError(
+            f"The samples in {save_dir} were saved with format {read_sample_format(save_dir)}, not "
+            f"{sample_format}"
+        )
+    write_sample_format(save_dir, sample_format)
+
+    if num_saved >= num_samples:
+        print(f"{num_saved} samples are already saved in {save_dir}")
+        return
+
+    if generation_order == "random":
+        # Return the index of each sample so we can look up its coordinates for the manifest
+        indexed_dataset = IndexedDataset(dataset)
+        if num_saved > 0:
+            # Do not generate the samples which have already been saved again
+            indexed_dataset = Subset(indexed_dataset, get_unsaved_indices(dataset, saved_manifest))
+        samples = DataLoader(indexed_dataset, **dataloader_kwargs)
+    else:
+        if num_saved > 0:
+            indices = get_unsaved_indices(dataset, saved_manifest)
+        else:
+            indices = np.arange(len(dataset))
+        # Choose the samples at random, then generate them grouped by init-time
+        chosen = np.random.default_rng().permutation(indices)[: num_samples - num_saved]
+        dataloader_kwargs = dict(
+            dataloader_kwargs,
+            batch_size=1,
+            shuffle=False,
+            sampler=None,
+            batch_sampler=get_time_blocks(dataset, chosen, time_block_size),
+            collate_fn=collate_sample_list,
+        )
+        dataloader = DataLoader(IndexedDataset(TimeCachedDataset(dataset)), **dataloader_kwargs)
+        samples = itertools.chain.from_iterable(dataloader)
+
+    generated_pbar = tqdm(total=num_samples, initial=num_saved, desc="Generated", position=0)
+    written_pbar = tqdm(total=num_samples, initial=num_saved, desc="Written", position=1)
+
+    # The dataset index and pending write of each sample, oldest first
+    pending_writes = deque()
+
+    def finish_oldest_write():
+        idx, future = pending_writes.popleft()
+        filename = future.result()
+        t0, target_id = get_sample_coords(dataset, idx)
+        manifest.write(
+            path=os.path.basename(filename),
+            nbytes=os.path.getsize(filename),
+            t0=t0,
+            target_id=target_id,
+            sources=sources,
+        )
+        written_pbar.update()
+
+    with SampleManifestWriter(save_dir) as manifest:
+        with ThreadPoolExecutor(num_writers) as writers:
+            for i, (idx, sample) in zip(range(num_saved, num_samples), samples):
+                pending_writes.append((idx, writers.submit(save_func, sample, i)))
+                generated_pbar.update()
+                # Record the finished writes, and wait for the oldest if too many are pending
+                while pending_writes and (
+                    pending_writes[0][1].done() or len(pending_writes) > max_pending_writes
+                ):
+                    finish_oldest_write()
+
+            while pending_writes:
+                finish_oldest_write()
+
+    generated_pbar.close()
+    written_pbar.close()
+
+    if generation_order == "time":
+        # The samples were saved in time order, so shuffle the order they are read in
+        shuffle_manifest(save_dir)
 
 
 @hydra.main(config_path="../configs/", config_name="config.yaml", version_base="1.2")
@@ -132,16 +357,29 @@ def main(config: DictConfig) -> None:
 
     print_config(config, resolve=False)
 
-    # Set up directory
-    os.makedirs(config_dm.sample_output_dir, exist_ok=False)
+    resume = config_dm.get("resume", False)
+    work_ledger = config_dm.get("work_ledger", False)
+
+    # Set up directory. Processes sharing a ledger all use the same directory
+    os.makedirs(config_dm.sample_output_dir, exist_ok=resume or work_ledger)
+
+    # Samples can only be added to a directory made with the same data configuration
+    data_config_path = f"{config_dm.sample_output_dir}/data_configuration.yaml"
+    if os.path.isfile(data_config_path) and not filecmp.cmp(
+        config_dm.configuration, data_config_path, shallow=False
+    ):
+        raise ValueError(
+            f"Cannot resume saving to {config_dm.sample_output_dir} since its samples were made "
+            "with a different data configuration"
+        )
 
     # Copy across configs which define the samples into the new sample directory
     with open(f"{config_dm.sample_output_dir}/datamodule.yaml", "w") as f:
         f.write(OmegaConf.to_yaml(config_dm))
 
-    shutil.copyfile(
-        config_dm.configuration, f"{config_dm.sample_output_dir}/data_configuration.yaml"
-    )
+    # Copied atomically, since other processes sharing a ledger may be comparing against it
+    shutil.copyfile(config_dm.configuration, f"{data_config_path}.{os.getpid()}.tmp")
+    os.replace(f"{data_config_path}.{os.getpid()}.tmp", data_config_path)
 
     # Define the keywargs going into the train and val dataloaders
     dataloader_kwargs = dict(
@@ -165,7 +403,7 @@ def main(config: DictConfig) -> None:
         val_output_dir = f"{config_dm.sample_output_dir}/val"
 
         # Make directory for val samples
-        os.mkdir(val_output_dir)
+        os.makedirs(val_output_dir, exist_ok=resume or work_ledger)
 
         # Get the dataset
         val_dataset = get_dataset(
@@ -181,6 +419,13 @@ def main(config: DictConfig) -> None:
             num_samples=config_dm.num_val_samples,
             dataloader_kwargs=dataloader_kwargs,
             renewable=config.renewable,
+            image_encoding=config_dm.get("image_encoding", "float32"),
+            num_writers=config_dm.get("num_writers", 4),
+            resume=resume,
+            work_ledger=work_ledger,
+            ledger_block_size=config_dm.get("ledger_block_size", 256),
+            generation_order=config_dm.get("generation_order", "random"),
+            time_block_size=config_dm.get("time_block_size", 32),
         )
 
         del val_dataset
@@ -191,7 +436,7 @@ def main(config: DictConfig) -> None:
         train_output_dir = f"{config_dm.sample_output_dir}/train"
 
         # Make directory for train samples
-        os.mkdir(train_output_dir)
+        os.makedirs(train_output_dir, exist_ok=resume or work_ledger)
 
         # Get the dataset
         train_dataset = get_dataset(
@@ -207,6 +452,13 @@ def main(config: DictConfig) -> None:
             num_samples=config_dm.num_train_samples,
             dataloader_kwargs=dataloader_kwargs,
             renewable=config.renewable,
+            image_encoding=config_dm.get("image_encoding", "float32"),
+            num_writers=config_dm.get("num_writers", 4),
+            resume=resume,
+            work_ledger=work_ledger,
+            ledger_block_size=config_dm.get("ledger_block_size", 256),
+            generation_order=config_dm.get("generation_order", "random"),
+            time_block_size=config_dm.get("time_block_size", 32),
         )
 
         del train_dataset
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import torch
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+from torch.utils.data import DataLoader
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset, collate_fn
+from pvnet.data.collate import BufferedCollator
+from pvnet.data.utils import flatten_sample
+
+SAMPLE_DIR = "tests/test_data/presaved_samples_uk_regional/train"
+
+
+@pytest.fixture()
+def samples():
+    dataset = PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)
+    return [dataset[i] for i in range(4)]
+
+
+def _assert_batches_equal(batch, expected):
+    batch, expected = flatten_sample(batch), flatten_sample(expected)
+    assert set(batch) == set(expected)
+    for key, value in expected.items():
+        if isinstance(value, torch.Tensor):
+            assert torch.equal(batch[key], value)
+        else:
+            np.testing.assert_array_equal(batch[key], value)
+
+
+def test_buffered_collator_matches_collate_fn(samples):
+    collator = BufferedCollator(ring_size=2)
+    _assert_batches_equal(collator(samples[:2]), collate_fn(samples[:2]))
+    # A smaller batch uses part of the buffers
+    _assert_batches_equal(collator(samples[2:3]), collate_fn(samples[2:3]))
+
+
+def test_buffered_collator_reuses_buffers(samples):
+    collator = BufferedCollator(ring_size=2)
+    pointers = [collator(samples[:2])["gsp"].data_ptr() for _ in range(3)]
+
+    # The ring of two buffers is reused on the third batch
+    assert pointers[0] != pointers[1]
+    assert pointers[0] == pointers[2]
+
+
+def test_buffered_collator_stacked_batch():
+    collator = BufferedCollator(ring_size=2)
+    dataset = PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)
+    _assert_batches_equal(
+        collator(dataset.__getitems__([0, 1])), collate_fn(dataset.__getitems__([0, 1]))
+    )
+
+
+def test_buffered_collator_multiprocessing():
+    dataset = PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=2,
+        num_workers=2,
+        prefetch_factor=1,
+        collate_fn=BufferedCollator(ring_size=3),
+    )
+
+    n = 0
+    for batch in dataloader:
+        # Each batch is copied before the buffer is reused, as when it is moved to the device
+        batch = {k: v.clone() for k, v in batch.items() if isinstance(v, torch.Tensor)}
+        n += len(batch["gsp"])
+    assert n == len(dataset)
+
+
+def test_datamodule_reuse_collate_buffers():
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+        reuse_collate_buffers=True,
+    )
+    dataloader = dm.val_dataloader()
+    assert isinstance(dataloader.collate_fn, BufferedCollator)
+    batch = next(iter(dataloader))
+    assert batch["gsp"].shape[0] == 2
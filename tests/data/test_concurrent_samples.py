@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+import xarray as xr
+
+from pvnet.data.concurrent_samples import (
+    ConcurrentSamplesDataset,
+    CropStack,
+    deduplicate_concurrent_sample,
+    deduplicate_crops,
+    get_crop_offsets,
+    load_concurrent_sample,
+)
+
+
+def _make_crops(field: np.ndarray, offsets: np.ndarray, crop_shape: tuple) -> np.ndarray:
+    return np.stack(
+        [field[tuple(slice(o, o + s) for o, s in zip(offset, crop_shape))] for offset in offsets]
+    )
+
+
+def _make_sample():
+    rng = np.random.default_rng(0)
+    nwp_field = rng.random((3, 2, 20, 20)).astype(np.float32)
+    nwp_offsets = np.array([[0, 0, 2, 3], [0, 0, 5, 4], [0, 0, 9, 11]])
+    sat_field = rng.random((4, 1, 30, 30)).astype(np.float32)
+    sat_offsets = np.array([[0, 0, 10, 12], [0, 0, 11, 12], [0, 0, 14, 15]])
+
+    sample = {
+        "nwp": {
+            "ukv": {
+                "nwp": _make_crops(nwp_field, nwp_offsets, (3, 2, 6, 6)),
+                "nwp_channel_names": np.array(["t", "dswrf"]),
+            }
+        },
+        "satellite_actual": _make_crops(sat_field, sat_offsets, (4, 1, 8, 8)),
+        "gsp_id": np.arange(1, 4),
+    }
+    crop_offsets = {"nwp/ukv/nwp": nwp_offsets, "satellite_actual": sat_offsets}
+    return sample, crop_offsets
+
+
+def test_get_crop_offsets():
+    field = xr.DataArray(
+        np.zeros((2, 10, 12)),
+        dims=["step", "x_osgb", "y_osgb"],
+        coords={"x_osgb": np.arange(10) * 2.0, "y_osgb": np.arange(12) * 3.0},
+    )
+    crop = field.isel(x_osgb=slice(4, 8), y_osgb=slice(1, 5))
+    np.testing.assert_array_equal(get_crop_offsets(field, crop), [0, 4, 1])
+
+
+def test_deduplicate_crops():
+    field = np.arange(20 * 20).reshape(20, 20)
+    offsets = np.array([[3, 4], [5, 5], [10, 2]])
+    crops = _make_crops(field, offsets, (4, 4))
+
+    dedup_field, dedup_offsets = deduplicate_crops(crops, offsets)
+    # Only the part of the field covering the crops is kept
+    assert dedup_field.shape == (11, 7)
+    np.testing.assert_array_equal(dedup_offsets.min(axis=0), [0, 0])
+
+    crop_stack = CropStack(dedup_field, dedup_offsets, (4, 4))
+    assert crop_stack.shape == crops.shape
+    np.testing.assert_array_equal(crop_stack.stack(), crops)
+    np.testing.assert_array_equal(crop_stack[1], crops[1])
+    np.testing.assert_array_equal(crop_stack[[0, 2]], crops[[0, 2]])
+
+
+def test_load_concurrent_sample(tmp_path):
+    sample, crop_offsets = _make_sample()
+    dedup_sample = deduplicate_concurrent_sample(sample, crop_offsets)
+    assert "nwp" not in dedup_sample["nwp"]["ukv"]
+    assert "satellite_actual" not in dedup_sample
+
+    # Saved as tensors, as by the dataloader in save_concurrent_samples.py
+    torch.save(torch.utils.data.default_convert(dedup_sample), f"{tmp_path}/00000000.pt")
+    torch.save(torch.utils.data.default_convert(sample), f"{tmp_path}/00000001.pt")
+
+    for lazy in [False, True]:
+        dataset = ConcurrentSamplesDataset(str(tmp_path), lazy=lazy)
+        assert len(dataset) == 2
+        for loaded in dataset:
+            nwp, sat = loaded["nwp"]["ukv"]["nwp"], loaded["satellite_actual"]
+            if lazy and isinstance(nwp, CropStack):
+                nwp, sat = nwp.stack(), sat.stack()
+            np.testing.assert_array_equal(np.asarray(nwp), sample["nwp"]["ukv"]["nwp"])
+            np.testing.assert_array_equal(np.asarray(sat), sample["satellite_actual"])
+            np.testing.assert_array_equal(np.asarray(loaded["gsp_id"]), sample["gsp_id"])
+
+    lazy_sample = load_concurrent_sample(f"{tmp_path}/00000000.pt", lazy=True)
+    assert isinstance(lazy_sample["satellite_actual"], CropStack)
+    assert lazy_sample["satellite_actual"].shape == sample["satellite_actual"].shape
@@ -0,0 +1,110 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset
+from pvnet.data.encoding import decode_sample, encode_sample
+from pvnet.data.memmap_samples import MemmapSamplesDataset, convert_to_memmap
+from pvnet.data.packed_samples import pack_samples
+from pvnet.data.utils import sample_to_numpy, write_sample_format
+
+SAMPLE_DIR = "tests/test_data/presaved_samples_uk_regional/train"
+
+# Maximum error relative to the range of each image
+TOLERANCES = dict(float32=0, float16=1e-3, bfloat16=1e-2, uint8=1e-2, uint16=1e-4)
+
+
+@pytest.fixture()
+def sample():
+    return sample_to_numpy(PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)[0])
+
+
+def _check_close(decoded, sample, image_encoding):
+    for x, y in [
+        (decoded["satellite_actual"], sample["satellite_actual"]),
+        (decoded["nwp"]["ukv"]["nwp"], sample["nwp"]["ukv"]["nwp"]),
+    ]:
+        assert x.dtype == np.float32
+        tolerance = TOLERANCES[image_encoding] * (y.max() - y.min())
+        np.testing.assert_allclose(x, y, atol=tolerance, rtol=0)
+
+
+@pytest.mark.parametrize("image_encoding", list(TOLERANCES))
+def test_encode_decode(sample, image_encoding):
+    encoded = encode_sample(sample, image_encoding)
+
+    if image_encoding != "float32":
+        assert len(pickle.dumps(encoded)) < len(pickle.dumps(sample)) * 0.6
+    assert encoded["gsp_id"] == sample["gsp_id"]
+
+    _check_close(decode_sample(encoded, image_encoding), sample, image_encoding)
+
+
+@pytest.mark.parametrize("image_encoding", ["float16", "bfloat16", "uint8", "uint16"])
+def test_encode_decode_nan(image_encoding):
+    x = np.random.default_rng(0).uniform(-5, 5, size=(3, 2, 4, 4)).astype(np.float32)
+    x[0, 0, 1, 2] = np.nan
+    # A channel which is all NaN
+    x[:, 1] = np.nan
+    # A NaN with a payload which would round up to inf
+    x[1, 0, 0, 0] = np.array(0x7F800001, dtype=np.uint32).view(np.float32)
+
+    sample = {"satellite_actual": x}
+    decoded = decode_sample(encode_sample(sample, image_encoding), image_encoding)
+
+    y = decoded["satellite_actual"]
+    np.testing.assert_array_equal(np.isnan(y), np.isnan(x))
+    assert np.isfinite(y[~np.isnan(x)]).all()
+    tolerance = TOLERANCES[image_encoding] * 10
+    np.testing.assert_allclose(y, x, atol=tolerance, rtol=0)
+
+
+@pytest.mark.parametrize("image_encoding", ["bfloat16", "uint8"])
+def test_decode_batch(sample, image_encoding):
+    encoded = encode_sample(sample, image_encoding)
+    batch = {k: np.stack([v, v]) for k, v in encoded.items() if k != "nwp"}
+    batch["nwp"] = {
+        provider: {k: np.stack([v, v]) for k, v in d.items()}
+        for provider, d in encoded["nwp"].items()
+    }
+
+    decoded = decode_sample(batch, image_encoding, batched=True)
+    second_sample = {
+        "satellite_actual": decoded["satellite_actual"][1],
+        "nwp": {"ukv": {"nwp": decoded["nwp"]["ukv"]["nwp"][1]}},
+    }
+    _check_close(second_sample, sample, image_encoding)
+
+
+def test_files_encoding(tmp_path, sample):
+    sample_dir = f"{tmp_path}/train"
+    os.makedirs(sample_dir)
+    sample_class = UKRegionalSample()
+    sample_class._data = encode_sample(sample, "float16")
+    sample_class.save(f"{sample_dir}/00000000.pt")
+    write_sample_format(sample_dir, dict(format="files", image_encoding="float16"))
+
+    dm = DataModule(configuration=None, sample_dir=f"{tmp_path}", batch_size=1)
+    batch = next(iter(dm.train_dataloader()))
+    assert batch["satellite_actual"].dtype == torch.float32
+    assert batch["nwp"]["ukv"]["nwp"].shape == (1, *sample["nwp"]["ukv"]["nwp"].shape)
+
+
+def test_packed_memmap_encoding(tmp_path, sample):
+    pack_samples(SAMPLE_DIR, f"{tmp_path}/packed/train", UKRegionalSample, image_encoding="uint8")
+    convert_to_memmap(SAMPLE_DIR, f"{tmp_path}/memmap/train", UKRegionalSample, "bfloat16")
+
+    memmap_dataset = MemmapSamplesDataset(f"{tmp_path}/memmap/train")
+    assert memmap_dataset.arrays["satellite_actual"].dtype == np.uint16
+    _check_close(memmap_dataset[0], sample, "bfloat16")
+
+    for sample_format in ["packed", "memmap"]:
+        dm = DataModule(configuration=None, sample_dir=f"{tmp_path}/{sample_format}", batch_size=2)
+        batch = next(iter(dm.train_dataloader()))
+        assert batch["satellite_actual"].dtype == torch.float32
+        assert "satellite_actual_scale" not in batch
@@ -0,0 +1,209 @@
+import io
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+from pvnet.data.ledger import WorkLedger, get_blocks, save_samples_with_ledger
+from pvnet.data.manifest import load_manifest
+
+
+class _RangeDataset(Dataset):
+    def __len__(self):
+        return 50
+
+    def __getitem__(self, idx):
+        return {"value": np.array([idx])}
+
+
+def _save(sample, sample_num, save_dir):
+    filename = f"{save_dir}/{sample_num:08}.pt"
+    torch.save(sample, filename)
+    return filename
+
+
+def _slow_save(sample, sample_num, save_dir):
+    """Save a sample in two halves, so a file read part way through the write is incomplete"""
+    buffer = io.BytesIO()
+    torch.save(sample, buffer)
+    data = buffer.getvalue()
+
+    filename = f"{save_dir}/{sample_num:08}.pt"
+    with open(filename, "wb") as f:
+        f.write(data[: len(data) // 2])
+        f.flush()
+        time.sleep(0.1)
+        f.write(data[len(data) // 2 :])
+    return filename
+
+
+def test_ledger_claims_are_disjoint(tmp_path):
+    ledger_a = WorkLedger(f"{tmp_path}/ledger", num_blocks=3)
+    ledger_b = WorkLedger(f"{tmp_path}/ledger", num_blocks=3)
+
+    claims = [ledger_a.claim(), ledger_b.claim(), ledger_a.claim(), ledger_b.claim()]
+    assert claims == [0, 1, 2, None]
+
+
+def test_ledger_takes_over_stale_claims(tmp_path):
+    ledger = WorkLedger(f"{tmp_path}/ledger", num_blocks=2, stale_seconds=0.05)
+    assert ledger.claim() == 0
+    ledger.finish(0)
+    assert ledger.claim() == 1
+
+    # The process working on block 1 has stopped
+    time.sleep(0.1)
+    assert WorkLedger(f"{tmp_path}/ledger", num_blocks=2, stale_seconds=0.05).claim() == 1
+
+    ledger.finish(1)
+    assert ledger.claim() is None
+    assert ledger.num_done() == 2
+
+
+def test_ledger_claim_taken_over_from_live_owner(tmp_path):
+    ledger_a = WorkLedger(f"{tmp_path}/ledger", num_blocks=1, stale_seconds=0.05)
+    ledger_b = WorkLedger(f"{tmp_path}/ledger", num_blocks=1, stale_seconds=0.05)
+    assert ledger_a.claim() == 0
+    assert ledger_a.owns(0)
+
+    # The process working on block 0 is slow, but still running
+    time.sleep(0.1)
+    assert ledger_b.claim() == 0
+    assert ledger_b.owns(0) and not ledger_a.owns(0)
+    ledger_a.touch(0)
+    assert ledger_b.owns(0)
+
+
+def test_get_blocks():
+    blocks = get_blocks(num_indices=50, num_samples=20, block_size=8, seed=1)
+    assert [len(b) for b in blocks] == [8, 8, 4]
+    assert len(np.unique(np.concatenate(blocks))) == 20
+    # The blocks are the same in every process
+    for a, b in zip(blocks, get_blocks(50, 20, 8, seed=1)):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_save_samples_with_ledger(tmp_path):
+    dataset = _RangeDataset()
+    dataloader_kwargs = dict(batch_size=None, num_workers=0)
+
+    def run():
+        save_samples_with_ledger(
+            dataset,
+            str(tmp_path),
+            num_samples=30,
+            dataloader_kwargs=dataloader_kwargs,
+            save_func=_save,
+            get_manifest_row=lambda idx: dict(t0=pd.Timestamp("2023-01-01"), target_id=idx),
+            block_size=4,
+            num_writers=2,
+        )
+
+    # Two processes sharing the directory
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    manifest = load_manifest(str(tmp_path))
+    assert len(manifest) == 30
+    assert list(manifest["path"]) == [f"{i:08}.pt" for i in range(30)]
+    assert manifest["target_id"].nunique() == 30
+
+    for path, target_id in zip(manifest["path"], manifest["target_id"]):
+        sample = torch.load(f"{tmp_path}/{path}")
+        assert int(sample["value"]) == target_id
+    assert len([f for f in os.listdir(tmp_path) if f.endswith(".pt")]) == 30
+
+
+def test_save_samples_with_ledger_slow_owner(tmp_path):
+    errors = []
+
+    def run(save_func):
+        try:
+            save_samples_with_ledger(
+                _RangeDataset(),
+                str(tmp_path),
+                num_samples=8,
+                dataloader_kwargs=dict(batch_size=None, num_workers=0),
+                save_func=save_func,
+                get_manifest_row=lambda idx: dict(t0=pd.Timestamp("2023-01-01"), target_id=idx),
+                block_size=4,
+                num_writers=1,
+                stale_seconds=0.02,
+            )
+        except Exception as e:
+            errors.append(e)
+
+    # The slow process has written some of its samples when its claims are taken over
+    slow_thread = threading.Thread(target=run, args=(_slow_save,))
+    slow_thread.start()
+    time.sleep(0.25)
+    run(_save)
+    slow_thread.join()
+
+    assert errors == []
+    manifest = load_manifest(str(tmp_path))
+    assert list(manifest["path"]) == [f"{i:08}.pt" for i in range(8)]
+    assert manifest["target_id"].nunique() == 8
+    assert not any(f.startswith("tmp_") for f in os.listdir(f"{tmp_path}/.ledger/manifests"))
+    assert not any(f.startswith("tmp_") for f in os.listdir(f"{tmp_path}/.ledger"))
+
+
+def test_save_samples_with_ledger_racing_writers(tmp_path):
+    def run(save_func):
+        save_samples_with_ledger(
+            _RangeDataset(),
+            str(tmp_path),
+            num_samples=8,
+            dataloader_kwargs=dict(batch_size=None, num_workers=0),
+            save_func=save_func,
+            get_manifest_row=lambda idx: dict(t0=pd.Timestamp("2023-01-01"), target_id=idx),
+            block_size=8,
+            num_writers=1,
+            stale_seconds=0.02,
+        )
+
+    # The slow process is still writing the samples of the block when it is taken over
+    slow_thread = threading.Thread(target=run, args=(_slow_save,))
+    slow_thread.start()
+    time.sleep(0.25)
+    run(_save)
+
+    # The samples in the manifest are complete while the slow process is still saving the same
+    # samples
+    assert slow_thread.is_alive()
+    manifest = load_manifest(str(tmp_path))
+    for path, target_id in zip(manifest["path"], manifest["target_id"]):
+        assert int(torch.load(f"{tmp_path}/{path}")["value"]) == target_id
+    slow_thread.join()
+
+    for path, target_id in zip(manifest["path"], manifest["target_id"]):
+        assert int(torch.load(f"{tmp_path}/{path}")["value"]) == target_id
+
+
+def test_save_samples_with_ledger_order(tmp_path):
+    order = np.arange(10)[::-1]
+
+    save_samples_with_ledger(
+        _RangeDataset(),
+        str(tmp_path),
+        num_samples=10,
+        dataloader_kwargs=dict(batch_size=None, num_workers=0),
+        save_func=_save,
+        get_manifest_row=lambda idx: dict(t0=pd.Timestamp("2023-01-01"), target_id=idx),
+        block_size=4,
+        order=order,
+    )
+
+    # The samples are generated in order, and the manifest is shuffled
+    for sample_num, idx in enumerate(order):
+        assert int(torch.load(f"{tmp_path}/{sample_num:08}.pt")["value"]) == idx
+    manifest = load_manifest(str(tmp_path))
+    assert sorted(manifest["target_id"]) == list(range(10))
+    assert list(manifest["target_id"]) != list(order)
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from ocf_data_sampler.torch_datasets.datasets.pvnet_uk import PVNetUKRegionalDataset
+
+from pvnet.data.locality import collate_sample_list, get_time_blocks, sort_indices_by_time
+
+
+class _Location:
+    def __init__(self, id):
+        self.id = id
+
+
+class _StreamedDataset(PVNetUKRegionalDataset):
+    """Holds the coordinates of the samples of a streamed dataset, ordered by location"""
+
+    def __init__(self, num_t0s: int = 3, num_locations: int = 5):
+        self.valid_t0_times = pd.date_range("2023-01-01 12:00", periods=num_t0s, freq="30min")
+        self.locations = [_Location(i + 1) for i in range(num_locations)]
+        self.index_pairs = [(t, loc) for loc in range(num_locations) for t in range(num_t0s)]
+
+    def __len__(self):
+        return len(self.index_pairs)
+
+
+def test_sort_indices_by_time():
+    dataset = _StreamedDataset()
+    indices = sort_indices_by_time(dataset, np.arange(len(dataset)))
+
+    t_index = [dataset.index_pairs[i][0] for i in indices]
+    assert t_index == sorted(t_index)
+    assert sorted(indices) == list(range(len(dataset)))
+
+
+def test_get_time_blocks():
+    dataset = _StreamedDataset()
+    chosen = np.random.default_rng(0).permutation(len(dataset))[:12]
+    blocks = get_time_blocks(dataset, chosen, block_size=2)
+
+    assert sorted(np.concatenate(blocks)) == sorted(chosen)
+    for block in blocks:
+        assert 1 <= len(block) <= 2
+        # Each block only holds samples for one init-time
+        assert len({dataset.index_pairs[i][0] for i in block}) == 1
+
+    # The init-times are generated in order
+    t_index = [dataset.index_pairs[block[0]][0] for block in blocks]
+    assert t_index == sorted(t_index)
+
+    with pytest.raises(ValueError):
+        get_time_blocks(dataset, chosen, block_size=0)
+
+
+def test_collate_sample_list():
+    samples = [(0, {"a": np.zeros(2)}), (3, {"a": np.ones(2)})]
+    collated = collate_sample_list(samples)
+
+    assert [idx for idx, _ in collated] == [0, 3]
+    assert all(isinstance(sample["a"], torch.Tensor) for _, sample in collated)
@@ -0,0 +1,114 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset
+from pvnet.data.manifest import create_manifest, load_manifest, shuffle_manifest
+from pvnet.data.memmap_samples import convert_to_memmap
+from pvnet.data.packed_samples import pack_samples
+
+
+@pytest.fixture()
+def sample_dir_with_manifest(tmp_path):
+    sample_dir = f"{tmp_path}/samples"
+    shutil.copytree("tests/test_data/presaved_samples_uk_regional/train", f"{sample_dir}/train")
+    create_manifest(f"{sample_dir}/train", UKRegionalSample)
+    return sample_dir
+
+
+def test_create_manifest(tmp_path):
+    sample_dir = f"{tmp_path}/train"
+    shutil.copytree("tests/test_data/presaved_samples_uk_regional/train", sample_dir)
+    create_manifest(sample_dir, UKRegionalSample)
+
+    manifest = load_manifest(sample_dir)
+    assert len(manifest) == 8
+    assert (manifest["nbytes"] > 0).all()
+    assert pd.api.types.is_datetime64_any_dtype(manifest["t0"])
+    assert manifest["target_id"].notnull().all()
+    assert (manifest["sources"] == "gsp;nwp/ecmwf;nwp/sat_pred;nwp/ukv;satellite").all()
+
+    # Remove one sample from the manifest. The dataset should only use the manifest
+    manifest.iloc[:-1].to_csv(f"{sample_dir}/manifest.csv", index=False)
+    dataset = PremadeSamplesDataset(sample_dir, UKRegionalSample)
+    assert len(dataset) == 7
+    assert dataset[0]["gsp_id"] == manifest["target_id"].iloc[0]
+
+
+def test_manifest_missing():
+    dataset = PremadeSamplesDataset(
+        "tests/test_data/presaved_samples_uk_regional/train", UKRegionalSample
+    )
+    assert len(dataset) == 8
+
+
+def test_packed_manifest(tmp_path):
+    pack_samples(
+        "tests/test_data/presaved_samples_uk_regional/train",
+        f"{tmp_path}/train",
+        UKRegionalSample,
+        samples_per_shard=3,
+    )
+    manifest = load_manifest(f"{tmp_path}/train")
+    assert list(manifest.columns) == ["path", "offset", "nbytes", "t0", "target_id", "sources"]
+    assert manifest["target_id"].notnull().all()
+    assert os.path.isfile(f"{tmp_path}/train/{manifest['path'].iloc[-1]}")
+
+
+def test_filter_without_manifest():
+    with pytest.raises(ValueError):
+        PremadeSamplesDataset(
+            "tests/test_data/presaved_samples_uk_regional/train",
+            UKRegionalSample,
+            target_ids=[1],
+        )
+
+
+@pytest.mark.parametrize("sample_format", [None, "packed", "memmap"])
+def test_datamodule_filters(sample_dir_with_manifest, tmp_path, sample_format):
+    sample_dir = sample_dir_with_manifest
+    manifest = load_manifest(f"{sample_dir}/train")
+
+    if sample_format is not None:
+        convert = pack_samples if sample_format == "packed" else convert_to_memmap
+        convert(f"{sample_dir}/train", f"{tmp_path}/converted/train", UKRegionalSample)
+        sample_dir = f"{tmp_path}/converted"
+
+    # Filter to the samples of one GSP from the earliest init-time onwards
+    target_id = manifest["target_id"].iloc[0]
+    start_time = str(manifest["t0"].min())
+    expected = manifest[(manifest["target_id"] == target_id) & (manifest["t0"] >= start_time)]
+
+    dm = DataModule(
+        configuration=None,
+        sample_dir=sample_dir,
+        batch_size=1,
+        train_period=[start_time, None],
+        target_ids=[target_id],
+    )
+    batches = list(dm.train_dataloader())
+    assert len(batches) == len(expected)
+    assert all(batch["gsp_id"].item() == target_id for batch in batches)
+
+    # Filter out all samples using the time period
+    end_time = str(manifest["t0"].min() - pd.Timedelta("1h"))
+    assert len(dm._get_premade_samples_dataset("train", end_time=end_time)) == 0
+
+
+def test_shuffle_manifest(sample_dir_with_manifest):
+    sample_dir = f"{sample_dir_with_manifest}/train"
+    manifest = load_manifest(sample_dir)
+
+    shuffle_manifest(sample_dir, seed=2)
+    shuffled = load_manifest(sample_dir)
+
+    assert sorted(shuffled["path"]) == sorted(manifest["path"])
+    assert list(shuffled["path"]) != list(manifest["path"])
+    pd.testing.assert_frame_equal(
+        shuffled.sort_values("path").reset_index(drop=True),
+        manifest.sort_values("path").reset_index(drop=True),
+    )
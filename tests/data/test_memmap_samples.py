@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from ocf_data_sampler.numpy_sample.collate import stack_np_samples_into_batch
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset, collate_fn
+from pvnet.data.memmap_samples import MemmapSampleWriter, MemmapSamplesDataset, convert_to_memmap
+
+
+def test_convert_to_memmap(tmp_path):
+    sample_dir = "tests/test_data/presaved_samples_uk_regional/train"
+    convert_to_memmap(sample_dir, f"{tmp_path}/train", UKRegionalSample)
+
+    memmap_dataset = MemmapSamplesDataset(f"{tmp_path}/train")
+    file_dataset = PremadeSamplesDataset(sample_dir, UKRegionalSample)
+    file_dataset.sample_paths = sorted(file_dataset.sample_paths)
+
+    assert len(memmap_dataset) == 8
+
+    memmap_sample = memmap_dataset[3]
+    file_sample = file_dataset[3]
+
+    # Arrays are views into the memory-mapped files
+    assert isinstance(memmap_sample["satellite_actual"], np.memmap)
+    np.testing.assert_array_equal(
+        memmap_sample["satellite_actual"], file_sample["satellite_actual"].numpy()
+    )
+    assert memmap_sample["gsp_id"] == file_sample["gsp_id"]
+    assert memmap_sample["gsp_t0_idx"] == file_sample["gsp_t0_idx"]
+    np.testing.assert_array_equal(
+        memmap_sample["nwp"]["ukv"]["nwp_channel_names"],
+        file_sample["nwp"]["ukv"]["nwp_channel_names"],
+    )
+
+    batch = collate_fn([memmap_dataset[i] for i in range(2)])
+    assert batch["nwp"]["ukv"]["nwp"].shape == (2, 11, 11, 24, 24)
+
+
+def test_memmap_writer_fixed_shape(tmp_path):
+    with MemmapSampleWriter(str(tmp_path), num_samples=2) as writer:
+        writer.write({"gsp": np.zeros(4)})
+        with pytest.raises(ValueError):
+            writer.write({"gsp": np.zeros(5)})
+
+
+def test_memmap_datamodule(tmp_path):
+    convert_to_memmap(
+        "tests/test_data/presaved_samples_uk_regional/train",
+        f"{tmp_path}/train",
+        UKRegionalSample,
+    )
+
+    dm = DataModule(
+        configuration=None,
+        sample_dir=f"{tmp_path}",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+    )
+
+    batch = next(iter(dm.train_dataloader()))
+    assert batch["satellite_actual"].shape[0] == 2
+
+
+def test_memmap_getitems(tmp_path):
+    convert_to_memmap(
+        "tests/test_data/presaved_samples_uk_regional/train", f"{tmp_path}/train", UKRegionalSample
+    )
+    dataset = MemmapSamplesDataset(f"{tmp_path}/train")
+
+    indices = [6, 1, 3]
+    batch = dataset.__getitems__(indices)
+    expected = stack_np_samples_into_batch([dataset[i] for i in indices])
+
+    np.testing.assert_array_equal(batch["gsp_id"], expected["gsp_id"])
+    np.testing.assert_array_equal(batch["satellite_actual"], expected["satellite_actual"])
+    np.testing.assert_array_equal(
+        batch["nwp"]["ecmwf"]["nwp_channel_names"], expected["nwp"]["ecmwf"]["nwp_channel_names"]
+    )
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+from ocf_data_sampler.numpy_sample.collate import stack_np_samples_into_batch
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+from torch.utils.data import DataLoader
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset
+from pvnet.data.packed_samples import (
+    PackedSamplesDataset,
+    PackedSamplesIterableDataset,
+    pack_samples,
+)
+
+
+def test_pack_samples(tmp_path):
+    sample_dir = "tests/test_data/presaved_samples_uk_regional/train"
+    pack_samples(sample_dir, f"{tmp_path}/train", UKRegionalSample, samples_per_shard=3)
+
+    packed_dataset = PackedSamplesDataset(f"{tmp_path}/train")
+    file_dataset = PremadeSamplesDataset(sample_dir, UKRegionalSample)
+    file_dataset.sample_paths = sorted(file_dataset.sample_paths)
+
+    # 8 samples into shards of 3
+    assert len(packed_dataset) == 8
+    assert len(packed_dataset.shard_names) == 3
+
+    for i in [0, 4, 7]:
+        packed_sample = packed_dataset[i]
+        file_sample = file_dataset[i]
+        assert packed_sample["gsp_id"] == file_sample["gsp_id"]
+        np.testing.assert_array_equal(
+            packed_sample["nwp"]["ukv"]["nwp"], file_sample["nwp"]["ukv"]["nwp"].numpy()
+        )
+
+
+def test_packed_datamodule(tmp_path):
+    pack_samples(
+        "tests/test_data/presaved_samples_uk_regional/train",
+        f"{tmp_path}/train",
+        UKRegionalSample,
+        samples_per_shard=4,
+    )
+
+    dm = DataModule(
+        configuration=None,
+        sample_dir=f"{tmp_path}",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+    )
+
+    batch = next(iter(dm.train_dataloader()))
+    assert batch["satellite_actual"].shape[0] == 2
+
+
+def test_packed_getitems(tmp_path):
+    pack_samples(
+        "tests/test_data/presaved_samples_uk_regional/train",
+        f"{tmp_path}/train",
+        UKRegionalSample,
+        samples_per_shard=3,
+    )
+    dataset = PackedSamplesDataset(f"{tmp_path}/train")
+
+    # Samples 0-2 are adjacent in the first shard and are read as one block
+    indices = [7, 0, 2, 1, 5]
+    batch = dataset.__getitems__(indices)
+    expected = stack_np_samples_into_batch([dataset[i] for i in indices])
+
+    np.testing.assert_array_equal(batch["gsp_id"], expected["gsp_id"])
+    np.testing.assert_array_equal(batch["nwp"]["ukv"]["nwp"], expected["nwp"]["ukv"]["nwp"])
+    assert batch["gsp_t0_idx"] == expected["gsp_t0_idx"]
+
+
+@pytest.fixture()
+def packed_sample_dir(tmp_path):
+    pack_samples(
+        "tests/test_data/presaved_samples_uk_regional/train",
+        f"{tmp_path}/train",
+        UKRegionalSample,
+        samples_per_shard=2,
+    )
+    return f"{tmp_path}/train"
+
+
+def _gsp_ids(samples):
+    return [int(sample["gsp_id"]) for sample in samples]
+
+
+def test_packed_iterable(packed_sample_dir):
+    dataset = PackedSamplesIterableDataset(packed_sample_dir, shuffle=False)
+    map_dataset = PackedSamplesDataset(packed_sample_dir)
+
+    # Without shuffling the samples are in file order
+    assert _gsp_ids(dataset) == _gsp_ids(map_dataset[i] for i in range(len(map_dataset)))
+
+    dataset = PackedSamplesIterableDataset(packed_sample_dir, shuffle_buffer_size=3)
+    assert sorted(_gsp_ids(dataset)) == sorted(_gsp_ids(map_dataset))
+    assert len(dataset) == len(map_dataset)
+
+
+@pytest.mark.parametrize("world_size", [1, 3])
+def test_packed_iterable_sharding(packed_sample_dir, world_size):
+    # 8 samples in 4 shards of 2
+    rank_samples = []
+    for rank in range(world_size):
+        dataset = PackedSamplesIterableDataset(
+            packed_sample_dir, shuffle=False, rank=rank, world_size=world_size
+        )
+        dataloader = DataLoader(dataset, batch_size=None, num_workers=2)
+        rank_samples.append(_gsp_ids(dataloader))
+        assert len(rank_samples[-1]) == len(dataset)
+
+    # Each rank yields the same number of samples and no sample is used twice
+    assert len({len(samples) for samples in rank_samples}) == 1
+    all_samples = sum(rank_samples, [])
+    if world_size == 1:
+        assert sorted(all_samples) == sorted(_gsp_ids(PackedSamplesDataset(packed_sample_dir)))
+    else:
+        assert len(all_samples) == 6
+
+
+def test_packed_iterable_datamodule(packed_sample_dir, tmp_path):
+    dm = DataModule(
+        configuration=None,
+        sample_dir=f"{tmp_path}",
+        batch_size=2,
+        num_workers=2,
+        stream_shards=True,
+        shuffle_buffer_size=4,
+    )
+    dataloader = dm.train_dataloader()
+    assert isinstance(dataloader.dataset, PackedSamplesIterableDataset)
+    assert sum(batch["gsp_id"].shape[0] for batch in dataloader) == 8
+
+
+@pytest.mark.parametrize("codec", ["lz4", "zstd", "blosc"])
+def test_packed_codecs(tmp_path, codec):
+    sample_dir = "tests/test_data/presaved_samples_uk_regional/train"
+    pack_samples(sample_dir, f"{tmp_path}/none", UKRegionalSample)
+    pack_samples(sample_dir, f"{tmp_path}/{codec}", UKRegionalSample, codec=codec)
+
+    dataset = PackedSamplesDataset(f"{tmp_path}/{codec}")
+    uncompressed_dataset = PackedSamplesDataset(f"{tmp_path}/none")
+    assert dataset._nbytes.sum() < uncompressed_dataset._nbytes.sum()
+
+    sample, expected = dataset[3], uncompressed_dataset[3]
+    assert sample["gsp_id"] == expected["gsp_id"]
+    np.testing.assert_array_equal(sample["nwp"]["ukv"]["nwp"], expected["nwp"]["ukv"]["nwp"])
+    np.testing.assert_array_equal(
+        sample["nwp"]["ukv"]["nwp_channel_names"], expected["nwp"]["ukv"]["nwp_channel_names"]
+    )
+
+    batch = dataset.__getitems__([0, 1, 5])
+    np.testing.assert_array_equal(
+        batch["satellite_actual"][2], uncompressed_dataset[5]["satellite_actual"]
+    )
@@ -0,0 +1,96 @@
+import gc
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+import torch
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset
+from pvnet.data.prefetch import DevicePrefetcher
+
+
+def _batches(n):
+    return [
+        {"gsp": torch.full((2, 3), float(i)), "nwp": {"ukv": torch.zeros(2, 1)}} for i in range(n)
+    ]
+
+
+def test_prefetcher_yields_all_batches():
+    batches = _batches(5)
+    prefetcher = DevicePrefetcher(batches, "cpu", num_batches=2)
+    assert len(prefetcher) == 5
+
+    for _ in range(2):
+        out = list(prefetcher)
+        assert len(out) == 5
+        for batch, expected in zip(out, batches):
+            assert torch.equal(batch["gsp"], expected["gsp"])
+
+
+def test_prefetcher_keep_host_batch():
+    batches = _batches(2)
+    for (batch, device_batch), expected in zip(
+        DevicePrefetcher(batches, "cpu", keep_host_batch=True), batches
+    ):
+        assert batch is expected
+        assert torch.equal(device_batch["gsp"], expected["gsp"])
+
+
+def test_prefetcher_raises_errors():
+    def batches():
+        yield _batches(1)[0]
+        raise RuntimeError("Bad batch")
+
+    iterator = iter(DevicePrefetcher(batches(), "cpu"))
+    next(iterator)
+    with pytest.raises(RuntimeError, match="Bad batch"):
+        next(iterator)
+
+
+def test_prefetcher_stops_when_abandoned():
+    iterator = iter(DevicePrefetcher(_batches(10), "cpu", num_batches=1))
+    next(iterator)
+    thread = iterator._thread
+
+    del iterator
+    gc.collect()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_prefetch_with_reused_collate_buffers():
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=1,
+        num_workers=2,
+        prefetch_factor=1,
+        reuse_collate_buffers=True,
+        prefetch_to_device=3,
+    )
+    dm.trainer = SimpleNamespace(
+        world_size=1, strategy=SimpleNamespace(root_device=torch.device("cpu"))
+    )
+    dataloader = dm.train_dataloader()
+    assert isinstance(dataloader, DevicePrefetcher)
+
+    sample_dir = "tests/test_data/presaved_samples_uk_regional/train"
+    dataset = PremadeSamplesDataset(sample_dir, UKRegionalSample)
+    sample_gsps = [torch.as_tensor(sample["gsp"]) for sample in dataset]
+
+    # The trainer holds the batch in use and the next one
+    held = deque(maxlen=2)
+    num_batches = 0
+    for batch in dataloader:
+        # The batch was not overwritten while it was held by the prefetcher
+        assert any(torch.equal(batch["gsp"][0], gsp) for gsp in sample_gsps)
+        held.append((batch, batch["gsp"].clone()))
+        # Let the workers and the prefetcher run ahead
+        time.sleep(0.05)
+        for held_batch, expected in held:
+            assert torch.equal(held_batch["gsp"], expected)
+        num_batches += 1
+    assert num_batches == 8
@@ -0,0 +1,231 @@
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from ocf_data_sampler.sample.site import SiteSample
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+from torchvision.transforms.functional import center_crop
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset, collate_fn
+from pvnet.data.encoding import decode_sample, encode_sample
+from pvnet.data.memmap_samples import MemmapSamplesDataset, convert_to_memmap
+from pvnet.data.packed_samples import PackedSamplesDataset, pack_samples
+from pvnet.data.projection import ImageProjection, ProjectedDataset, SampleProjection
+from pvnet.data.utils import flatten_sample, sample_to_numpy
+from pvnet.models.multimodal.linear_networks.networks import ResFCNet2
+from pvnet.models.multimodal.multimodal import Model
+from pvnet.models.multimodal.site_encoders.encoders import SingleAttentionNetwork
+
+SAMPLE_DIR = "tests/test_data/presaved_samples_uk_regional/train"
+SITE_SAMPLE_DIR = "tests/test_data/presaved_samples_site/train"
+
+
+@pytest.fixture()
+def projection():
+    return SampleProjection(
+        nwp={
+            "ukv": ImageProjection(image_size_pixels=12, sequence_length=5, channels=["dswrf", "t"])
+        },
+        satellite=ImageProjection(image_size_pixels=16, sequence_length=3),
+    )
+
+
+@pytest.fixture()
+def sample():
+    return sample_to_numpy(PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)[0])
+
+
+def test_project_sample(sample, projection):
+    projected = projection.project(sample)
+
+    assert set(projected["nwp"]) == {"ukv"}
+    assert projected["nwp"]["ukv"]["nwp"].shape == (5, 2, 12, 12)
+    assert list(projected["nwp"]["ukv"]["nwp_channel_names"]) == ["dswrf", "t"]
+    assert projected["satellite_actual"].shape == (3, 11, 16, 16)
+
+    # The crop matches the one made by the model
+    expected = center_crop(torch.from_numpy(sample["satellite_actual"][:3]), output_size=16)
+    np.testing.assert_array_equal(projected["satellite_actual"], expected.numpy())
+    np.testing.assert_array_equal(
+        projected["nwp"]["ukv"]["nwp"][:, 0], sample["nwp"]["ukv"]["nwp"][:5, 1, 6:18, 6:18]
+    )
+    np.testing.assert_array_equal(projected["gsp"], sample["gsp"])
+
+    # Projecting twice has no further effect
+    twice = projection.project(projected)
+    np.testing.assert_array_equal(twice["nwp"]["ukv"]["nwp"], projected["nwp"]["ukv"]["nwp"])
+
+
+def test_project_drops_satellite(sample):
+    projected = SampleProjection(nwp={"ecmwf": None}, include_satellite=False).project(sample)
+    assert set(projected["nwp"]) == {"ecmwf"}
+    assert not any(key.startswith("satellite") for key in projected)
+    assert projected["nwp"]["ecmwf"]["nwp"].shape == sample["nwp"]["ecmwf"]["nwp"].shape
+
+
+def test_project_encoded_sample(sample, projection):
+    encoded = projection.project(encode_sample(sample, "uint8"))
+    assert encoded["nwp"]["ukv"]["nwp_scale"].shape == (2,)
+
+    decoded = decode_sample(encoded, "uint8")
+    expected = projection.project(sample)
+    np.testing.assert_allclose(
+        decoded["nwp"]["ukv"]["nwp"], expected["nwp"]["ukv"]["nwp"], atol=0.05, rtol=0
+    )
+
+
+def test_project_unknown_channel(sample):
+    projection = SampleProjection(nwp={"ukv": ImageProjection(channels=["not_a_channel"])})
+    with pytest.raises(ValueError):
+        projection.project(sample)
+
+
+def test_from_model(multimodal_model, sample):
+    projection = SampleProjection.from_model(multimodal_model)
+    projected = projection.project(sample)
+
+    assert set(projected["nwp"]) == {"ukv"}
+    assert projected["nwp"]["ukv"]["nwp"].shape[0] == (
+        multimodal_model.nwp_encoders_dict["ukv"].sequence_length
+    )
+    assert projected["satellite_actual"].shape[0] == multimodal_model.sat_sequence_len
+
+    series_len = multimodal_model.forecast_len + multimodal_model.history_len + 1
+    assert projected["gsp"].shape == (series_len,)
+    assert projected["gsp_solar_azimuth"].shape == (series_len,)
+
+
+def test_model_input_schema(multimodal_model, sample):
+    schema = multimodal_model.get_input_schema()
+    projected = flatten_sample(multimodal_model.get_input_spec().project(sample))
+
+    # Only the keys read by the model are kept
+    assert set(projected) == set(schema)
+    assert "nwp/ecmwf/nwp" not in projected and "gsp_nominal_capacity_mwp" not in projected
+
+    for key, shape in schema.items():
+        if shape is not None:
+            actual = np.shape(projected[key])
+            assert len(actual) == len(shape)
+            assert all(s is None or s == a for s, a in zip(shape, actual))
+
+
+def test_project_keys_keeps_encoding_params(sample):
+    projection = SampleProjection(keys=["satellite_actual", "gsp"])
+    projected = projection.project(encode_sample(sample, "uint8"))
+    assert set(projected) == {
+        "satellite_actual",
+        "satellite_actual_scale",
+        "satellite_actual_offset",
+        "gsp",
+    }
+
+    decoded = decode_sample(projected, "uint8")
+    assert set(decoded) == {"satellite_actual", "gsp"}
+
+
+def test_model_input_spec_matches_adapt_batch(multimodal_model_kwargs):
+    model = Model(adapt_batches=True, **multimodal_model_kwargs).eval()
+    projection = model.get_input_spec()
+
+    samples = [sample_to_numpy(s) for s in PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)]
+    full_batch = collate_fn(samples[:2])
+    projected_batch = collate_fn([projection.project(s) for s in samples[:2]])
+
+    with torch.no_grad():
+        torch.testing.assert_close(model(projected_batch), model(full_batch))
+
+
+def test_model_input_spec_site_encoder():
+    model = Model(
+        output_network=partial(
+            ResFCNet2, fc_hidden_features=32, n_res_blocks=1, res_block_layers=1, dropout_frac=0.0
+        ),
+        pv_encoder=partial(SingleAttentionNetwork, num_sites=1, out_features=32),
+        target_key="site",
+        interval_minutes=15,
+        pv_interval_minutes=15,
+        history_minutes=60,
+        forecast_minutes=2880,
+        pv_history_minutes=60,
+        include_gsp_yield_history=False,
+        include_sun=False,
+        embedding_dim=None,
+    ).eval()
+
+    # The keys read by the site encoder are declared by the model
+    assert {"site", "site_id"} <= set(model.get_input_schema())
+
+    projection = model.get_input_spec()
+    samples = [sample_to_numpy(s) for s in PremadeSamplesDataset(SITE_SAMPLE_DIR, SiteSample)]
+    full_batch = collate_fn(samples[:2])
+    projected_batch = collate_fn([projection.project(s) for s in samples[:2]])
+
+    assert set(flatten_sample(projected_batch)) == set(model.get_input_schema())
+    with torch.no_grad():
+        torch.testing.assert_close(model(projected_batch), model(full_batch))
+
+
+def test_projected_streamed_dataset(sample, projection):
+    dataset = ProjectedDataset([sample, sample], projection)
+    assert len(dataset) == 2
+    assert dataset[1]["nwp"]["ukv"]["nwp"].shape == (5, 2, 12, 12)
+
+
+def test_projected_datasets(tmp_path, projection):
+    convert_to_memmap(SAMPLE_DIR, f"{tmp_path}/memmap", UKRegionalSample, image_encoding="uint8")
+    pack_samples(SAMPLE_DIR, f"{tmp_path}/packed", UKRegionalSample, image_encoding="uint8")
+
+    expected = PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample, projection=projection)
+    expected.sample_paths = sorted(expected.sample_paths)
+    datasets = [
+        MemmapSamplesDataset(f"{tmp_path}/memmap", projection=projection),
+        PackedSamplesDataset(f"{tmp_path}/packed", projection=projection),
+    ]
+
+    # The memmap arrays which are not used are not opened
+    assert not any(key.startswith("nwp/ecmwf") for key in datasets[0].arrays)
+
+    for dataset in datasets:
+        sample = dataset[2]
+        batch = dataset.__getitems__([2, 0])
+        assert sample["nwp"]["ukv"]["nwp"].shape == (5, 2, 12, 12)
+        assert batch["nwp"]["ukv"]["nwp"].shape == (2, 5, 2, 12, 12)
+        assert set(batch["nwp"]) == {"ukv"}
+        np.testing.assert_allclose(
+            batch["nwp"]["ukv"]["nwp"][0], expected[2]["nwp"]["ukv"]["nwp"], atol=0.05, rtol=0
+        )
+
+
+def test_projected_datamodule(projection):
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+        projection=projection,
+    )
+    batch = next(iter(dm.train_dataloader()))
+    assert batch["nwp"]["ukv"]["nwp"].shape == (2, 5, 2, 12, 12)
+    assert batch["satellite_actual"].shape == (2, 3, 11, 16, 16)
+
+
+def test_model_input_spec_datamodule(multimodal_model):
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+        use_model_input_spec=True,
+    )
+    with pytest.raises(ValueError):
+        dm.train_dataloader()
+
+    dm.trainer = SimpleNamespace(lightning_module=multimodal_model)
+    batch = next(iter(dm.train_dataloader()))
+    assert set(batch["nwp"]) == {"ukv"}
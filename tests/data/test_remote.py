@@ -0,0 +1,175 @@
+import os
+import time
+
+import fsspec
+import numpy as np
+import pytest
+from ocf_data_sampler.sample.site import SiteSample
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.data.base_datamodule import PremadeSamplesDataset, get_premade_samples_dataset
+from pvnet.data.packed_samples import PackedSamplesDataset, pack_samples
+from pvnet.data.remote import DiskCache, RemoteSampleReader, is_remote_path
+from pvnet.data.utils import flatten_sample
+
+SAMPLE_DIR = "tests/test_data/presaved_samples_uk_regional/train"
+
+
+@pytest.fixture()
+def memory_dir(tmp_path):
+    """A unique directory on the in-memory fsspec filesystem, standing in for an object store"""
+    fs = fsspec.filesystem("memory")
+    path = f"memory://{tmp_path.name}"
+    yield path
+    fs.rm(path, recursive=True)
+
+
+def test_is_remote_path():
+    assert is_remote_path("s3://bucket/samples")
+    assert is_remote_path("gs://bucket/samples")
+    assert is_remote_path("memory://samples")
+    assert not is_remote_path("/data/samples")
+    assert not is_remote_path("file:///data/samples")
+
+
+def test_disk_cache_eviction(tmp_path):
+    cache = DiskCache(f"{tmp_path}/cache", max_bytes=250)
+
+    for i in range(3):
+        cache.put(f"key{i}", bytes(100))
+        # Space out the modification times so the eviction order is well defined
+        time.sleep(0.01)
+
+    # The least recently used value was evicted
+    assert cache.get("key0") is None
+    assert cache.get("key2") == bytes(100)
+    assert cache.nbytes <= 250
+
+
+def test_disk_cache_keeps_recently_used(tmp_path):
+    cache = DiskCache(f"{tmp_path}/cache", max_bytes=250)
+    cache.put("key0", bytes(100))
+    time.sleep(0.01)
+    cache.put("key1", bytes(100))
+    time.sleep(0.01)
+
+    # Reading a value marks it as recently used
+    assert cache.get("key0") is not None
+    time.sleep(0.01)
+    cache.put("key2", bytes(100))
+
+    assert cache.get("key0") is not None
+    assert cache.get("key1") is None
+
+
+def test_read_ranges(memory_dir):
+    data = bytes(range(256))
+    with fsspec.open(f"{memory_dir}/data.bin", "wb") as f:
+        f.write(data)
+
+    reader = RemoteSampleReader(max_concurrency=4)
+    ranges = [(f"{memory_dir}/data.bin", start, 10) for start in [200, 0, 50, 0]]
+
+    assert reader.read_ranges(ranges) == [data[s : s + 10] for _, s, _ in ranges]
+    assert reader.read_file(f"{memory_dir}/data.bin") == data
+
+
+def test_read_through_disk_cache(memory_dir, tmp_path):
+    with fsspec.open(f"{memory_dir}/data.bin", "wb") as f:
+        f.write(bytes(100))
+
+    reader = RemoteSampleReader(cache_dir=f"{tmp_path}/cache", cache_bytes=10_000)
+    assert reader.read_range(f"{memory_dir}/data.bin", 10, 20) == bytes(20)
+
+    # Later reads come from the cache
+    fsspec.filesystem("memory").rm(f"{memory_dir}/data.bin")
+    assert reader.read_range(f"{memory_dir}/data.bin", 10, 20) == bytes(20)
+
+
+def test_read_records_caches_each_record(memory_dir, tmp_path):
+    data = bytes(range(100))
+    with fsspec.open(f"{memory_dir}/data.bin", "wb") as f:
+        f.write(data)
+
+    reader = RemoteSampleReader(cache_dir=f"{tmp_path}/cache", cache_bytes=10_000)
+    fetched = []
+    fetch_range = reader._fetch_range
+    reader._fetch_range = lambda *block: fetched.append(block) or fetch_range(*block)
+
+    path = f"{memory_dir}/data.bin"
+    records = [(path, 20, 10), (path, 0, 10), (path, 10, 10), (path, 60, 10)]
+    assert reader.read_records(records) == [data[s : s + n] for _, s, n in records]
+    # The adjacent records are read together
+    assert sorted(fetched) == [(path, 0, 30), (path, 60, 10)]
+
+    # A record read as part of a larger read is found in the cache on its own, and only the
+    # records which are not cached are read
+    fetched.clear()
+    records = [(path, 10, 10), (path, 30, 10), (path, 40, 10), (path, 60, 10)]
+    assert reader.read_records(records) == [data[s : s + n] for _, s, n in records]
+    assert fetched == [(path, 30, 20)]
+
+    fetched.clear()
+    assert reader.read_range(path, 40, 10) == data[40:50]
+    assert fetched == []
+
+
+def test_remote_packed_samples(memory_dir, tmp_path):
+    pack_samples(SAMPLE_DIR, f"{tmp_path}/train", UKRegionalSample, samples_per_shard=3)
+    fsspec.filesystem("memory").put(f"{tmp_path}/train", f"{memory_dir}/train", recursive=True)
+
+    reader = RemoteSampleReader(cache_dir=f"{tmp_path}/cache", cache_bytes=10**9)
+    remote_dataset = get_premade_samples_dataset(
+        f"{memory_dir}/train", UKRegionalSample, reader=reader
+    )
+    local_dataset = PackedSamplesDataset(f"{tmp_path}/train")
+
+    assert isinstance(remote_dataset, PackedSamplesDataset)
+    assert len(remote_dataset) == len(local_dataset) == 8
+
+    remote_batch = remote_dataset.__getitems__([6, 0, 1, 4])
+    local_batch = local_dataset.__getitems__([6, 0, 1, 4])
+    np.testing.assert_array_equal(remote_batch["gsp_id"], local_batch["gsp_id"])
+    np.testing.assert_array_equal(
+        remote_batch["nwp"]["ukv"]["nwp"], local_batch["nwp"]["ukv"]["nwp"]
+    )
+
+    np.testing.assert_array_equal(
+        remote_dataset[5]["satellite_actual"], local_dataset[5]["satellite_actual"]
+    )
+    assert len(os.listdir(f"{tmp_path}/cache")) > 0
+
+
+@pytest.mark.parametrize(
+    "sample_dir, sample_class",
+    [
+        (SAMPLE_DIR, UKRegionalSample),
+        ("tests/test_data/presaved_samples_site/train", SiteSample),
+    ],
+)
+def test_remote_sample_files(memory_dir, tmp_path, sample_dir, sample_class):
+    fsspec.filesystem("memory").put(sample_dir, f"{memory_dir}/train", recursive=True)
+
+    reader = RemoteSampleReader(cache_dir=f"{tmp_path}/cache", cache_bytes=10**9)
+    remote_dataset = get_premade_samples_dataset(
+        f"{memory_dir}/train", sample_class, reader=reader
+    )
+    local_dataset = PremadeSamplesDataset(sample_dir, sample_class)
+
+    assert isinstance(remote_dataset, PremadeSamplesDataset)
+    assert len(remote_dataset) == len(local_dataset)
+
+    # The samples are loaded by name, so match them up by their paths
+    local_samples = {
+        os.path.basename(path): local_dataset[i]
+        for i, path in enumerate(local_dataset.sample_paths)
+    }
+    for i, path in enumerate(remote_dataset.sample_paths):
+        remote_sample = flatten_sample(remote_dataset[i])
+        local_sample = flatten_sample(local_samples[os.path.basename(path)])
+        assert set(remote_sample) == set(local_sample)
+        for key, value in local_sample.items():
+            np.testing.assert_array_equal(remote_sample[key], value)
+
+    # The files were read through the disk cache
+    assert len(os.listdir(f"{tmp_path}/cache")) > 0
@@ -0,0 +1,105 @@
+import pickle
+
+import numpy as np
+import pytest
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+from torch.utils.data import DataLoader
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset
+from pvnet.data.sample_cache import CachedDataset, SharedSampleCache
+
+
+def _sample(i):
+    return {"gsp": np.full(100, i, dtype=np.float32), "gsp_id": np.array(i)}
+
+
+def test_cache_get_put():
+    cache = SharedSampleCache(max_bytes=10_000, num_samples=4)
+    assert cache.get(0) is None
+
+    cache.put(0, _sample(0))
+    assert cache.get(0)["gsp_id"] == 0
+    assert cache.get_stats()["hits"] == 1
+    assert cache.get_stats()["misses"] == 1
+    cache.close()
+
+
+def test_cache_lru_eviction():
+    record_size = len(pickle.dumps(_sample(0), protocol=pickle.HIGHEST_PROTOCOL))
+    # Room for exactly two samples
+    cache = SharedSampleCache(max_bytes=int(record_size * 2.5 + 10), num_samples=4)
+
+    cache.put(0, _sample(0))
+    cache.put(1, _sample(1))
+    cache.get(0)
+    # Sample 1 is the least recently used so it is evicted
+    cache.put(2, _sample(2))
+
+    assert cache.get(0) is not None
+    assert cache.get(1) is None
+    assert cache.get(2) is not None
+    assert cache.nbytes <= cache.max_bytes
+    cache.close()
+
+
+@pytest.mark.parametrize("multiprocessing_context", ["fork", "spawn"])
+def test_cached_dataset_multiprocessing(multiprocessing_context):
+    dataset = CachedDataset(
+        PremadeSamplesDataset(
+            "tests/test_data/presaved_samples_uk_regional/train", UKRegionalSample
+        ),
+        max_bytes=100_000_000,
+    )
+    dataloader = DataLoader(
+        dataset, batch_size=None, num_workers=2, multiprocessing_context=multiprocessing_context
+    )
+
+    for _ in dataloader:
+        pass
+    assert dataset.cache.misses == len(dataset)
+
+    # The second epoch is served from the cache written by the workers of the first epoch
+    for sample, expected in zip(dataloader, dataset.dataset):
+        np.testing.assert_array_equal(sample["gsp"], expected["gsp"])
+    assert dataset.cache.hits == len(dataset)
+
+
+def test_datamodule_sample_cache():
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        sample_cache_bytes=100_000_000,
+    )
+    dataloader = dm.train_dataloader()
+    assert isinstance(dataloader.dataset, CachedDataset)
+
+    for _ in range(2):
+        for _ in dataloader:
+            pass
+    assert dataloader.dataset.cache.get_stats()["hit_rate"] == 0.5
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_cached_dataset_getitems(batched):
+    premade_dataset = PremadeSamplesDataset(
+        "tests/test_data/presaved_samples_uk_regional/train", UKRegionalSample
+    )
+    # The wrapped dataset is read one sample at a time if it has no `__getitems__()`
+    wrapped = premade_dataset if batched else [premade_dataset[i] for i in range(8)]
+    dataset = CachedDataset(wrapped, max_bytes=100_000_000)
+
+    samples = dataset.__getitems__([0, 3])
+    assert dataset.cache.misses == 2
+
+    # Only the samples which are not cached are loaded from the wrapped dataset
+    samples += dataset.__getitems__([3, 5, 0])
+    assert dataset.cache.hits == 2
+    assert dataset.cache.misses == 3
+
+    for sample, idx in zip(samples, [0, 3, 3, 5, 0]):
+        expected = premade_dataset[idx]
+        np.testing.assert_array_equal(sample["gsp"], expected["gsp"])
+        np.testing.assert_array_equal(sample["nwp"]["ukv"]["nwp"], expected["nwp"]["ukv"]["nwp"])
+    dataset.cache.close()
@@ -0,0 +1,69 @@
+from pvnet.data import DataModule
+from pvnet.data.sampler import ResumableSampler
+
+
+def test_sampler_deterministic():
+    dataset = list(range(20))
+    a, b = ResumableSampler(dataset, seed=3), ResumableSampler(dataset, seed=3)
+    assert list(a) == list(b)
+    assert sorted(a) == dataset
+
+    a.set_epoch(1)
+    assert list(a) != list(b)
+
+
+def test_sampler_resume():
+    dataset = list(range(20))
+    sampler = ResumableSampler(dataset, seed=3)
+    sampler.set_epoch(2)
+    full_order = list(sampler)
+
+    resumed = ResumableSampler(dataset, seed=3)
+    resumed.resume(epoch=2, num_samples_seen=8)
+    resumed.set_epoch(2)
+    assert len(resumed) == 12
+    assert list(resumed) == full_order[8:]
+    # The length stays shortened until the resumed epoch ends
+    assert len(resumed) == 12
+    # Later passes are not shortened
+    assert list(resumed) == full_order
+    assert len(resumed) == 20
+
+
+def test_sampler_resume_other_epoch():
+    dataset = list(range(20))
+    sampler = ResumableSampler(dataset, seed=3)
+    sampler.resume(epoch=0, num_samples_seen=8)
+    sampler.set_epoch(1)
+    assert len(sampler) == 20
+    assert len(list(sampler)) == 20
+
+
+def test_sampler_resume_len_ends_with_epoch():
+    sampler = ResumableSampler(list(range(20)), seed=3)
+    sampler.resume(epoch=0, num_samples_seen=8)
+    assert len(sampler) == 12
+    assert len(list(sampler)) == 12
+    sampler.set_epoch(1)
+    assert len(sampler) == 20
+    assert len(list(sampler)) == 20
+
+
+def test_datamodule_resumable_sampler():
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+        resumable_sampler=True,
+        sampler_seed=5,
+    )
+    dm.load_state_dict(dict(seed=5, epoch=0, num_samples_seen=4))
+    dataloader = dm.train_dataloader()
+    assert isinstance(dataloader.sampler, ResumableSampler)
+    assert len(dataloader) == 2
+
+    # The first 4 of the 8 samples are skipped
+    assert sum(len(batch["gsp"]) for batch in dataloader) == 4
+    assert sum(len(batch["gsp"]) for batch in dataloader) == 8
@@ -0,0 +1,131 @@
+import gc
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+import torch
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.data import DataModule
+from pvnet.data.base_datamodule import PremadeSamplesDataset, collate_fn
+from pvnet.data.shared_batches import (
+    SharedBatchCollator,
+    SharedBatchDataLoader,
+    SharedBatchSlots,
+)
+
+SAMPLE_DIR = "tests/test_data/presaved_samples_uk_regional/train"
+
+
+def test_slots_acquire_release():
+    slots = SharedBatchSlots(num_slots=2, slot_bytes=1024)
+    a, b = slots.acquire(), slots.acquire()
+    assert {a, b} == {0, 1}
+    assert slots.acquire(timeout=0.01) is None
+
+    slots.release(a)
+    assert slots.num_free == 1
+    assert slots.acquire(timeout=0.01) == a
+
+
+def test_slots_reclaim():
+    slots = SharedBatchSlots(num_slots=2, slot_bytes=1024)
+    slot = slots.acquire()
+    slots.mark_written(slot)
+    # Batches written but never opened are freed
+    assert slots.reclaim() == 1
+    assert slots.num_free == 2
+
+
+def _acquire_and_exit(slots):
+    slots.acquire()
+    # Killed part way through writing the batch
+    os._exit(1)
+
+
+@pytest.mark.parametrize("multiprocessing_context", ["fork", "spawn"])
+def test_slots_reclaim_killed_writer(multiprocessing_context):
+    slots = SharedBatchSlots(num_slots=3, slot_bytes=1024)
+    process = multiprocessing.get_context(multiprocessing_context).Process(
+        target=_acquire_and_exit, args=(slots,)
+    )
+    process.start()
+    process.join()
+    # A slot being written by a live process is kept
+    slots.acquire()
+    assert slots.num_free == 1
+
+    assert slots.reclaim() == 1
+    assert slots.num_free == 2
+
+
+def test_slots_release_while_locked():
+    slots = SharedBatchSlots(num_slots=2, slot_bytes=1024)
+    slot = slots.acquire()
+    slots.mark_written(slot)
+
+    # A batch can be garbage collected while this process holds the lock, for example in
+    # `reclaim()`. Its slot is freed once the lock is released rather than deadlocking
+    with slots._locked():
+        slots.release(slot)
+        assert slots.num_free == 1
+    assert slots.num_free == 2
+    assert slots.acquire(timeout=0.01) is not None
+
+
+@pytest.mark.parametrize("multiprocessing_context", ["fork", "spawn"])
+def test_shared_batch_dataloader(multiprocessing_context):
+    dataset = PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)
+    dataset.sample_paths = sorted(dataset.sample_paths)
+    slots = SharedBatchSlots(num_slots=4, slot_bytes=100_000_000)
+    dataloader = SharedBatchDataLoader(
+        dataset,
+        batch_size=2,
+        num_workers=2,
+        prefetch_factor=1,
+        collate_fn=SharedBatchCollator(slots, collate_fn),
+        multiprocessing_context=multiprocessing_context,
+    )
+
+    for i, batch in enumerate(dataloader):
+        expected = collate_fn([dataset[j] for j in range(2 * i, 2 * i + 2)])
+        assert torch.equal(batch["gsp"], expected["gsp"])
+        np.testing.assert_array_equal(
+            batch["nwp"]["ukv"]["nwp"].numpy(), expected["nwp"]["ukv"]["nwp"].numpy()
+        )
+
+    # The slots are freed once the batches are garbage collected
+    del batch
+    gc.collect()
+    assert slots.num_free == slots.num_slots
+
+
+def test_shared_batch_too_large():
+    dataset = PremadeSamplesDataset(SAMPLE_DIR, UKRegionalSample)
+    slots = SharedBatchSlots(num_slots=2, slot_bytes=64)
+    dataloader = SharedBatchDataLoader(
+        dataset, batch_size=2, num_workers=1, collate_fn=SharedBatchCollator(slots, collate_fn)
+    )
+
+    # Batches which do not fit in a slot are sent as normal
+    batch = next(iter(dataloader))
+    assert batch["gsp"].shape[0] == 2
+    assert slots.num_free == 2
+
+
+def test_datamodule_shared_batch_slots():
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=2,
+        prefetch_factor=1,
+        shared_batch_slot_bytes=100_000_000,
+    )
+    dataloader = dm.val_dataloader()
+    assert isinstance(dataloader, SharedBatchDataLoader)
+    assert dataloader.collate_fn.slots.num_slots == 6
+
+    for batch in dataloader:
+        assert batch["gsp"].shape[0] <= 2
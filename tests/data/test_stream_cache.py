@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from ocf_data_sampler.config import load_yaml_configuration
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+from ocf_data_sampler.torch_datasets.datasets.pvnet_uk import PVNetUKRegionalDataset
+
+from pvnet.data.base_datamodule import PremadeSamplesDataset
+from pvnet.data.stream_cache import StreamedSampleCache
+from pvnet.data.utils import flatten_sample, get_all_sample_coords, get_sample_coords
+
+SAMPLE_DIR = "tests/test_data/presaved_samples_uk_regional"
+
+
+class _Location:
+    def __init__(self, id):
+        self.id = id
+
+
+class MockStreamedDataset(PVNetUKRegionalDataset):
+    """Serves premade samples as if they were streamed, and counts how many are generated"""
+
+    def __init__(self, config_path: str = f"{SAMPLE_DIR}/data_configuration.yaml"):
+        self.config = load_yaml_configuration(config_path)
+        self.samples = PremadeSamplesDataset(f"{SAMPLE_DIR}/train", UKRegionalSample)
+        self.valid_t0_times = pd.date_range("2023-01-01 12:00", periods=2, freq="30min")
+        self.locations = [_Location(i) for i in range(4)]
+        self.index_pairs = [(t, loc) for t in range(2) for loc in range(4)]
+        self.num_generated = 0
+
+    def __len__(self):
+        return len(self.index_pairs)
+
+    def __getitem__(self, idx):
+        self.num_generated += 1
+        return self.samples[idx]
+
+
+def _assert_samples_equal(a, b):
+    a, b = flatten_sample(a), flatten_sample(b)
+    assert set(a) == set(b)
+    for key in a:
+        np.testing.assert_array_equal(a[key], b[key])
+
+
+def test_stream_cache(tmp_path):
+    dataset = MockStreamedDataset()
+    cache = StreamedSampleCache(dataset, f"{tmp_path}/cache")
+
+    first = [cache[i] for i in range(len(cache))]
+    assert dataset.num_generated == 8
+    assert os.path.isfile(cache.get_sample_path(5))
+    assert cache.get_sample_path(5).endswith("20230101/20230101T1230_1.bin")
+
+    # Samples are served from the cache by a new dataset with the same configuration
+    new_dataset = MockStreamedDataset()
+    new_cache = StreamedSampleCache(new_dataset, f"{tmp_path}/cache")
+    for i in range(len(new_cache)):
+        _assert_samples_equal(new_cache[i], first[i])
+    assert new_dataset.num_generated == 0
+
+
+def test_stream_cache_format_mismatch(tmp_path):
+    StreamedSampleCache(MockStreamedDataset(), f"{tmp_path}/cache")
+    with pytest.raises(ValueError):
+        StreamedSampleCache(MockStreamedDataset(), f"{tmp_path}/cache", image_encoding="float16")
+
+
+def test_get_all_sample_coords():
+    dataset = MockStreamedDataset()
+    coords = get_all_sample_coords(dataset)
+
+    assert len(coords) == len(dataset)
+    for idx in range(len(dataset)):
+        t0, target_id = get_sample_coords(dataset, idx)
+        assert coords["t0"].iloc[idx] == t0
+        assert coords["target_id"].iloc[idx] == target_id
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+from ocf_data_sampler.sample.uk_regional import UKRegionalSample
+
+from pvnet.callbacks import DataStageMonitor
+from pvnet.data import DataModule
+from pvnet.data.packed_samples import PackedSamplesDataset, pack_samples
+from pvnet.data.projection import SampleProjection
+from pvnet.data.timing import DATA_STAGES, StageTimer, time_stage
+
+
+def test_stage_timer():
+    timer = StageTimer()
+
+    with timer.time("read"):
+        sum(range(10_000))
+    with time_stage(timer, "collate"):
+        pass
+    # Nothing is timed without a timer
+    with time_stage(None, "decode"):
+        pass
+
+    seconds = timer.get_seconds()
+    assert set(seconds) == set(DATA_STAGES)
+    assert seconds["read"] > 0
+    assert seconds["collate"] >= 0
+    assert seconds["decode"] == 0
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_datamodule_stage_times(num_workers):
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=num_workers,
+        prefetch_factor=None if num_workers == 0 else 1,
+        time_data_stages=True,
+    )
+
+    dataloader = dm.train_dataloader()
+    for _ in dataloader:
+        pass
+
+    seconds = dm.train_stage_timer.get_seconds()
+    for stage in ["read", "to_numpy", "decode", "collate", "to_tensor"]:
+        assert seconds[stage] > 0
+    assert seconds["generate"] == 0
+    # There is no projection
+    assert seconds["project"] == 0
+
+
+def test_datamodule_no_stage_times():
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+    )
+    dm.train_dataloader()
+    assert dm.train_stage_timer is None
+
+
+def test_packed_stage_times(tmp_path):
+    pack_samples(
+        "tests/test_data/presaved_samples_uk_regional/train",
+        f"{tmp_path}/train",
+        UKRegionalSample,
+        samples_per_shard=4,
+    )
+
+    timer = StageTimer()
+    dataset = PackedSamplesDataset(
+        f"{tmp_path}/train",
+        projection=SampleProjection(include_satellite=False),
+        stage_timer=timer,
+    )
+    dataset.__getitems__([0, 1, 5])
+
+    seconds = timer.get_seconds()
+    for stage in ["read", "project", "decode", "collate"]:
+        assert seconds[stage] > 0
+
+
+def test_data_stage_monitor():
+    dm = DataModule(
+        configuration=None,
+        sample_dir="tests/test_data/presaved_samples_uk_regional",
+        batch_size=2,
+        num_workers=0,
+        prefetch_factor=None,
+        projection=SampleProjection(include_satellite=False),
+        time_data_stages=True,
+    )
+
+    logged = {}
+    pl_module = SimpleNamespace(log_dict=lambda values, **kwargs: logged.update(values))
+    # The timer is read from the datamodule, not from the dataloader the trainer holds
+    trainer = SimpleNamespace(datamodule=dm, log_every_n_steps=2)
+
+    monitor = DataStageMonitor()
+    for batch_idx, batch in enumerate(dm.train_dataloader()):
+        monitor.on_train_batch_end(trainer, pl_module, None, batch, batch_idx)
+
+    for stage in ["read", "project", "decode", "collate"]:
+        assert logged[f"data/{stage}_ms"] > 0
+    assert "data/generate_ms" not in logged
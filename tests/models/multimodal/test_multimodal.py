@@ -1,6 +1,9 @@
+import torch
 from torch.optim import SGD
 import pytest
 
+from pvnet.models.multimodal.multimodal import Model
+
 
 def test_model_forward(multimodal_model, sample_batch):
     y = multimodal_model(sample_batch)
@@ -45,3 +48,24 @@ def test_weighted_quantile_model_forward(multimodal_quantile_model_ignore_minute
 
     # Backwards on sum drives sum to zero
     y_quantiles.sum().backward()
+
+
+def test_adapt_batch_keeps_ignored_forecast_steps(multimodal_model_kwargs, sample_batch):
+    kwargs = dict(multimodal_model_kwargs, forecast_minutes=360)
+    model = Model(
+        output_quantiles=[0.1, 0.5, 0.9], forecast_minutes_ignore=120, adapt_batches=True, **kwargs
+    )
+    # history_len=4, forecast_len_ignore=4, forecast_len=8
+    series_len = 4 + 4 + 8 + 1
+
+    gsp = sample_batch["gsp"].clone()
+    batch = model._adapt_batch(dict(sample_batch))
+    assert batch["gsp"].shape[1] == series_len
+    assert batch["gsp_solar_azimuth"].shape[1] == series_len
+
+    # The target is the forecast after the ignored steps
+    target = batch["gsp"][:, -model.forecast_len :]
+    torch.testing.assert_close(target, gsp[:, 4 + 1 + 4 : series_len])
+
+    y_quantiles = model(dict(sample_batch))
+    assert tuple(y_quantiles.shape) == (2, 8, 3), y_quantiles.shape